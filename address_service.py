@@ -0,0 +1,130 @@
+import os
+import re
+import json
+
+
+# Address words removed before geocoding and sending to 1C
+DEL_PATTERN = re.compile(
+    r"улица\s*|ул\.*\s|дом(\s|,)|д\.*\s|город(\s|,)|гор\.*\s|г\.*\s",
+    re.IGNORECASE
+)
+# Building and block written as one letter with the number, e.g. 1к3 or 98с4
+CH_PATTERN = re.compile(
+    r'(,*\sстроение|,*\sстр\.*|,*\sс\.*)\s(\d+)|(,*\sкорпус|,*\sкорп\.*|,*\sк\.*)\s(\d+)',
+    re.IGNORECASE
+)
+SEPARATORS_PATTERN = re.compile(r"[\s,.;]+")
+
+
+def replacement(match):
+    if match.group(1):
+        return f"с{match.group(2)}"
+    elif match.group(3):
+        return f"к{match.group(4)}"
+    return match.group(0)
+
+
+def normalize_address(address):
+    address = CH_PATTERN.sub(replacement, address)
+    return DEL_PATTERN.sub('', address)
+
+
+def address_key(address):
+    # Case, spacing and punctuation insensitive key of a normalized address
+    return SEPARATORS_PATTERN.sub(" ", normalize_address(address)).strip().lower()
+
+
+def numbers(key):
+    # House, корпус and строение of a key, e.g. "128к3" for both "128к3" and "128 к3"
+    return "".join(token for token in key.split() if any(char.isdigit() for char in token))
+
+
+def trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+
+class AddressIndex:
+    def __init__(self, index_path, logger, similarity=0.85):
+        self.logger = logger
+        self.index_path = index_path
+        self.similarity = similarity
+        self.entries = None
+        self.trigram_index = {}
+        self.mtime = None
+
+    def load(self):
+        # Lazy loading of confirmed addresses with the trigram index
+        self.entries = {}
+        self.trigram_index = {}
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+            self.mtime = os.path.getmtime(self.index_path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.logger.error(f"Error in loading address index: {e}")
+        for key in self.entries:
+            self.index_key(key)
+        self.logger.info(f"Address index loaded with {len(self.entries)} addresses")
+
+    def ensure_loaded(self):
+        if self.entries is None:
+            self.load()
+            return
+        try:
+            if os.path.getmtime(self.index_path) != self.mtime:
+                self.load()
+        except OSError:
+            pass
+
+    def index_key(self, key):
+        for trigram in trigrams(key):
+            self.trigram_index.setdefault(trigram, set()).add(key)
+
+    def lookup(self, address):
+        # Confirmed address with the same key or a similar spelling of the same building,
+        # None if a remote geocoding is needed
+        self.ensure_loaded()
+        key = address_key(address)
+        if key in self.entries:
+            return self.entries[key]
+
+        query = trigrams(key)
+        counts = {}
+        for trigram in query:
+            for candidate in self.trigram_index.get(trigram, ()):
+                counts[candidate] = counts.get(candidate, 0) + 1
+        best_key = None
+        best_similarity = 0
+        for candidate, shared in counts.items():
+            similarity = shared / (len(query) + len(trigrams(candidate)) - shared)
+            if similarity > best_similarity:
+                best_key, best_similarity = candidate, similarity
+        if best_key and best_similarity >= self.similarity:
+            # Neighbouring buildings differ only in numbers, a similar address of another one is geocoded
+            if numbers(best_key) == numbers(key):
+                return self.entries[best_key]
+            self.logger.info(f"Similar confirmed address {best_key} is another building, geocoding {key}")
+        return None
+
+    def add(self, address, latitude, longitude, affilate):
+        # Saving an address confirmed by a customer
+        self.ensure_loaded()
+        key = address_key(address)
+        self.entries[key] = {
+            "address": address,
+            "latitude": float(latitude),
+            "longitude": float(longitude),
+            "affilate": affilate,
+        }
+        self.index_key(key)
+        try:
+            temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f, ensure_ascii=False)
+            os.replace(temp_path, self.index_path)
+            self.mtime = os.path.getmtime(self.index_path)
+        except Exception as e:
+            self.logger.error(f"Error in saving address index: {e}")
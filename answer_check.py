@@ -0,0 +1,97 @@
+import re
+
+
+class Rule:
+    def __init__(self, name, patterns, tool, used_tools=(), excluded=None):
+        # Answer matching all patterns (and not excluded) without any of used_tools
+        # claims an action that was not done, tool is forced to do it
+        self.name = name
+        self.patterns = [re.compile(pattern, re.IGNORECASE) for pattern in patterns]
+        self.excluded = re.compile(excluded, re.IGNORECASE) if excluded else None
+        self.tool = tool
+        self.used_tools = {tool, *used_tools}
+
+    def matches(self, output, steps):
+        if not all(pattern.search(output) for pattern in self.patterns):
+            return False
+        if self.excluded and self.excluded.search(output):
+            return False
+        return not any(step[0].tool in self.used_tools for step in steps)
+
+
+RULES = [
+    Rule(
+        "address_saved",
+        [r"адрес", r"зон", r"8 495 463 50 46|автоматич"],
+        "Saving_address",
+        ("Create_request", "Saving_GPS-coordinates")
+    ),
+    Rule(
+        "request_created",
+        [r"заявк[ау]", r"созда|оформл"],
+        "Create_request",
+        excluded=r"подтвер|мастер"
+    ),
+    Rule(
+        "request_changed",
+        [r"обновл[её]н"],
+        "Change_request"
+    ),
+    Rule(
+        "operator_called",
+        [r"пере[дв]", r"оператор"],
+        "Call_operator",
+        ("Create_request", "Saving_address", "Saving_GPS-coordinates")
+    ),
+]
+
+
+class AnswerChecker:
+    def __init__(self, logger, rules=None):
+        self.logger = logger
+        self.rules = rules or RULES
+        self.checks = 0
+        # rule name: detections, corrected, failed, correction time
+        self.counters = {
+            rule.name: {
+                "detections": 0,
+                "corrected": 0,
+                "failed": 0,
+                "correction_time_total": 0.0,
+            }
+            for rule in self.rules
+        }
+
+    def detect(self, output, steps):
+        # First rule broken by the answer, None if it is consistent with the tool calls
+        self.checks += 1
+        for rule in self.rules:
+            if rule.matches(output, steps):
+                self.counters[rule.name]["detections"] += 1
+                return rule
+        return None
+
+    def record(self, rule, corrected, latency):
+        counters = self.counters[rule.name]
+        counters["corrected" if corrected else "failed"] += 1
+        counters["correction_time_total"] += latency
+
+    def stats(self):
+        return {
+            "checks": self.checks,
+            "rules": {
+                name: {
+                    **counters,
+                    "detection_rate": round(
+                        counters["detections"] / self.checks, 4
+                    ) if self.checks else None,
+                    "correction_rate": round(
+                        counters["corrected"] / counters["detections"], 4
+                    ) if counters["detections"] else None,
+                    "added_latency_avg": round(
+                        counters["correction_time_total"] / counters["detections"], 3
+                    ) if counters["detections"] else None,
+                }
+                for name, counters in self.counters.items()
+            },
+        }
@@ -0,0 +1,117 @@
+# Compares GeoService with the former per-vertex geodesic loop.
+# Run from the repository root: python benchmarks/geo_benchmark.py [points]
+import os
+import sys
+import json
+import time
+import random
+import logging
+
+from geopy.distance import geodesic
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from geo_service import GeoService, zone_class
+
+
+def geodesic_distance_calculation(latitude, longitude, affilate_coordinates):
+    # Former ChatAgent.distance_calculation implementation
+    distance = float('inf')
+    affilate = None
+
+    for aff, boundaries in affilate_coordinates:
+        if abs(latitude - boundaries[0][0]) < 7 and abs(longitude - boundaries[0][1]) < 3:
+            for coordinates in boundaries:
+                current_distance = geodesic(
+                    [latitude, longitude],
+                    coordinates
+                ).kilometers
+                if current_distance < distance:
+                    distance = current_distance
+                    affilate = aff
+    return distance, affilate
+
+
+def random_points(affilates, count, seed=654321):
+    # Points scattered up to ~150 km around random boundary vertices
+    rng = random.Random(seed)
+    boundaries = list(affilates.values())
+    points = []
+    for _ in range(count):
+        latitude, longitude = rng.choice(rng.choice(boundaries))
+        points.append((
+            latitude + rng.uniform(-1.3, 1.3),
+            longitude + rng.uniform(-2, 2)
+        ))
+    return points
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger(__name__)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+    with open("./data/affilates_coordinates.json", "r", encoding="utf-8") as f:
+        affilates = json.load(f)["affilates"]
+    points = random_points(affilates, count)
+
+    start = time.perf_counter()
+    geo_service = GeoService(
+        "./data/affilates_coordinates.json",
+        "/tmp/affilates_coordinates.bin",
+        None,
+        logger
+    )
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    geo_service.build_zones()
+    zones_time = time.perf_counter() - start
+    geo_service.zones_path = "/tmp/affilates_zones.npz"
+
+    start = time.perf_counter()
+    fast = [geo_service.nearest(lat, lon) for lat, lon in points]
+    fast_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    geo_service.nearest_batch([p[0] for p in points], [p[1] for p in points])
+    batch_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    zones = [geo_service.classify(lat, lon) for lat, lon in points]
+    zones_lookup_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    slow = [
+        geodesic_distance_calculation(lat, lon, affilates.items())
+        for lat, lon in points
+    ]
+    slow_time = time.perf_counter() - start
+
+    # Only points the old window pre-filter could see are comparable
+    compared = [
+        (f, s) for f, s in zip(fast, slow) if s[1] is not None
+    ]
+    mismatches = sum(1 for f, s in compared if f[1] != s[1])
+    deviations = [abs(f[0] - s[0]) for f, s in compared]
+    relative = [
+        abs(f[0] - s[0]) / s[0] for f, s in compared if s[0] > 1
+    ]
+
+    print(f"points: {count}, comparable: {len(compared)}")
+    print(f"index build: {build_time * 1000:.1f} ms")
+    print(f"geodesic loop: {slow_time / count * 1000:.2f} ms/point")
+    print(f"geo service: {fast_time / count * 1000:.3f} ms/point")
+    print(f"geo service batch: {batch_time / count * 1000:.4f} ms/point")
+    print(f"zone table build: {zones_time * 1000:.1f} ms")
+    print(f"zone table lookup: {zones_lookup_time / count * 1000:.4f} ms/point")
+    print(f"affilate mismatches: {mismatches}")
+    print(f"zone class mismatches: {sum(1 for z, s in zip(zones, slow) if z[0] != zone_class(s[1], s[0]))}")
+    if deviations:
+        print(f"max abs deviation: {max(deviations):.3f} km")
+    if relative:
+        print(f"max rel deviation: {max(relative) * 100:.3f} %")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# Benchmarks the hedged geocoding client against the local geocoder stub.
+# Run from the repository root: python benchmarks/geocoder_benchmark.py [requests] [concurrency]
+import os
+import sys
+import time
+import asyncio
+import logging
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from geocoder import GeocodingClient
+from geocode_cache import GeocodeCache
+from resilience import Resilience
+from geocoding_scheduler import GeocodingScheduler
+
+
+STUB_PORT = 7490
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+async def run(client, count, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def lookup(index):
+        async with semaphore:
+            start = time.perf_counter()
+            await client.geocode(
+                f"Тестовая {index}, Москва",
+                f"Москва, Тестовая улица, {index}",
+                f"Тестовая {index}, Москва"
+            )
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(lookup(i) for i in range(count)), return_exceptions=True)
+    total = time.perf_counter() - start
+    return latencies, total
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger(__name__)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    env = {
+        "NOMINATIM_LATENCY": "0.4",
+        "NOMINATIM_JITTER": "0.6",
+        "YANDEX_LATENCY": "0.5",
+        "YANDEX_JITTER": "0.1",
+        **os.environ,
+    }
+    stub = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "stubs.geocoder_stub:app",
+            "--port", str(STUB_PORT), "--log-level", "warning"
+        ],
+        env=env
+    )
+    try:
+        time.sleep(2)
+        for hedge_delay in (60, 0.8):
+            with tempfile.TemporaryDirectory() as temp_dir:
+                cache = GeocodeCache(os.path.join(temp_dir, "cache.db"), logger)
+                scheduler = GeocodingScheduler(
+                    os.path.join(temp_dir, "nominatim_slot"),
+                    logger,
+                    rate=50
+                )
+                client = GeocodingClient(
+                    cache,
+                    scheduler,
+                    Resilience(logger),
+                    logger,
+                    hedge_delay=hedge_delay,
+                    stub_url=f"http://127.0.0.1:{STUB_PORT}"
+                )
+                latencies, total = asyncio.run(run(client, count, concurrency))
+                print(f"hedge delay {hedge_delay} s: {len(latencies)} ok in {total:.2f} s")
+                print(
+                    f"  p50 {percentile(latencies, 0.5):.3f} s, "
+                    f"p95 {percentile(latencies, 0.95):.3f} s, "
+                    f"p99 {percentile(latencies, 0.99):.3f} s"
+                )
+                print(f"  {client.stats()}")
+                print(f"  {scheduler.stats()}")
+    finally:
+        stub.terminate()
+
+
+if __name__ == "__main__":
+    main()
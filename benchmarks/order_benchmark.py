@@ -0,0 +1,79 @@
+# Compares order payload building from the precompiled model with reloading template.json.
+# Run from the repository root: python benchmarks/order_benchmark.py [orders]
+import os
+import sys
+import json
+import time
+
+import orjson
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from order_model import OrderBuilder
+
+
+TEMPLATE_PATH = "./data/template.json"
+
+
+def template_payload(index):
+    # Former create_request implementation
+    with open(TEMPLATE_PATH, "r", encoding="utf-8") as f:
+        order_params = json.load(f)
+    order_params["order"]["client"]["display_name"] = "Иван"
+    order_params["order"]["address"]["floor"] = "5"
+    order_params["order"]["address"]["entrance"] = "2"
+    order_params["order"]["address"]["apartment"] = "17"
+    order_params["order"]["address"]["intercom"] = ""
+    order_params["order"]["services"][0]["service_id"] = "Холодильники"
+    order_params["order"]["desired_dt"] = "2024-10-01T00:00Z"
+    order_params["order"]["client"]["phone"] = "9161234567"
+    order_params["order"]["address"]["name"] = "Москва, Тверская 7"
+    order_params["order"]["address"]["name_components"][0]["name"] = "Москва"
+    order_params["order"]["comment"] = "Не морозит"
+    order_params["order"]["address"]["geopoint"]["latitude"] = 55.76
+    order_params["order"]["address"]["geopoint"]["longitude"] = 37.61
+    order_params["order"]["uslugi_id"] = f"20241001000000{index}"
+    return json.dumps(order_params).encode()
+
+
+def model_payload(builder, index):
+    payload = builder.build(
+        name="Иван",
+        floor="5",
+        entrance="2",
+        apartment="17",
+        intercom="",
+        direction="Холодильники",
+        date="2024-10-01T00:00Z",
+        phone="9161234567",
+        address="Москва, Тверская 7",
+        affilate="Москва",
+        comment="Не морозит",
+        latitude=55.76,
+        longitude=37.61,
+        uslugi_id=f"20241001000000{index}"
+    )
+    return orjson.dumps(payload.model_dump())
+
+
+def measure(name, function, count):
+    start = time.perf_counter()
+    for index in range(count):
+        function(index)
+    total = time.perf_counter() - start
+    print(f"{name}: {total / count * 1e6:.1f} us per order")
+    return total
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    builder = OrderBuilder(TEMPLATE_PATH)
+    assert orjson.loads(model_payload(builder, 1)) == json.loads(template_payload(1))
+
+    old = measure("template.json reload", template_payload, count)
+    new = measure("precompiled model", lambda index: model_payload(builder, index), count)
+    print(f"speedup: {old / new:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# Load test of the order outbox worker against the local 1C proxy stub.
+# Run from the repository root: python benchmarks/outbox_benchmark.py [orders] [error_rate]
+import os
+import sys
+import time
+import asyncio
+import logging
+import tempfile
+import subprocess
+
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ws_router import WsRouter
+from bid_cache import BidCache
+from order_outbox import OrderOutbox
+from resilience import Resilience
+from proxy_client import ProxyClient
+
+
+STUB_PORT = 7495
+
+
+class RecordingBot:
+    # Collects pushed request numbers instead of sending them to Telegram
+    def __init__(self):
+        self.delivered = {}
+
+    async def send_message(self, chat_id, text):
+        self.delivered[chat_id] = time.perf_counter()
+        return SimpleNamespace(
+            from_user=SimpleNamespace(
+                first_name="bot",
+                last_name=None,
+                is_bot=True,
+                id=0,
+                username=None
+            ),
+            message_id=0,
+            date=time.time()
+        )
+
+    async def insert_message_to_sql(self, *args):
+        pass
+
+
+def order(index):
+    return {
+        "order": {
+            "uslugi_id": time.strftime("%Y%m%d%H%M%S") + str(index),
+            "services": [{"service_id": "Тест"}],
+            "address": {"name_components": [{"kind": "locality", "name": "Москва"}]},
+            "comment": "",
+        }
+    }
+
+
+async def run(outbox, bot, count):
+    outbox.start()
+    enqueued = {}
+    start = time.perf_counter()
+    for index in range(count):
+        await outbox.enqueue(index, order(index))
+        enqueued[index] = time.perf_counter()
+    enqueue_time = time.perf_counter() - start
+
+    while len(bot.delivered) < count:
+        statuses = outbox.stats()["statuses"]
+        if statuses.get("pending", 0) + statuses.get("submitted", 0) == 0:
+            break
+        await asyncio.sleep(0.5)
+    await outbox.stop()
+    await outbox.proxy_client.close()
+
+    delays = sorted(bot.delivered[index] - enqueued[index] for index in bot.delivered)
+    return enqueue_time, delays
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger(__name__)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    error_rate = sys.argv[2] if len(sys.argv) > 2 else "0.2"
+
+    env = {"PROXY_ERROR_RATE": error_rate, **os.environ}
+    stub = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "stubs.proxy_stub:app",
+            "--port", str(STUB_PORT), "--log-level", "warning"
+        ],
+        env=env
+    )
+    try:
+        time.sleep(2)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            proxy_client = ProxyClient(
+                f"http://127.0.0.1:{STUB_PORT}",
+                Resilience(logger),
+                logger,
+                http2=False
+            )
+            bot = RecordingBot()
+            ws_router = WsRouter(proxy_client, {}, logger)
+            outbox = OrderOutbox(
+                os.path.join(temp_dir, "outbox.db"),
+                proxy_client,
+                ws_router,
+                BidCache(ws_router, logger),
+                {},
+                bot,
+                bot,
+                logger,
+                base_delay=0.5,
+                max_delay=5,
+                number_polls=10,
+                concurrency=20
+            )
+            enqueue_time, delays = asyncio.run(run(outbox, bot, count))
+            print(f"enqueue: {enqueue_time / count * 1000:.2f} ms per order")
+            if delays:
+                print(
+                    f"number delivered for {len(delays)}/{count} orders, "
+                    f"p50 {delays[len(delays) // 2]:.2f} s, "
+                    f"p95 {delays[int(len(delays) * 0.95)]:.2f} s"
+                )
+            print(f"  {outbox.stats()}")
+    finally:
+        stub.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+# Customer flows against the local 1C proxy stub: bid lists and consecutive request changes.
+# Run from the repository root: python benchmarks/proxy_benchmark.py [customers] [changes] [revision_drift]
+import os
+import sys
+import time
+import asyncio
+import logging
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ws_router import WsRouter
+from bid_cache import BidCache
+from order_model import OrderBuilder
+from order_metadata import OrderMetadataCache
+from resilience import Resilience
+from proxy_client import ProxyClient
+
+
+STUB_PORT = 7496
+WS_PATHS = {"msk": "/msk/ws", "spb": "/spb/ws", "reg": "/reg/ws"}
+ORDER_PATH = {"crm": "/crm/"}
+CHANGE_PATH = {"domain": "/domain/"}
+REGIONS = {"Москва": "msk", "Санкт-Петербург": "spb"}
+AFFILATES = ["Москва", "Санкт-Петербург", "Казань"]
+REVISION_CONFLICT = 409
+
+
+async def create(proxy_client, builder, chat_id):
+    affilate = AFFILATES[chat_id % len(AFFILATES)]
+    order = builder.build(
+        name="Иван",
+        direction="Холодильники",
+        date="2024-10-01T00:00Z",
+        phone="9161234567",
+        address=f"{affilate}, Тверская 7",
+        affilate=affilate,
+        comment="Не морозит",
+        latitude=55.76,
+        longitude=37.61,
+        uslugi_id=time.strftime("%Y%m%d%H%M%S") + str(chat_id)
+    ).model_dump()
+    await proxy_client.http_service(ORDER_PATH, {"order": order})
+    return affilate
+
+
+async def change(proxy_client, builder, order_metadata, bid_cache, chat_id, request_number, comment):
+    # Same flow as ChatAgent.change_request
+    for attempt in range(2):
+        metadata = await order_metadata.get(request_number, refresh=attempt > 0)
+        change_params = builder.build(
+            uslugi_id=metadata["partner_number"],
+            date=metadata["date"],
+            affilate=metadata["locality"],
+            revision=metadata["revision"] + 1,
+            comment=comment
+        ).model_dump()
+        response = await proxy_client.exchange(
+            {"domain": CHANGE_PATH["domain"] + metadata["partner_number"]},
+            change_params
+        )
+        if response.status_code == 200:
+            order_metadata.update(
+                request_number,
+                revision=change_params["order"]["revision"],
+                comment=comment
+            )
+            bid_cache.invalidate(chat_id)
+            return True
+        if response.status_code != REVISION_CONFLICT:
+            break
+        order_metadata.conflict(request_number)
+    return False
+
+
+async def customer(proxy_client, builder, order_metadata, bid_cache, chat_id, changes, latencies):
+    affilate = await create(proxy_client, builder, chat_id)
+    bids = []
+    while not bids:
+        # Waiting for the request number like the outbox worker does
+        await asyncio.sleep(0.2)
+        bid_cache.invalidate(chat_id)
+        bids = (await bid_cache.get(chat_id, affilate)).get(REGIONS.get(affilate, "reg"), [])
+    request_number = bids[0]["id"]
+
+    changed = 0
+    for index in range(changes):
+        start = time.perf_counter()
+        await bid_cache.get(chat_id, affilate)
+        if await change(
+            proxy_client,
+            builder,
+            order_metadata,
+            bid_cache,
+            chat_id,
+            request_number,
+            f"Комментарий {index}"
+        ):
+            changed += 1
+        latencies.append(time.perf_counter() - start)
+    return changed
+
+
+async def run(customers, changes):
+    logger = logging.getLogger(__name__)
+    proxy_client = ProxyClient(
+        f"http://127.0.0.1:{STUB_PORT}",
+        Resilience(logger),
+        logger,
+        http2=False
+    )
+    ws_router = WsRouter(proxy_client, WS_PATHS, logger, REGIONS, "reg")
+    bid_cache = BidCache(ws_router, logger)
+    order_metadata = OrderMetadataCache(ws_router, proxy_client, ORDER_PATH, logger)
+    builder = OrderBuilder("./data/template.json")
+    latencies = []
+    try:
+        changed = await asyncio.gather(*[
+            customer(proxy_client, builder, order_metadata, bid_cache, chat_id, changes, latencies)
+            for chat_id in range(customers)
+        ])
+        stub_stats = (await proxy_client.client.get("/stats")).json()
+    finally:
+        await proxy_client.close()
+
+    latencies.sort()
+    print(
+        f"changes applied {sum(changed)}/{customers * changes}, "
+        f"p50 {latencies[len(latencies) // 2]:.2f} s, "
+        f"p95 {latencies[int(len(latencies) * 0.95)]:.2f} s"
+    )
+    print(f"  stub: {stub_stats}")
+    print(f"  order_metadata: {order_metadata.stats()}")
+    print(f"  bid_cache: {bid_cache.stats()}")
+    print(f"  ws_routes: {ws_router.stats()}")
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    customers = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    changes = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    drift = sys.argv[3] if len(sys.argv) > 3 else "0.1"
+
+    env = {
+        "REVISION_DRIFT": drift,
+        "NUMBER_DELAY": "0.5",
+        "PROXY_LATENCY_DIST": "lognormal",
+        "PROXY_LATENCY": "0.2",
+        "PROXY_JITTER": "0.2",
+        **os.environ
+    }
+    stub = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "stubs.proxy_stub:app",
+            "--port", str(STUB_PORT), "--log-level", "warning"
+        ],
+        env=env
+    )
+    try:
+        time.sleep(2)
+        asyncio.run(run(customers, changes))
+    finally:
+        stub.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import os
+import time
+import asyncio
+
+from pathlib import Path
+
+
+class BidCache:
+    def __init__(self, ws_router, logger, ttl=60, sweep_every=500, stamps_dir=None):
+        self.logger = logger
+        self.ws_router = ws_router
+        self.ttl = ttl
+        self.sweep_every = sweep_every
+        # Invalidation time stamps of the chats shared by all workers, one file per chat
+        self.stamps_dir = stamps_dir
+        if stamps_dir is not None:
+            Path(stamps_dir).mkdir(parents=True, exist_ok=True)
+        # chat_id: {route: (expiration time, 1C lookup latency, results, lookup start time)}
+        self.entries = {}
+        self.in_flight = {}
+        # chat_id: invalidations, kept only while the chat has entries or running lookups
+        self.generations = {}
+        self.running = {}
+        self.lookups = 0
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "invalidations": 0,
+            "expired": 0,
+            "shared_invalidations": 0,
+            "lookup_time_total": 0.0,
+            "saved_time_total": 0.0,
+        }
+
+    async def fetch(self, key, affilate):
+        chat_id, route = key
+        generation = self.generations.get(chat_id, 0)
+        self.running[chat_id] = self.running.get(chat_id, 0) + 1
+        try:
+            started = time.time()
+            start = time.monotonic()
+            results = await self.ws_router.query(
+                {
+                    "Идентификатор": "bid_numbers",
+                    "НомерПартнера": chat_id,
+                },
+                affilate
+            )
+            latency = time.monotonic() - start
+            self.counters["lookup_time_total"] += latency
+            # Results of a lookup started before an invalidation are not cached
+            if self.generations.get(chat_id, 0) == generation:
+                self.entries.setdefault(chat_id, {})[route] = (
+                    time.monotonic() + self.ttl, latency, results, started
+                )
+            return results
+        finally:
+            self.running[chat_id] -= 1
+            if self.running[chat_id] == 0:
+                self.running.pop(chat_id)
+                self.prune(chat_id, time.monotonic())
+
+    def stamp_path(self, chat_id):
+        return os.path.join(self.stamps_dir, chat_id)
+
+    def stamp(self, chat_id):
+        # Time of the last invalidation of the chat by any worker, 0 if none is known
+        try:
+            return os.stat(self.stamp_path(chat_id)).st_mtime
+        except OSError:
+            return 0
+
+    def check_stamp(self, chat_id):
+        # Entries looked up before an invalidation in another worker are dropped
+        routes = self.entries.get(chat_id)
+        if not routes or self.stamps_dir is None:
+            return
+        stamp = self.stamp(chat_id)
+        for route in [route for route, entry in routes.items() if entry[3] <= stamp]:
+            routes.pop(route)
+            self.counters["shared_invalidations"] += 1
+
+    def prune(self, chat_id, now):
+        # Expired entries of the chat, its generation goes when nothing of the chat is left
+        routes = self.entries.get(chat_id, {})
+        for route in [route for route, entry in routes.items() if entry[0] <= now]:
+            routes.pop(route)
+            self.counters["expired"] += 1
+        if not routes:
+            self.entries.pop(chat_id, None)
+            if chat_id not in self.running:
+                self.generations.pop(chat_id, None)
+
+    def sweep(self):
+        now = time.monotonic()
+        for chat_id in list(self.entries):
+            self.prune(chat_id, now)
+        for chat_id in [chat_id for chat_id in self.generations if chat_id not in self.entries]:
+            self.prune(chat_id, now)
+        # Stamps older than twice the TTL can not be newer than any live entry
+        if self.stamps_dir is not None:
+            expired = time.time() - self.ttl * 2
+            try:
+                for entry in os.scandir(self.stamps_dir):
+                    if entry.stat().st_mtime < expired:
+                        os.unlink(entry.path)
+            except OSError as e:
+                self.logger.error(f"Error in sweeping bid cache stamps: {e}")
+
+    async def get(self, chat_id, affilate=None):
+        # Customer bids by 1C base, one web service call per chat within the TTL
+        chat_id = str(chat_id)
+        key = (chat_id, self.ws_router.route(affilate))
+        self.lookups += 1
+        if self.lookups % self.sweep_every == 0:
+            self.sweep()
+        self.prune(chat_id, time.monotonic())
+        self.check_stamp(chat_id)
+        entry = self.entries.get(chat_id, {}).get(key[1])
+        if entry is not None:
+            _, latency, results, _ = entry
+            self.counters["hits"] += 1
+            self.counters["saved_time_total"] += latency
+            return results
+
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.counters["coalesced"] += 1
+        else:
+            self.counters["misses"] += 1
+            task = asyncio.create_task(self.fetch(key, affilate))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda done: self.forget(key, done))
+        return await asyncio.shield(task)
+
+    def peek(self, chat_id):
+        # Whether cached lookups of the chat found bids, None if none is cached
+        chat_id = str(chat_id)
+        self.prune(chat_id, time.monotonic())
+        self.check_stamp(chat_id)
+        routes = self.entries.get(chat_id)
+        if not routes:
+            return None
+        return any(any(results.values()) for _, _, results, _ in routes.values())
+
+    def forget(self, key, task):
+        if self.in_flight.get(key) is task:
+            self.in_flight.pop(key)
+
+    def invalidate(self, chat_id):
+        # Called after a bid of the chat was created or changed, other workers see the stamp
+        chat_id = str(chat_id)
+        if self.stamps_dir is not None:
+            try:
+                Path(self.stamp_path(chat_id)).touch()
+            except OSError as e:
+                self.logger.error(f"Error in saving bid cache stamp: {e}")
+        for key in [key for key in self.in_flight if key[0] == chat_id]:
+            self.in_flight.pop(key)
+        routes = self.entries.pop(chat_id, {})
+        self.counters["invalidations"] += len(routes)
+        # Only running lookups need the generation to drop their results
+        if chat_id in self.running:
+            self.generations[chat_id] = self.generations.get(chat_id, 0) + 1
+        else:
+            self.generations.pop(chat_id, None)
+
+    def stats(self):
+        served = (
+            self.counters["hits"]
+            + self.counters["misses"]
+            + self.counters["coalesced"]
+        )
+        return {
+            **self.counters,
+            "hit_ratio": round(
+                (self.counters["hits"] + self.counters["coalesced"]) / served, 3
+            ) if served else None,
+            "entries": sum(len(routes) for routes in self.entries.values()),
+            "chats": len(self.entries),
+            "in_flight": len(self.in_flight),
+        }
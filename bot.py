@@ -1,12 +1,13 @@
+import io
 import os
 import re
+import csv
 import time
 import json
 import logging
 
 import asyncio
 import aiofiles
-import requests
 
 from uuid import uuid4
 from pathlib import Path
@@ -15,13 +16,30 @@ from datetime import datetime, timedelta
 
 from pyrogram import Client
 from pydub import AudioSegment
-from openai import OpenAI, RateLimitError
-from fastapi.responses import JSONResponse
+from openai import OpenAI
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi import FastAPI, Request, Header
 from telebot import async_telebot, apihelper
 from telebot.types import ReplyKeyboardMarkup, KeyboardButton, BotCommand, BotCommandScopeChat
 
 from langchain_env import ChatAgent
+from system_prompt import dynamic_prompt
+from answer_check import AnswerChecker
+from history_compactor import HistoryCompactor
+from chat_turns import ChatTurns
+from geo_service import GeoService
+from address_service import AddressIndex, normalize_address
+from geocoder import GeocodingClient
+from geocode_cache import GeocodeCache
+from geocoding_scheduler import GeocodingScheduler
+from proxy_client import ProxyClient
+from resilience import Resilience
+from llm_router import LlmRouter
+from ws_router import WsRouter
+from bid_cache import BidCache
+from order_outbox import OrderOutbox
+from order_metadata import OrderMetadataCache
+from order_model import OrderBuilder
 from file_service import FileService
 from config_manager import ConfigManager
 
@@ -48,23 +66,136 @@ class Application:
             "./data/cc/channel_posts.json",
             self.logger
         )
-        self.coordinates_manager = ConfigManager(
+        self.resilience = Resilience(
+            self.logger,
+            self.config_manager.get("resilience", {})
+        )
+        self.answer_checker = AnswerChecker(self.logger)
+        router_config = self.config_manager.get("llm_router", {})
+        self.llm_router = LlmRouter(
+            self.resilience,
+            self.logger,
+            router_config.get("providers", ["OpenAI", "Anthropic"]),
+            router_config.get("cooldown", 120),
+            router_config.get("max_error_rate", 0.3),
+            router_config.get("max_latency", 30),
+            router_config.get("min_calls", 5),
+            router_config.get("min_remaining_requests", 2)
+        )
+        self.geo_service = GeoService(
             "./data/affilates_coordinates.json",
+            "./data/affilates_coordinates.bin",
+            "./data/affilates_zones.npz",
+            self.logger
+        )
+        self.geocode_cache = GeocodeCache(
+            "./data/geocode_cache.db",
+            self.logger
+        )
+        self.address_index = AddressIndex(
+            "./data/address_index.json",
             self.logger
         )
         self.set_keys()
+        geocoding_config = self.config_manager.get("geocoding", {})
+        self.geocoding_scheduler = GeocodingScheduler(
+            "./data/nominatim_slot",
+            self.logger,
+            geocoding_config.get("nominatim_rate", 1.0),
+            geocoding_config.get("nominatim_max_queue", 50),
+            geocoding_config.get("nominatim_max_wait", 10)
+        )
+        self.geocoder = GeocodingClient(
+            self.geocode_cache,
+            self.geocoding_scheduler,
+            self.resilience,
+            self.logger,
+            geocoding_config.get("nominatim_user_agent", "my_app"),
+            geocoding_config.get("hedge_delay", 1.5),
+            geocoding_config.get("nominatim_timeout", 5),
+            geocoding_config.get("yandex_timeout", 5),
+            geocoding_config.get("stub_url", "")
+        )
+        proxy_config = self.config_manager.get("proxy_client", {})
+        self.proxy_client = ProxyClient(
+            proxy_config.get("stub_url") or self.config_manager.get("proxy_url"),
+            self.resilience,
+            self.logger,
+            proxy_config.get("timeouts"),
+            proxy_config.get("max_connections", 20),
+            proxy_config.get("max_keepalive_connections", 10),
+            proxy_config.get("http2", True)
+        )
+        self.ws_router = WsRouter(
+            self.proxy_client,
+            self.config_manager.get("ws_paths"),
+            self.logger,
+            self.config_manager.get("ws_regions", {}),
+            self.config_manager.get("ws_default_base")
+        )
+        self.bid_cache = BidCache(
+            self.ws_router,
+            self.logger,
+            self.config_manager.get("bid_cache_ttl", 60),
+            500,
+            "./data/bid_cache"
+        )
         self.TOKEN = os.environ.get("BOT_TOKEN", "")
         self.bot = async_telebot.AsyncTeleBot(self.TOKEN)
         self.chat_data_service = FileService(
             self.config_manager.get("chats_dir"),
             self.bot,
+            self.resilience,
             self.logger
         )
         self.request_service = FileService(
             self.config_manager.get("request_dir"),
             self.bot,
+            self.resilience,
             self.logger
         )
+        history_config = self.config_manager.get("chat_history", {})
+        self.history_compactor = HistoryCompactor(
+            self.chat_data_service,
+            self.resilience,
+            self.logger,
+            self.config_manager.get("openai_model"),
+            history_config.get("token_budget", 3000),
+            history_config.get("keep_turns", 6)
+        )
+        turns_config = self.config_manager.get("chat_turns", {})
+        self.chat_turns = ChatTurns(
+            self.chat_data_service,
+            self.logger,
+            turns_config.get("debounce", 1.5),
+            turns_config.get("max_wait", 5)
+        )
+        self.order_builder = OrderBuilder("./data/template.json")
+        self.order_metadata = OrderMetadataCache(
+            self.ws_router,
+            self.proxy_client,
+            self.config_manager.get("order_path"),
+            self.logger,
+            self.config_manager.get("order_metadata_ttl", 600)
+        )
+        outbox_config = self.config_manager.get("order_outbox", {})
+        self.order_outbox = OrderOutbox(
+            "./data/order_outbox.db",
+            self.proxy_client,
+            self.ws_router,
+            self.bid_cache,
+            self.config_manager.get("order_path"),
+            self.bot,
+            self.chat_data_service,
+            self.logger,
+            outbox_config.get("max_attempts", 8),
+            outbox_config.get("base_delay", 2),
+            outbox_config.get("max_delay", 300),
+            outbox_config.get("number_polls", 5),
+            outbox_config.get("concurrency", 4),
+            outbox_config.get("lease", 120),
+            outbox_config.get("draft_window", 600)
+        )
         self.empty_response = JSONResponse(
             content={"type": "empty", "body": ""}
         )
@@ -156,6 +287,14 @@ Cвяжитесь с нами по телефону 8 495 463 50 46 для да
             "YANDEX_GEOCODER_KEY",
             ""
         )
+        os.environ["STATS_TOKEN"] = self.auth_manager.get(
+            "STATS_TOKEN",
+            ""
+        )
+        os.environ["ZONE_CHECK_TOKEN"] = self.auth_manager.get(
+            "ZONE_CHECK_TOKEN",
+            ""
+        )
         self.logger.info("Auth data set successfully")
 
     def setup_logging(self):
@@ -216,6 +355,13 @@ Cвяжитесь с нами по телефону 8 495 463 50 46 для да
             request: Request,
             authorization: str = Header(None)
         ):
+            # Turn of the chat taken while processing is released with the request
+            try:
+                return await process_message(request, authorization)
+            finally:
+                self.chat_turns.release_current()
+
+        async def process_message(request, authorization):
             self.logger.info("Handle_message")
 
             if authorization and authorization.startswith("Bearer "):
@@ -603,21 +749,8 @@ Cвяжитесь с нами по телефону 8 495 463 50 46 для да
             
             elif user_message == "📑 Выбрать свою активную заявку":
                 await self.bot.delete_message(chat_id, message_id)
-                token = os.environ.get("1С_TOKEN", "")
-                login = os.environ.get("1C_LOGIN", "")
-                password = os.environ.get("1C_PASSWORD", "")
 
                 try:
-                    ws_url = f'{self.config_manager.get("proxy_url")}/ws'        
-                    ws_params = {
-                        "Идентификатор": "bid_numbers",
-                        "НомерПартнера": str(chat_id),
-                    }
-                    ws_data = {
-                        "clientPath": self.config_manager.get("ws_paths"),
-                        "login": login,
-                        "password": password,
-                    }
                     request_numbers = {}
                     divisions = self.config_manager.get("divisions")
                 except Exception as e:
@@ -625,14 +758,14 @@ Cвяжитесь с нами по телефону 8 495 463 50 46 для да
                     return f"Ошибка при получении параметров вэб-сервиса: {e}"
 
                 try:
-                    results = requests.post(
-                        ws_url,
-                        json={
-                            "config": ws_data,
-                            "params": ws_params,
-                            "token": token
-                        }
-                    ).json()["result"]
+                    saved_request = await self.request_service.read_request(
+                        chat_id,
+                        True
+                    )
+                    results = await self.bid_cache.get(
+                        chat_id,
+                        saved_request.get("affilate")
+                    )
                     self.logger.info(f"results: {results}")
                     for value in results.values():
                         if len(value) > 0:
@@ -709,11 +842,48 @@ Cвяжитесь с нами по телефону 8 495 463 50 46 для да
                 except:
                     self.logger.info("Chat id not received yet")
 
+                # Messages of a burst are answered by one agent turn,
+                # operator dialogues and maintenance answers are not queued into turns
+                turn = None
+                if (
+                    str(chat_id) not in self.dialogues_api_accounts
+                    and (self.is_llm_active or str(chat_id) in self.WHITE_LIST_IDS)
+                ):
+                    turn = await self.chat_turns.enter(chat_id, message_id, user_message)
+                    if turn is None:
+                        # read_chat_history saves the user message of a turn to SQL DB,
+                        # a merged message does not get there, so it is saved the same way here
+                        if "text" in message:
+                            try:
+                                await self.chat_data_service.insert_message_to_sql(
+                                    message["from"].get("first_name"),
+                                    message["from"].get("last_name"),
+                                    message["from"]["is_bot"],
+                                    message["from"]["id"],
+                                    chat_id,
+                                    message_id,
+                                    datetime.fromtimestamp(message["date"]),
+                                    message["text"],
+                                    message["from"].get("username")
+                                )
+                            except Exception as error:
+                                self.logger.error(
+                                    f"Error in saving message to SQL: {error}"
+                                )
+                        return
+                    user_message = turn.text
+
                 chat_history = await self.chat_data_service.read_chat_history(
                     chat_id,
                     message_id,
                     self.TOKEN
                 )
+                # Merged messages go to the agent only as the input
+                if turn is not None:
+                    chat_history = [
+                        history_message for history_message in chat_history
+                        if int(history_message.id or 0) not in turn.message_ids
+                    ]
                 self.logger.info(f"History for {chat_id}: {chat_history}")
 
                 # Ignoring messages from dialogues with the presence of a human operator
@@ -770,11 +940,14 @@ Cвяжитесь с нами по телефону 8 495 463 50 46 для да
                         message_id
                     )
                 try:
-                    request = await self.request_service.read_request(chat_id)
+                    draft = await self.request_service.read_request(chat_id, True)
                 except Exception as e:
                     self.logger.error(
                         f"Error in reading current request files: {e}"
                     )
+                    draft = {}
+                # Affilate is not shown to the agent, it is kept for the tools of the turn
+                request = {key: value for key, value in draft.items() if key != "affilate"}
                 try:
                     date = time.strftime(
                         "%Y-%m-%d",
@@ -788,96 +961,6 @@ Cвяжитесь с нами по телефону 8 495 463 50 46 для да
                     date = time.strftime("%Y-%m-%d", time.localtime())
                     time_str = time.strftime("%H:%M", time.localtime())
 
-                system_prompt = f"""Вы - только сотрудник колл-центра сервисного центра по ремонту и различным бытовым услугам. Говорите всегда от мужского рода. Отвечайте на русском языке, учитывая контекст переписки. ОБЯЗАТЕЛЬНО здоровайтесь в рамках одного диалога за один день, но ТОЛЬКО однократно. На благодарности же клиента просто свободно отвечайте, а НЕ ещё раз уточняйте или отправляйте данные, так как это не новое обращение. Вы получаете сообщения от клиента c аккаунта с именем {user_name}.
-Ваша итоговая цель - в принципе МАКСИМАЛЬНО дружелюбно, доброжелательно, внимательно и участливо на каждом этапе отвечать на вопросы клиента (если ТОЧНО и ОПРЕДЕЛЁННО знаете на них ответ, иначе ОБЯЗАТЕЛЬНО используйте ваш инструмент Call_operator) только в рамках ваших должностных обязанностей сотрудника колл-центра и деятельности комании и вести с ним диалог, а также оформлять заявки, обязательно используя соответствующий инструмент Create_request.
-Ни в коем случае не отвечайте абсолютно ни на какие вопросы, кроме тех, что относятся к деятельности, услугам сервисного центра. То есть никаких советов и нерелевантной информации самому давать не нужно.
-ОБЯЗАТЕЛЬНО никогда НЕ будьте настойчивы при запросе нужной информации, то есть в том числе НИ В КОЕМ СЛУЧАЕ НЕ запрашивайте повторно, несколько раз один и тот же пункт перечисленной ниже нужной вам информации в нескольких ваших сообщениях подряд во время ответов на вопросы или возражения клиента, просто ТОЛЬКО отвечайте на них и далее НИЧЕГО больше в каждом таком сообщении. Запросить повторно одну и ту же информацию в одном диалоге можете ТОЛЬКО ПОСЛЕ того, как вы убедитесь, УТОЧНИВ у самого клиента, а не сами, что у него НЕ осталось вопросов по текущей теме.
-Также цель - для создания заявок запрашивать сообщениями у клиента, ТОЛЬКО если он уже НЕ предоставил это сам ранее в диалоге (в таком случае не уточняйте, а просто сохраняйте информацию в заявку с помощью ваших инструментов) и у него НЕТ вопросов, ПО ОДНОМУ сообщению:
-1) ТОЛЬКО если имеющееся у вас имя аккаунта клиента - {user_name} - выглядит НЕ как обычное человеческое, а как какой-то ЛОГИН / НИКНЕЙМ, - в НАЧАЛЕ диалога ДО всех остальных вопросов однократно запрашивайте имя клиента, как к нему можно обращаться. Иначе, если у вас есть обычное имя, обращайтесь сами по нему без уточнения, в том числе при приветствии. Но клиент может отказаться называть его при вопросе, в таком случае снова НЕ настаивайте;
-2) цель / причину обращения. Если вы однозначно не уверены в ней после ответа, уточните ещё раз, а не сохраняйте сразу, например, если вам сказали просто про машинку без уточнения, какая она;
-3) какие-либо дополнительные обстоятельства, характеристики обращения (сформулируйте сами в зависимости от причины обращения, например, какая именно неисправность, если обращение по поводу поломки, нюансы установки, в чём особенности и тому подобное), ТОЛЬКО, если клиент не назвал уже их ранее сам, но именно подробные. Если названа только причина без подробностей, уточняйте! Клиент также может отказаться отвечать на этот пункт, запрашивайте его разово и в любом случае продолжайте уточнять следующие, в таком случае НИКАКИХ обстоятельств отказа, ответ клиента сохранять НЕ нужно!;
-4) ТОЛЬКО если в обращении фигурирует какая-либо именно ТЕХНИКА (например, услуги, окна, двери или сантехника техникой НЕ являются), запросите её бренд, модель при наличии, иначе НЕ запрашивайте! Если же запрашиваете, то снова только разово, без возврата к этому пункту позднее, и не настаивайте на ответе при отказе;
-5) телефон ИМЕННО контактного лица на адресе для связи с мастером;
-6) адрес, куда требуется ВЫЕЗД мастера (нужны сразу как минимум ТРИ следующих пункта в формате:
-город,
-улица,
-номер дома с корпусом или строением при наличии,
-донесите это в том числе до клиента), нужно ОБЯЗАТЕЛЬНО получить от клиента в итоге как минимум ВСЕ эти ТРИ пункта адреса. Определяйте это и проверяйте их наличие в ответе клиента СРАЗУ в диалоге и запрашивайте СРАЗУ повторно, если не ВСЕ ТРИ (город, улица, номер) указаны!
-Прописывайте эти пункты в своём сообщении ТОЛЬКО на ОТДЕЛЬНЫХ новых абзацах с промежутками между строками.
-Также оповестите клиента, что при желании он может просто указать нужные координаты адреса на карте через соответствующую кнопку меню чата справа снизу, выключив GPS и указав 'Выбрать вручную'. Получив такие координаты, далее запрашивать основную часть адреса до дома НЕ нужно;
-7) дополнительную информацию по адресу - квартиру, подъезд, этаж, код/домофон.
-Запрашивайте только ОДНОКРАТНО, именно получить необязательно, но запрашивайте ОДНОЗНАЧНО и УВЕРЕННО, НЕ НУЖНО самому изначально нанаводить клиента на мысль о необязательности, прописывая, например, ему 'если это возможно' или подобные сомнительные обороты, НЕ НУЖНО упоминать, что это необязательно.
-Клиент может отказаться предоставлять данную информацию полностью или частично, запросить что-то ещё, например, звонок мастера (который будет после оформления заявки), в таком случае СРАЗУ просто ПРОДОЛЖАЙТЕ работу БЕЗ этой дополнительной информации и БЕЗ повторных уточнений);
-а также цель - каждый раз СРАЗУ после получения, а НЕ потом несколько одновременно, СОХРАНИТЬ каждый этот пункт с помощью ваших ИНСТРУМЕНТОВ по одному ОБЯЗАТЕЛЬНО для каждой новой заявки и каждый раз, когда информация по пункту будет обновляться! НЕ запрашивайте несколько пунктов в одном сообщении.
-В том числе по запросу клиента вы можете менять / дополнять информацию в уже оформленных заявках. Для этого используйте ТОЛЬКО ваши инструменты Request_selection (ОДИН РАЗ для запроса ТОЛЬКО НОМЕРА) и Change_request, ВСЕГДА ОБА, Change_request ПОСЛЕ Request_selection. НЕ запрашивайте номер заявки у клиента без использования Request_selection, но используйте этот инструмент СРАЗУ и ТОЛЬКО ОДИН РАЗ!
-Далее указана ваша детальная инструкция, внимательно и чётко обязательно соблюдайте из неё ВСЕ пункты. НЕ додумывайте сами никаких фактов, которых нет в вашей инструкции! Если не нужная вам информация однозначно не указана в инструкции, НЕ придумывайте ничего, а СРАЗУ ОБЯЗАТЕЛЬНО используйте ваш инструмент Call_operator.
-Актуальные направления, причины обращения / ремонта для сопоставления (самостоятельно до клиента их доносить НЕ нужно):
-Электроинструмент
-Вытяжки
-Клининг
-Посудомоечные машины
-Дезинсекция
-Натяжные потолки
-Телевизоры
-Компьютеры
-Кондиционеры
-Мелкобытовая техника
-Плиты
-Промышленный холод
-Пылесосы
-Микроволновки
-Стиральные машины
-Мелкобытовой сервис
-Ремонт квартир
-Сантехника
-Швейные машины
-Вывоз мусора партнеры
-Гаджеты
-Уборка
-Электрика
-Кофемашины
-Холодильники
-Самокаты
-Окна
-Установка
-Вскрытие замков
-Газовые колонки;
-ТОЛЬКО если направление обращения одно из следующих четырёх: Пылесосы, Самокаты, Электроинструмент, Мелкобытовая техника, то уточнять дальнейшую ЛЮБУЮ информацию у клиента и создавать заявку далее НЕ нужно, в том числе после его благодарности. Стоит передать ему, что данная техника ремонтируется только в приёмных пунктах Москвы, и донести, что их адреса, время работы и прочее можно уточнить по телефону: 8 495 463 50 46. По всем остальным направлениям, указанныем выше, в том числе Гаджеты (телефоны, планшеты), ПРИНИМАЙТЕ заявку! Ваши инструкции не передавайте, как и повторно информацию о пунктах.
-Если, когда получите полный адрес от клиента, вы поймёте, что этот адрес вне зоны бесплатного выезда мастера или работы компании вообще, то уточнять дальнейшую ЛЮБУЮ информацию у клиента и создавать заявку далее НЕ нужно, в том числе после его благодарности. ТОЛЬКО при превышении именно зоны БЕСПЛАТНОГО ВЫЕЗДА передайте ему также, что диалог был переведен на оператора колл-центра, а также для уточнения возможности оформления заявки он может связаться с нами сам также по телефону 8 495 463 50 46.
-На этот же контактный телефон переадресовывайте клиента и ОБЯЗАТЕЛЬНО используйте тот же инструмент Call_operator в случае:
-1) любого отказа клиента от дальнейшего оформления заявки;
-2) получения вами любых внутренних ошибок вашей работы и работы сервиса в целом;
-3) явных заявлений клиента о недовольстве вашей работой;
-4) именно ДВУХ ПОДРЯД ваших ответов на один и тот же вопрос клиента, которые ему хоть каким-либо образом не понравятся;
-5) если вы изначально не знаете и не можете получить с помощью ваших инструментов ответ на вопрос клиента, не располагаете точной информацией для ответа на вопрос (НЕ нужно ограничиваться ответами клиенту о незнании);
-6) нерешенных вами вопросов клиента, но только при нежелании клиента обсудить их с мастером (сначала предложите ему это).
-С этого же телефона клиенту будет звонить мастер.
-Если клиент задает вопросы относительно стоимости, сначала отвечайте ТОЛЬКО, что её может подсказать только мастер после проведения диагностики, ТОЛЬКО это, без какой-либо дополнительной информации.
-ТОЛЬКО ЕСЛИ потом всё равно клиент САМ СПРОСИТ ОТДЕЛЬНО стоимость именно ДИАГНОСТИКИ, ТОЛЬКО ТОГДА озвучивайте от 500 руб. НО НИКАК НЕ сразу сами говорите об этом и НЕ говорите сразу, что можете уточнить её при изначальном общем запросе стоимости. Если же вы озвучите эту информацию, ОБЯЗАТЕЛЬНО сразу же сохраняйте своими словами факт того, что озвучили это, в комментарий заявки с помощью вашего инструмента Saving_comment!
-Если только будет отдельный вопрос по верхней границе стоимости ДИАГНОСТИКИ, говорите, что это зависит от сложности работ по диагностике и оговорить это также можно с мастером, также ТОЛЬКО при таком конкретном запросе клиента.
-На вопрос о стоимости именно ВЫЕЗДА мастера отвечайте, что это бесплатно, также предоставляйте эту информацию только по запросу, а не сами.
-Если вопрос о причине запроса адреса / отказ в его предоставлении, объясняйте, что это нужно для распределения заявки на мастера с района клиента.
-Если же вопрос о причине запроса телефона / отказ в его предоставлении, объясняйте, что это нужно для модерации фейковых спам-обращений.
-Без указания данных выше создать заявку не получится!
-Если клиент запрашивает связь с мастером до предоставления всей именно ОБЯЗАТЕЛЬНОЙ для вас информации (номер подъезда и тому подобное НЕ обязателен, например), объясните ему, что вам нужно её узнать именно для СОЗДАНИЯ ЗАЯВКИ, которая также распределится на конкретного мастера, который и будет звонить. 
-Отменять никакие заявки НЕ нужно, даже по запросу клиента. В таком случае донесите до него, что он сможет обсудить всё это с мастером, который ему позвонит.
-ВСЕГДА ОБЯЗАТЕЛЬНО используйте ваш инструмент Saving_visit_date для сохранения даты по умолчанию в зависимости от вашего текущего времени - {time_str}. Если оно до 19:00 - передавайте в инструмент только сегодняшню дату - {date}. Иначе же, если после 19:00 - передавайте сами уже только завтрашнюю дату.
-Запрашивать дату у клиента НЕ НУЖНО, определяйте сами!
-ТОЛЬКО в случае, если клиент САМ первый по своей инициативе упомянул о нужной ему дате визита мастера в ЛЮБОМ формате, в том числе относительно сегодняшнего дня (завтра, послезавтра и т.д.) - используйте это инструмент ещё раз, передавая только дату (без времени).
-Если в процессе диалога клиент передаст какую-то дополнительную информацию в целом в истории чата, любом своем сообщении или даже его части (например, об любых обстоятельствах и деталях неисправности / нужной услуги, нюансах расположения локации запроса, доступности клиента и т.п.), являющуюся полезной для компании или ваших коллег, мастеров и т.д., также передавайте КАЖДУЮ такую в заявку с помощью соответствующего инструмента. Но ни в коем случае НЕЛЬЗЯ использовать именно этот инструмент для передачи информации, содержащей детали адреса (квартира, подъезд и т.п.) или ЛЮБЫЕ телефоны клиента, даже если он сам просит, для этого используйте ваши ДРУГИЕ соответствующие инструменты.
-Вам доступен набор инструментов. Вам НАСТОЯТЕЛЬНО рекомендуется ИСПОЛЬЗОВАТЬ ваши инструменты для сохранения информации СРАЗУ и ПО ОТДЕЛЬНОСТИ, как только будет доступна НОВАЯ соответствующая информация, КАЖДЫЙ РАЗ для КАЖДОЙ новой заявки и при поступлении НОВОЙ информации! Если информация обновилась, сразу вызывайте инструмент для сохранения ПОВТОРНО, передавая НОВЫЕ данные, чтобы обновить их!
-Текущее содержание новой заявки: {request}. Пока в этой заявке не хватает какого-либо пункта из перечисленных выше, то ТОЛЬКО при ОТСУТСТВИИ вопросов клиента запрашивайте этот пункт ПО ОДНОМУ, а не в одном сообщении. ПОСЛЕ получения от клиента сообщения с данными СРАЗУ ИСПОЛЬЗУЙТЕ ОДИН из ваших соответствующих ИНСТРУМЕНТОВ для сохранения НОВЫХ данных в заявку, в зависимости от того, что именно было получено. А НЕ уже после получения всех данных.
-Далее только если у вас уже есть и "direction", и "date", и "phone", и "latitude", и "longitude", и "address", и "address_line_2" (или последнее было хотя бы однократно запрошено), СНАЧАЛА ОБЯЗАТЕЛЬНО уточните у клиента корректность сразу всех переданных им данных, в том числе именно "direction" (называя его для клиента ТОЛЬКО "причиной обращения") и "address_line_2" при его наличии, НО КРОМЕ "date", "latitude", "longitude" и "comment", прислав их ему. Уточняйте ТОЛЬКО ТАК, по отдельности разные пункты НЕ нужно, как НЕ нужно НИКОГДА уточнять "date", "latitude", "longitude" и "comment".
-Уточняйте именно сам имеющийся у вас полный адрес, а НЕ его координаты! В этом одном сообщении выносите каждый отдельный пункт на отдельный новый абзац c промежутком между строками и обязательно именуйте КАЖДЫЙ отдельный элемент подтверждаемой информации, например, по отдельности разные детали адреса. 
-Объяснять причину уточнения НЕ нужно! А после, ТОЛЬКО в случае получения ЯВНОГО именно ПОДТВЕРЖДЕНИЯ, СРАЗУ ОБЯЗАТЕЛЬНО ИСПОЛЬЗУЙТЕ ваш инструмент "Create_request" для создания каждой новой заявки.
-Сообщайте клиенту о создании заявки ТОЛЬКО, если действительно сами получили информацию из ИНСТРУМЕНТА, что заявка была создана. Честность и точность для вас ВСЕГДА важнее, чем всё остальное.
-Простой ответ "да" также является подтверждением, ещё раз уточнять НЕ нужно. Подтверждением НЕ является просто любое другое сообщение, явно не подтверждающее данные.
-Если же клиент указал на неточность данных, снова вызывайте только соответствующие инструменты для обновления заявки только для этих актуальных данных. И повторно после согласовывайте сначала корректность данных после изменений, ПРЕЖДЕ ЧЕМ создавать заявку. Она создается ТОЛЬКО ПОСЛЕ финального подтверждения для каждой новой заявки.
-В завершающем создание заявки сообщении для клиента после использования ИНСТРУМЕНТА "Create_request" и ТОЛЬКО в случае получения самими вами информации о фактическом создании заявки, если ваше текущее время - {time_str} - до 19:00, доносите, что мастер свяжется с ним сегодня в течение часа. Если город обращения Екатеринбург или Новосибирск, то в течение двух часов, но НИ В КОЕМ СЛУЧАЕ НЕ пишите клиенту, что это из-за города, присылайте ему только информацию о времени!
-Если же ваше текущее время после 19:00, то доносите, что мастер свяжется с клиентом уже завтра.
-Только если в результате создания заявки вы действительно получили её номер, в этом же завершающем сообщении передавайте его клиенту.
-chat_id текущего клиента - {chat_id}"""
-
                 # Creating chat agent
                 if self.chat_agent is None:
                     self.chat_agent = ChatAgent(
@@ -886,162 +969,104 @@ chat_id текущего клиента - {chat_id}"""
                         self.config_manager.get("openai_temperature"),
                         self.config_manager.get("anthropic_temperature"),
                         self.config_manager.get("request_dir"),
-                        self.config_manager.get("proxy_url"),
+                        self.proxy_client,
+                        self.bid_cache,
+                        self.order_outbox,
+                        self.order_metadata,
+                        self.order_builder,
                         self.config_manager.get("order_path"),
                         self.config_manager.get("ws_paths"),
                         self.config_manager.get("change_path"),
                         self.config_manager.get("dialogue_path"),
                         self.config_manager.get("divisions"),
-                        self.coordinates_manager.get("affilates"),
+                        self.geo_service,
+                        self.geocoder,
+                        self.address_index,
                         self.logger,
                         self.bot,
                         self.request_service,
                         self.chat_data_service,
                         self.ban_manager,
-                        self.dialogues_api_manager
+                        self.dialogues_api_manager,
+                        self.resilience,
+                        self.llm_router,
+                        self.config_manager.get("batched_request_fields", True)
                     )
                     self.chat_agent.initialize_agent()
                     asyncio.create_task(self.periodic_task())
+                self.chat_agent.use_draft(chat_id, draft)
+
+                async def agent_inputs(company, error=None):
+                    # Older turns are folded into the running summary of the chat
+                    # by the provider serving the run
+                    summary, history = "", chat_history
+                    try:
+                        summary, history = await self.history_compactor.compact(
+                            chat_id,
+                            chat_history,
+                            company,
+                            self.chat_agent.llms[company]
+                        )
+                    except Exception as e:
+                        self.logger.error(f"Error in chat history compaction: {e}")
+
+                    system_prompt = dynamic_prompt(
+                        user_name,
+                        request,
+                        date,
+                        time_str,
+                        chat_id,
+                        summary
+                    )
+                    if error is not None:
+                        system_prompt += f". Сейчас вы получили следующую ошибку при своей работе, попробуйте действовать иначе: {error}"
+                    return {
+                        "system_prompt": system_prompt,
+                        "input": user_message,
+                        "chat_history": history,
+                    }
 
                 # Reply to user message
                 try:
+                    tool_names = self.chat_agent.select_tools(chat_id, request)
                     try:
-                        try:
-                            bot_response = await self.chat_agent.agent_executor.ainvoke(
-                                {
-                                    "system_prompt": system_prompt,
-                                    "input": user_message,
-                                    "chat_history": chat_history,
-                                }
-                            )
-                        # Answer by alternative LLM
-                        except RateLimitError as oai_limit_error:
-                            self.logger.error(
-                                f"""Exceeded OpenAI quota: {oai_limit_error},
-                                change agent to Anthropic model"""
-                            )
-                            self.chat_agent.initialize_agent("Anthropic")
-                            bot_response = await self.chat_agent.agent_executor.ainvoke(
-                                {
-                                    "system_prompt": system_prompt,
-                                    "input": user_message,
-                                    "chat_history": chat_history,
-                                }
-                            )
+                        # Alternative LLM is chosen by the router of the agent
+                        bot_response = await self.chat_agent.run_agent(
+                            agent_inputs,
+                            tool_names
+                        )
                     # Answer with error handling
                     except Exception as first_error:
                         self.logger.error(
                             f"Error in agent run: {first_error}, second try"
                         )
-                        bot_response = await self.chat_agent.agent_executor.ainvoke(
-                            {
-                                "system_prompt": system_prompt+f". Сейчас вы получили следующую ошибку при своей работе, попробуйте действовать иначе: {first_error}",
-                                "input": user_message,
-                                "chat_history": chat_history,
-                            }
+                        bot_response = await self.chat_agent.run_agent(
+                            lambda company: agent_inputs(company, first_error),
+                            tool_names
                         )
                     output = bot_response["output"]
                     steps = bot_response["intermediate_steps"]
 
-                    # Detecting LLM hallucinations and reanswering
-                    if "адрес" in output.lower() and "зон" in output.lower() and (
-                        "8 495 463 50 46" in output.lower() or "автоматич" in output.lower()
-                    ) and (
-                        len(steps)==0 or (
-                            len(steps)>0 and not any(step[0].tool in {"Create_request", "Saving_address", "Saving_GPS-coordinates"} for step in steps)
-                        )
-                    ):
-                        self.logger.error(
-                            f"Detected deceptive hallucination in LLM answer, steps - {steps} reanswering.."
-                        )
-                        bot_response = await self.chat_agent.agent_executor.ainvoke(
-                            {
-                                "system_prompt": system_prompt,
-                                "input": """
-                                    Вы же на самом деле не сохраняли сейчас адрес и не использовали инструмент, исправьтесь!
-ОБЯЗАТЕЛЬНО сначала сохраните сейчас новый полученный адрес, используя ИНСТРУМЕНТ.
-Уточнять его заново и давать знать клиенту об этой вашей ошибке НЕ нужно, отвечайте дальше после использования, как обычно, как если бы её не было.
-                                """,
-                                "chat_history": chat_history,
-                            }
-                        )
-                        output = bot_response["output"]
-                        steps = bot_response["intermediate_steps"]
-
-                    elif (
-                        re.search(r'заявк[ау]', output.lower()
-                    ) and (
-                        "созда" in output.lower() or "оформл" in output.lower()
-                    ) and (
-                        "подтвер" not in output.lower() and "мастер" not in output.lower()
-                    )
-                    ) and (
-                        (
-                            len(steps)>0 and not any(step[0].tool == "Create_request" for step in steps)
-                        ) or len(steps)==0
-                    ):
-                        self.logger.error(
-                            f"Detected deceptive hallucination in LLM answer, reanswering.."
-                        )
-                        bot_response = await self.chat_agent.agent_executor.ainvoke(
-                            {
-                                "system_prompt": system_prompt,
-                                "input": """
-                                    Вы же на самом деле не создали сейчас заявку и не использовали инструмент, исправьтесь!
-ОБЯЗАТЕЛЬНО сначала создайте сейчас заявку, используя ИНСТРУМЕНТ 'Create_request'.
-Клиенту давать знать об этой вашей ошибке НЕ нужно, отвечайте дальше после создания, как обычно, как если бы её не было
-                                """,
-                                "chat_history": chat_history,
-                            }
-                        )
-                        output = bot_response["output"]
-                        steps = bot_response["intermediate_steps"]
-
-                    elif (
-                        re.search(r'обновл[её]н', output.lower()
-                    ) and (
-                        (
-                            len(steps)>0 and not any(step[0].tool == "Change_request" for step in steps)
-                        ) or len(steps)==0
-                    )):
+                    # Detecting LLM hallucinations and forcing the missing tool call
+                    rule = self.answer_checker.detect(output, steps)
+                    if rule is not None:
                         self.logger.error(
-                            f"Detected deceptive hallucination in LLM answer, reanswering.."
-                        )
-                        bot_response = await self.chat_agent.agent_executor.ainvoke(
-                            {
-                                "system_prompt": system_prompt,
-                                "input": """
-                                    Вы же на самом деле не изменили сейчас заявку и не использовали инструмент, исправьтесь!
-ОБЯЗАТЕЛЬНО сначала измените сейчас заявку, используя ИНСТРУМЕНТ 'Change_request'.
-Клиенту давать знать об этой вашей ошибке НЕ нужно, отвечайте дальше после создания, как обычно, как если бы её не было
-                                """,
-                                "chat_history": chat_history,
-                            }
-                        )
-                        output = bot_response["output"]
-                        steps = bot_response["intermediate_steps"]
-
-                    elif (
-                        re.search(r'пере[дв]', output.lower()) and "оператор" in output.lower()
-                    ) and (
-                        (
-                            len(steps)>0 and not any(step[0].tool in {"Call_operator", "Create_request", "Saving_address", "Saving_GPS-coordinates"} for step in steps)
-                        ) or len(steps)==0
-                    ):
-                        self.logger.error(
-                            f"Detected deceptive hallucination in LLM answer, reanswering.."
-                        )
-                        bot_response = await self.chat_agent.agent_executor.ainvoke(
-                            {
-                                "system_prompt": system_prompt,
-                                "input": """
-                                    Вы же на самом деле не позвали сейчас оператора и не использовали инструмент, исправьтесь!
-ОБЯЗАТЕЛЬНО сначала позовите сейчас оператора, используя ИНСТРУМЕНТ 'Call_operator'.
-Клиенту давать знать об этой вашей ошибке НЕ нужно, отвечайте дальше после создания, как обычно, как если бы её не было
-                                """,
-                                "chat_history": chat_history,
-                            }
+                            f"Detected deceptive hallucination in LLM answer by rule {rule.name}, steps - {steps}, calling {rule.tool}.."
                         )
+                        start = time.monotonic()
+                        corrected = False
+                        try:
+                            bot_response = await self.chat_agent.correct(
+                                bot_response,
+                                rule.tool
+                            )
+                            corrected = True
+                        finally:
+                            self.answer_checker.record(
+                                rule,
+                                corrected,
+                                time.monotonic() - start
+                            )
                         output = bot_response["output"]
                         steps = bot_response["intermediate_steps"]
 
@@ -1297,10 +1322,172 @@ chat_id текущего клиента - {chat_id}"""
                 answer = f"Параметр switch должен быть 0 или 1, передан {switch}"
                 return self.text_response(answer)
 
+        # Endpoint for batch check of addresses and coordinates against service zones
+        @self.app.post("/zone_check/{received_token}")
+        async def zone_check(request: Request, received_token: str):
+            correct_token = os.environ.get("ZONE_CHECK_TOKEN", "")
+            if not correct_token or received_token != correct_token:
+                answer = "Неверный токен проверки зон обслуживания"
+                return self.text_response(answer)
+
+            try:
+                if "csv" in request.headers.get("content-type", ""):
+                    body = (await request.body()).decode("utf-8-sig")
+                    rows = list(csv.DictReader(io.StringIO(body)))
+                else:
+                    rows = await request.json()
+                if not isinstance(rows, list):
+                    raise ValueError("a list of rows is expected")
+            except Exception as e:
+                self.logger.error(f"Error in reading zone check batch: {e}")
+                return JSONResponse(
+                    status_code=400,
+                    content={"error": f"Некорректный формат данных: {e}"}
+                )
+            self.logger.info(f"Zone check batch of {len(rows)} rows")
+
+            points = []
+            addresses = []
+            for index, row in enumerate(rows):
+                try:
+                    if row.get("latitude") not in (None, "") and row.get("longitude") not in (None, ""):
+                        points.append(
+                            (index, float(row["latitude"]), float(row["longitude"]))
+                        )
+                    else:
+                        addresses.append((index, str(row["address"])))
+                except Exception:
+                    addresses.append((index, None))
+
+            # Addresses are geocoded through the Nominatim queue shared with live customers
+            max_addresses = self.config_manager.get("zone_check_max_addresses", 200)
+            if len(addresses) > max_addresses:
+                return JSONResponse(
+                    status_code=400,
+                    content={"error": f"Не более {max_addresses} строк с адресом без координат в одной проверке"}
+                )
+
+            def zone_row(index, latitude, longitude, result, **extra):
+                zone, affilate, distance = result
+                return {
+                    "row": index,
+                    "latitude": latitude,
+                    "longitude": longitude,
+                    "affilate": affilate,
+                    "distance_km": round(distance, 3),
+                    "zone": zone,
+                    **extra
+                }
+
+            async def geocode_address(semaphore, index, address):
+                if not address:
+                    return {"row": index, "error": "Нет координат или адреса"}
+                async with semaphore:
+                    try:
+                        candidates = await self.geocoder.geocode(
+                            normalize_address(address),
+                            address,
+                            normalize_address(address)
+                        )
+                        return {"row": index, "candidate": candidates[0], "candidates": len(candidates)}
+                    except Exception as e:
+                        return {"row": index, "address": address, "error": f"Адрес не найден: {e!r}"}
+
+            async def stream_results():
+                # Coordinates in one vectorized pass, then geocoded addresses in another one
+                if points:
+                    results = self.geo_service.classify_batch(
+                        [point[1] for point in points],
+                        [point[2] for point in points]
+                    )
+                    for (index, latitude, longitude), result in zip(points, results):
+                        yield json.dumps(
+                            zone_row(index, latitude, longitude, result),
+                            ensure_ascii=False
+                        ) + "\n"
+
+                if not addresses:
+                    return
+                # A batch takes at most a quarter of the queue, the rest is left to customers
+                semaphore = asyncio.Semaphore(max(1, min(
+                    self.config_manager.get("zone_check_concurrency", 4),
+                    self.geocoding_scheduler.max_queue // 4
+                )))
+                tasks = [
+                    asyncio.create_task(geocode_address(semaphore, index, address))
+                    for index, address in addresses
+                ]
+                try:
+                    geocoded = await asyncio.gather(*tasks)
+                finally:
+                    for task in tasks:
+                        task.cancel()
+
+                found = [row for row in geocoded if "candidate" in row]
+                results = self.geo_service.classify_batch(
+                    [row["candidate"]["latitude"] for row in found],
+                    [row["candidate"]["longitude"] for row in found]
+                ) if found else []
+                results = dict(zip((row["row"] for row in found), results))
+                for row in geocoded:
+                    if "candidate" not in row:
+                        yield json.dumps(row, ensure_ascii=False) + "\n"
+                        continue
+                    candidate = row["candidate"]
+                    yield json.dumps(
+                        zone_row(
+                            row["row"],
+                            candidate["latitude"],
+                            candidate["longitude"],
+                            results[row["row"]],
+                            address=candidate["address"],
+                            candidates=row["candidates"]
+                        ),
+                        ensure_ascii=False
+                    ) + "\n"
+
+            return StreamingResponse(
+                stream_results(),
+                media_type="application/x-ndjson"
+            )
+
+        # Endpoint for service counters of the current worker
+        @self.app.get("/stats/{received_token}")
+        async def get_stats(received_token: str):
+            correct_token = os.environ.get("STATS_TOKEN", "")
+            if not correct_token or received_token != correct_token:
+                answer = "Неверный токен получения статистики"
+                return self.text_response(answer)
+
+            return JSONResponse(
+                content={
+                    "pid": os.getpid(),
+                    "geocode_cache": self.geocode_cache.stats(),
+                    "geocoder": self.geocoder.stats(),
+                    "nominatim_scheduler": self.geocoding_scheduler.stats(),
+                    "bid_cache": self.bid_cache.stats(),
+                    "ws_routes": self.ws_router.stats(),
+                    "dependencies": self.resilience.stats(),
+                    "llm_router": self.llm_router.stats(),
+                    "answer_check": self.answer_checker.stats(),
+                    "chat_history": self.history_compactor.stats(),
+                    "chat_turns": self.chat_turns.stats(),
+                    "chat_agent": self.chat_agent.stats() if self.chat_agent else None,
+                    "order_outbox": self.order_outbox.stats(),
+                    "order_metadata": self.order_metadata.stats(),
+                }
+            )
+
 
 application = Application()
 app = application.app
 
 @app.on_event("startup")
 async def startup_event():
-    await application.set_bot_commands()
\ No newline at end of file
+    await application.set_bot_commands()
+    application.order_outbox.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await application.order_outbox.stop()
+    await application.proxy_client.close()
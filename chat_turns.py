@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import fcntl
+import asyncio
+import contextvars
+
+from pathlib import Path
+
+
+class ChatTurn:
+    def __init__(self, chat_id, lock, lock_file, messages):
+        self.chat_id = chat_id
+        self.lock = lock
+        self.lock_file = lock_file
+        self.messages = messages
+        self.message_ids = {message["message_id"] for message in messages}
+        self.text = "\n".join(message["text"] for message in messages)
+
+
+class ChatTurns:
+    def __init__(self, chat_data_service, logger, debounce=1.5, max_wait=5):
+        self.logger = logger
+        self.chat_data_service = chat_data_service
+        self.debounce = debounce
+        self.max_wait = max_wait
+        # chat_id: [asyncio lock of the worker, requests using it]
+        self.locks = {}
+        self.current = contextvars.ContextVar("chat_turn", default=None)
+        self.counters = {
+            "messages": 0,
+            "turns": 0,
+            "merged_messages": 0,
+            "wait_time_total": 0.0,
+        }
+
+    def path(self, chat_id, name):
+        chat_dir = self.chat_data_service.file_path(chat_id)
+        Path(chat_dir).mkdir(parents=True, exist_ok=True)
+        return os.path.join(chat_dir, name)
+
+    def buffer(self, chat_id, message=None, consume=False):
+        # Pending messages of the chat shared by all workers, the file is locked only for a moment
+        with open(self.path(chat_id, "pending.jsonl"), "a+", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if message is not None:
+                f.write(json.dumps(message, ensure_ascii=False) + "\n")
+                f.flush()
+            f.seek(0)
+            messages = [json.loads(line) for line in f if line.strip()]
+            if consume:
+                f.truncate(0)
+            return messages
+
+    async def lock_file(self, chat_id):
+        # Turn lock across gunicorn workers, polled to keep the event loop free
+        lock_file = open(self.path(chat_id, "turn.lock"), "w")
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock_file
+            except BlockingIOError:
+                await asyncio.sleep(0.05)
+
+    async def enter(self, chat_id, message_id, text):
+        # Turn answering this message together with the following ones of the burst,
+        # None if it was already answered within the turn of an earlier message
+        self.counters["messages"] += 1
+        start = time.monotonic()
+        self.buffer(
+            chat_id,
+            {"message_id": message_id, "text": text, "time": time.time()}
+        )
+        entry = self.locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        await entry[0].acquire()
+        lock_file = None
+        try:
+            lock_file = await self.lock_file(chat_id)
+            messages = self.buffer(chat_id)
+            if not any(message["message_id"] == message_id for message in messages):
+                self.counters["merged_messages"] += 1
+                self.release(chat_id, entry[0], lock_file)
+                return None
+
+            # Waiting for the customer to finish the burst
+            while time.monotonic() - start < self.max_wait:
+                quiet = time.time() - max(message["time"] for message in messages)
+                if quiet >= self.debounce:
+                    break
+                await asyncio.sleep(self.debounce - quiet)
+                messages = self.buffer(chat_id)
+            messages = sorted(self.buffer(chat_id, consume=True), key=lambda message: message["message_id"])
+        except BaseException:
+            self.release(chat_id, entry[0], lock_file)
+            raise
+
+        self.counters["turns"] += 1
+        self.counters["wait_time_total"] += time.monotonic() - start
+        turn = ChatTurn(chat_id, entry[0], lock_file, messages)
+        self.current.set(turn)
+        if len(messages) > 1:
+            self.logger.info(f"Merged {len(messages)} messages of {chat_id} into one turn")
+        return turn
+
+    def release(self, chat_id, lock, lock_file):
+        if lock_file is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+        lock.release()
+        entry = self.locks[chat_id]
+        entry[1] -= 1
+        if entry[1] == 0:
+            self.locks.pop(chat_id)
+
+    def release_current(self):
+        # Called when the request of the turn is finished
+        turn = self.current.get()
+        if turn is not None:
+            self.current.set(None)
+            self.release(turn.chat_id, turn.lock, turn.lock_file)
+
+    def stats(self):
+        return {
+            **self.counters,
+            "llm_calls_saved": self.counters["merged_messages"],
+            "active_chats": len(self.locks),
+        }
@@ -12,8 +12,9 @@ from langchain.schema import AIMessage, HumanMessage
 
 
 class FileService:
-    def __init__(self, data_dir, bot_instance, logger):
+    def __init__(self, data_dir, bot_instance, resilience, logger):
         self.data_dir = data_dir
+        self.resilience = resilience
         self.logger = logger
         self.chat_history_client = None
         self.pool = None
@@ -176,9 +177,12 @@ class FileService:
         try:
             await self.chat_history_client.start()
             message_ids = list(range(message_id-199, message_id+1))
-            messages = await self.chat_history_client.get_messages(
-                chat_id,
-                message_ids
+            messages = await self.resilience.call(
+                "telegram_history",
+                lambda: self.chat_history_client.get_messages(
+                    chat_id,
+                    message_ids
+                )
             )
         except Exception as e:
             self.logger.error(
@@ -197,15 +201,18 @@ class FileService:
                     if message.text and message.text not in service_messages:
                         if message.from_user.is_bot:
                             chat_history.append(
-                                AIMessage(content=message.text)
+                                AIMessage(content=message.text, id=str(message.id))
                             )
                         else:
                             chat_history.append(
-                                HumanMessage(content=message.text)
+                                HumanMessage(content=message.text, id=str(message.id))
                             )
                     elif message.location:
                         chat_history.append(
-                                HumanMessage(content=f"Передаю координаты обращения для определения вами полного адреса - {message.location}")
+                                HumanMessage(
+                                    content=f"Передаю координаты обращения для определения вами полного адреса - {message.location}",
+                                    id=str(message.id)
+                                )
                             )
 
             message = messages[-1]
@@ -296,9 +303,52 @@ class FileService:
                 )
             )
 
+    async def save_request_fields(self, chat_id, fields):
+        # Saving several request items to fields.json in one write
+        self.logger.info(
+            f"[fields] Saving request items {list(fields)} to request for chat_id: {chat_id}"
+        )
+        message_date = time.strftime("%Y-%m-%d-%H-%M-%S", time.localtime())
+        request_dir = self.file_path(chat_id)
+        Path(request_dir).mkdir(parents=True, exist_ok=True)
+        full_path = os.path.join(request_dir, "fields.json")
+
+        saved_fields = {}
+        if Path(full_path).exists():
+            async with aiofiles.open(full_path, "r", encoding="utf-8") as log_file:
+                saved_fields = json.loads(await log_file.read()).get("fields", {})
+        fields = dict(fields)
+
+        # Adding a comment to the same string
+        if "comment" in fields:
+            comment_path = os.path.join(request_dir, "comment.json")
+            existing_text = saved_fields.get("comment", "")
+            if Path(comment_path).exists():
+                async with aiofiles.open(comment_path, "r", encoding="utf-8") as log_file:
+                    existing_text = json.loads(await log_file.read()).get("text", "")
+            if existing_text:
+                fields["comment"] = existing_text + ". " + fields["comment"]
+
+        saved_fields.update(fields)
+        async with aiofiles.open(full_path, "w") as log_file:
+            await log_file.write(
+                json.dumps(
+                    {
+                        "type": "fields",
+                        "fields": saved_fields,
+                        "date": message_date,
+                    },
+                    ensure_ascii=False
+                )
+            )
+        # Separate item files are older than the saved fields now
+        for name in fields:
+            Path(os.path.join(request_dir, f"{name}.json")).unlink(missing_ok=True)
+
     async def read_request(self, chat_id: str, show_affilate=False):
         # Reads request items from a folder and returns it
         request_items = {}
+        saved_fields = {}
         request_path = self.file_path(chat_id)
         Path(request_path).mkdir(parents=True, exist_ok=True)
         self.logger.info(f"Reading request from: {request_path}")
@@ -332,8 +382,11 @@ class FileService:
                         request_items["comment"] = message["text"]
                     elif message["type"] == "name":
                         request_items["name"] = message["text"]
+                    elif message["type"] == "fields":
+                        saved_fields = message["fields"]
             except Exception as e:
                 self.logger.error(f"Error reading request file {item}: {e}")
                 # Remove problematic file
                 os.remove(full_path)
-        return request_items
+        # Item files are written only after fields.json, so they are newer
+        return {**saved_fields, **request_items}
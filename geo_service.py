@@ -0,0 +1,389 @@
+import os
+import sys
+import json
+import time
+import logging
+
+import numpy as np
+
+from scipy.spatial import cKDTree
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Free visit / paid visit radiuses (km) from the affilate boundary
+ZONE_THRESHOLDS = {"Москва": (50, 100)}
+DEFAULT_ZONE_THRESHOLDS = (40, 90)
+
+ZONE_FREE = "free"
+ZONE_PAID = "paid"
+ZONE_OUT = "out"
+
+# Zone table tile codes, tiles missing from the table are out of area
+TILE_FREE = 0
+TILE_PAID = 1
+TILE_EXACT = 2
+TILE_SIZE = 0.04
+
+# Binary boundaries file: magic, header length, JSON header, float64 (lat, lon) pairs
+BOUNDARIES_MAGIC = b"AFB1"
+BOUNDARIES_ALIGN = 16
+
+
+def to_unit_vectors(latitudes, longitudes):
+    # Converts degrees to points on the unit sphere for the spatial index
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack(
+        (cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat))
+    )
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    # Vectorized great-circle distance in kilometers
+    lat1, lon1, lat2, lon2 = (
+        np.radians(np.asarray(value, dtype=np.float64))
+        for value in (lat1, lon1, lat2, lon2)
+    )
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def zone_thresholds(affilate):
+    return ZONE_THRESHOLDS.get(affilate, DEFAULT_ZONE_THRESHOLDS)
+
+
+def zone_class(affilate, distance):
+    # Service zone class by distance to the nearest affilate boundary
+    free, paid = zone_thresholds(affilate)
+    if affilate is None or distance > paid:
+        return ZONE_OUT
+    elif distance > free:
+        return ZONE_PAID
+    return ZONE_FREE
+
+
+def tile_keys(latitudes, longitudes, tile_size=TILE_SIZE):
+    # Integer keys of the lat/lon grid tiles containing the points
+    lat_index = np.floor(np.asarray(latitudes) / tile_size).astype(np.int64)
+    lon_index = np.floor(np.asarray(longitudes) / tile_size).astype(np.int64)
+    return (lat_index + (1 << 15)) << 17 | (lon_index + (1 << 16))
+
+
+def convert_boundaries(coordinates_path, boundaries_path):
+    # Writes affilate boundaries from JSON into the memory-mappable binary format
+    with open(coordinates_path, "r", encoding="utf-8") as f:
+        affilates = json.load(f)["affilates"]
+
+    index = []
+    offset = 0
+    for affilate, boundaries in affilates.items():
+        index.append(
+            {"name": affilate, "offset": offset, "length": len(boundaries)}
+        )
+        offset += len(boundaries)
+    header = json.dumps(
+        {"dtype": "<f8", "count": offset, "affilates": index},
+        ensure_ascii=False
+    ).encode("utf-8")
+    data_offset = len(BOUNDARIES_MAGIC) + 4 + len(header)
+    padding = -data_offset % BOUNDARIES_ALIGN
+
+    temp_path = f"{boundaries_path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(BOUNDARIES_MAGIC)
+        f.write(len(header).to_bytes(4, "little"))
+        f.write(header)
+        f.write(b"\0" * padding)
+        for boundaries in affilates.values():
+            f.write(np.asarray(boundaries, dtype="<f8").tobytes())
+    os.replace(temp_path, boundaries_path)
+
+
+def read_boundaries(boundaries_path):
+    # Maps the binary boundaries read-only, pages are shared by all workers
+    with open(boundaries_path, "rb") as f:
+        if f.read(len(BOUNDARIES_MAGIC)) != BOUNDARIES_MAGIC:
+            raise ValueError(f"{boundaries_path} is not a boundaries file")
+        header_length = int.from_bytes(f.read(4), "little")
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    data_offset = len(BOUNDARIES_MAGIC) + 4 + header_length
+    data_offset += -data_offset % BOUNDARIES_ALIGN
+    points = np.memmap(
+        boundaries_path,
+        dtype=header["dtype"],
+        mode="r",
+        offset=data_offset,
+        shape=(header["count"], 2)
+    )
+    return header["affilates"], points
+
+
+class GeoService:
+    def __init__(
+        self,
+        coordinates_path,
+        boundaries_path,
+        zones_path,
+        logger,
+        reload_interval=30
+    ):
+        self.logger = logger
+        self.coordinates_path = coordinates_path
+        self.boundaries_path = boundaries_path
+        self.zones_path = zones_path
+        self.reload_interval = reload_interval
+        self.zones = {}
+        self.load()
+
+    def load(self):
+        # Loading boundaries and the zone table, regenerating outdated files from JSON
+        self.coordinates_mtime = os.path.getmtime(self.coordinates_path)
+        self.checked_at = time.monotonic()
+        try:
+            outdated = os.path.getmtime(self.boundaries_path) < self.coordinates_mtime
+        except OSError:
+            outdated = True
+        if outdated:
+            self.logger.info(f"Converting {self.coordinates_path} to {self.boundaries_path}")
+            convert_boundaries(self.coordinates_path, self.boundaries_path)
+        self.build_index(*read_boundaries(self.boundaries_path))
+
+        if self.zones_path is None:
+            return
+        try:
+            if os.path.getmtime(self.zones_path) >= self.coordinates_mtime:
+                self.load_zones()
+                return
+        except Exception as e:
+            self.logger.warning(f"Zone table is not available: {e}")
+        self.build_zones()
+        try:
+            self.save_zones()
+        except Exception as e:
+            self.logger.error(f"Error in saving zone table: {e}")
+
+    def check_reload(self):
+        # Hot reloading after the coordinates file has been changed
+        if time.monotonic() - self.checked_at < self.reload_interval:
+            return
+        self.checked_at = time.monotonic()
+        try:
+            if os.path.getmtime(self.coordinates_path) != self.coordinates_mtime:
+                self.logger.info("Affilate coordinates changed, reloading")
+                self.load()
+        except Exception as e:
+            self.logger.error(f"Error in reloading affilate coordinates: {e}")
+
+    def build_index(self, affilates, points):
+        # KD-tree index over the memory-mapped boundary vertices
+        self.names = [affilate["name"] for affilate in affilates]
+        self.owners = np.repeat(
+            np.arange(len(affilates), dtype=np.int32),
+            [affilate["length"] for affilate in affilates]
+        )
+        self.points = points
+        self.tree = cKDTree(
+            to_unit_vectors(self.points[:, 0], self.points[:, 1])
+        )
+        self.logger.info(
+            f"Geo index built for {len(self.names)} affilates and {len(self.points)} vertices"
+        )
+
+    def build_zones(self):
+        # Rasterizing boundaries and zone rings into a tile lookup table
+        max_radius = max(
+            [DEFAULT_ZONE_THRESHOLDS[1]]
+            + [paid for _, paid in ZONE_THRESHOLDS.values()]
+        )
+        lat_tiles = []
+        lon_tiles = []
+        for index in range(len(self.names)):
+            points = self.points[self.owners == index]
+            lat_margin = max_radius / 111 + TILE_SIZE
+            lat_min = points[:, 0].min() - lat_margin
+            lat_max = points[:, 0].max() + lat_margin
+            lon_margin = lat_margin / np.cos(
+                np.radians(max(abs(lat_min), abs(lat_max)))
+            )
+            lat_range = np.arange(
+                np.floor(lat_min / TILE_SIZE),
+                np.ceil(lat_max / TILE_SIZE) + 1
+            )
+            lon_range = np.arange(
+                np.floor((points[:, 1].min() - lon_margin) / TILE_SIZE),
+                np.ceil((points[:, 1].max() + lon_margin) / TILE_SIZE) + 1
+            )
+            lat_grid, lon_grid = np.meshgrid(lat_range, lon_range)
+            lat_tiles.append(lat_grid.ravel())
+            lon_tiles.append(lon_grid.ravel())
+
+        tiles = np.unique(
+            np.column_stack(
+                (np.concatenate(lat_tiles), np.concatenate(lon_tiles))
+            ),
+            axis=0
+        )
+        latitudes = (tiles[:, 0] + 0.5) * TILE_SIZE
+        longitudes = (tiles[:, 1] + 0.5) * TILE_SIZE
+        distances, owners = self.nearest_batch(latitudes, longitudes)
+
+        # Distance to a point set changes no faster than the offset from the tile center
+        radiuses = haversine(
+            latitudes,
+            longitudes,
+            latitudes + TILE_SIZE / 2,
+            longitudes + TILE_SIZE / 2
+        )
+        thresholds = np.array(
+            [zone_thresholds(name) for name in self.names],
+            dtype=np.float64
+        )[owners]
+        codes = np.where(
+            distances <= thresholds[:, 0],
+            TILE_FREE,
+            np.where(distances <= thresholds[:, 1], TILE_PAID, -1)
+        )
+        straddling = (
+            np.abs(distances[:, None] - thresholds) <= radiuses[:, None]
+        ).any(axis=1)
+
+        # Tiles where another affilate may be the nearest one inside the tile
+        centers = to_unit_vectors(latitudes, longitudes)
+        for index in range(len(self.names)):
+            others = owners != index
+            if not others.any():
+                continue
+            points = self.points[self.owners == index]
+            _, vertices = cKDTree(
+                to_unit_vectors(points[:, 0], points[:, 1])
+            ).query(centers[others])
+            other_distances = haversine(
+                latitudes[others],
+                longitudes[others],
+                points[vertices, 0],
+                points[vertices, 1]
+            )
+            straddling[others] |= (
+                other_distances - distances[others] <= 2 * radiuses[others]
+            )
+        codes[straddling] = TILE_EXACT
+
+        kept = codes >= 0
+        keys = tile_keys(latitudes[kept], longitudes[kept])
+        self.zone_arrays = {
+            "keys": keys,
+            "codes": codes[kept].astype(np.uint8),
+            "owners": owners[kept].astype(np.int16),
+        }
+        self.zones = dict(
+            zip(
+                keys.tolist(),
+                zip(codes[kept].tolist(), owners[kept].tolist())
+            )
+        )
+        self.logger.info(
+            f"Zone table built with {len(self.zones)} tiles, {int(straddling.sum())} of them exact"
+        )
+
+    def save_zones(self):
+        # Atomic replace, other workers may be reading the table
+        temp_path = f"{self.zones_path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            np.savez(
+                f,
+                names=np.array(self.names),
+                tile_size=np.array(TILE_SIZE),
+                **self.zone_arrays
+            )
+        os.replace(temp_path, self.zones_path)
+
+    def load_zones(self):
+        with np.load(self.zones_path) as data:
+            if (
+                data["names"].tolist() != self.names
+                or float(data["tile_size"]) != TILE_SIZE
+            ):
+                raise ValueError("zone table doesn't match coordinates")
+            self.zone_arrays = {
+                key: data[key] for key in ("keys", "codes", "owners")
+            }
+        self.zones = dict(
+            zip(
+                self.zone_arrays["keys"].tolist(),
+                zip(
+                    self.zone_arrays["codes"].tolist(),
+                    self.zone_arrays["owners"].tolist()
+                )
+            )
+        )
+        self.logger.info(f"Zone table loaded with {len(self.zones)} tiles")
+
+    def nearest_batch(self, latitudes, longitudes):
+        # Returns distances (km) and affilate indexes of the nearest boundary vertices
+        latitudes = np.atleast_1d(np.asarray(latitudes, dtype=np.float64))
+        longitudes = np.atleast_1d(np.asarray(longitudes, dtype=np.float64))
+        _, vertices = self.tree.query(to_unit_vectors(latitudes, longitudes))
+        distances = haversine(
+            latitudes,
+            longitudes,
+            self.points[vertices, 0],
+            self.points[vertices, 1]
+        )
+        return distances, self.owners[vertices]
+
+    def nearest(self, latitude, longitude):
+        # Returns distance (km) to the nearest affilate and its name
+        distances, owners = self.nearest_batch(latitude, longitude)
+        return float(distances[0]), self.names[owners[0]]
+
+    def classify_batch(self, latitudes, longitudes):
+        # Exact zone classes, affilates and distances for many points in one pass
+        self.check_reload()
+        distances, owners = self.nearest_batch(latitudes, longitudes)
+        results = []
+        for distance, owner in zip(distances.tolist(), owners.tolist()):
+            affilate = self.names[owner]
+            results.append((zone_class(affilate, distance), affilate, distance))
+        return results
+
+    def classify(self, latitude, longitude):
+        # Returns zone class and nearest affilate, exact only for border tiles
+        self.check_reload()
+        if self.zones_path is not None:
+            key = int(tile_keys(latitude, longitude))
+            tile = self.zones.get(key)
+            if tile is None:
+                return ZONE_OUT, None
+            code, owner = tile
+            if code == TILE_FREE:
+                return ZONE_FREE, self.names[owner]
+            elif code == TILE_PAID:
+                return ZONE_PAID, self.names[owner]
+        distance, affilate = self.nearest(latitude, longitude)
+        return zone_class(affilate, distance), affilate
+
+
+if __name__ == "__main__":
+    # Offline build: python geo_service.py convert|build-zones
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 2 or sys.argv[1] not in ("convert", "build-zones"):
+        sys.exit("Usage: python geo_service.py convert|build-zones")
+    coordinates_path = "./data/affilates_coordinates.json"
+    boundaries_path = "./data/affilates_coordinates.bin"
+    if sys.argv[1] == "convert":
+        convert_boundaries(coordinates_path, boundaries_path)
+    else:
+        geo_service = GeoService(
+            coordinates_path,
+            boundaries_path,
+            None,
+            logging.getLogger(__name__)
+        )
+        geo_service.zones_path = "./data/affilates_zones.npz"
+        geo_service.build_zones()
+        geo_service.save_zones()
@@ -0,0 +1,143 @@
+import re
+import json
+import time
+import asyncio
+import sqlite3
+import threading
+
+from collections import OrderedDict
+
+
+class GeocodeCache:
+    def __init__(self, db_path, logger, ttl=30*24*60*60, maxsize=2048, prune_every=200):
+        self.logger = logger
+        self.db_path = db_path
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.prune_every = prune_every
+        self.writes = 0
+        self.memory = OrderedDict()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self.conn = None
+        # Disk reads and writes run in threads, the shared connection is used by one at a time
+        self.lock = threading.Lock()
+
+    def connection(self):
+        # One WAL connection per worker, the database file is shared by all of them
+        if self.conn is None:
+            self.conn = sqlite3.connect(
+                self.db_path,
+                timeout=5,
+                check_same_thread=False
+            )
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS geocode_cache (
+                    provider TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    PRIMARY KEY (provider, kind, key)
+                )
+            """)
+            self.conn.execute("""
+                CREATE INDEX IF NOT EXISTS geocode_cache_created
+                ON geocode_cache (created)
+            """)
+            self.conn.commit()
+        return self.conn
+
+    @staticmethod
+    def address_key(address):
+        return re.sub(r"\s+", " ", str(address)).strip(" ,").lower()
+
+    @staticmethod
+    def coordinates_key(latitude, longitude):
+        # About 10 m precision
+        return f"{float(latitude):.4f},{float(longitude):.4f}"
+
+    def read(self, cache_key):
+        with self.lock:
+            return self.connection().execute(
+                """
+                    SELECT value, created FROM geocode_cache
+                    WHERE provider = ? AND kind = ? AND key = ?
+                """,
+                cache_key
+            ).fetchone()
+
+    def write(self, cache_key, value, created, prune):
+        with self.lock:
+            conn = self.connection()
+            conn.execute(
+                """
+                    INSERT OR REPLACE INTO geocode_cache
+                    (provider, kind, key, value, created)
+                    VALUES (?, ?, ?, ?, ?)
+                """,
+                cache_key + (value, created)
+            )
+            if prune:
+                conn.execute(
+                    "DELETE FROM geocode_cache WHERE created < ?",
+                    (created - self.ttl,)
+                )
+            conn.commit()
+
+    async def get(self, provider, kind, key):
+        cache_key = (provider, kind, key)
+        now = time.time()
+        if cache_key in self.memory:
+            created, value = self.memory[cache_key]
+            if now - created < self.ttl:
+                self.memory.move_to_end(cache_key)
+                self.counters["memory_hits"] += 1
+                return value
+            del self.memory[cache_key]
+
+        try:
+            row = await asyncio.to_thread(self.read, cache_key)
+        except Exception as e:
+            self.logger.error(f"Error in reading geocode cache: {e}")
+            row = None
+        if row and now - row[1] < self.ttl:
+            value = json.loads(row[0])
+            self.remember(cache_key, row[1], value)
+            self.counters["disk_hits"] += 1
+            return value
+
+        self.counters["misses"] += 1
+        return None
+
+    async def set(self, provider, kind, key, value):
+        cache_key = (provider, kind, key)
+        created = time.time()
+        self.remember(cache_key, created, value)
+        # Expired rows are deleted once per prune_every writes of the worker
+        self.writes += 1
+        try:
+            await asyncio.to_thread(
+                self.write,
+                cache_key,
+                json.dumps(value, ensure_ascii=False),
+                created,
+                self.writes % self.prune_every == 1
+            )
+        except Exception as e:
+            self.logger.error(f"Error in writing geocode cache: {e}")
+
+    def remember(self, cache_key, created, value):
+        self.memory[cache_key] = (created, value)
+        self.memory.move_to_end(cache_key)
+        while len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+    def stats(self):
+        total = sum(self.counters.values())
+        hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+        return {
+            **self.counters,
+            "hit_ratio": round(hits / total, 3) if total else None,
+            "memory_size": len(self.memory),
+        }
@@ -0,0 +1,189 @@
+import os
+import asyncio
+
+from geopy.geocoders import Nominatim, Yandex
+
+
+def nominatim_candidates(locations):
+    # Unique building-level addresses from Nominatim results
+    candidates = []
+    for location in locations or []:
+        if location.raw['addresstype'] == 'building' and location.raw['name'] == '':
+            if location.raw['display_name'] not in [c["address"] for c in candidates]:
+                candidates.append({
+                    "address": location.raw['display_name'],
+                    "latitude": location.latitude,
+                    "longitude": location.longitude
+                })
+    return candidates
+
+
+def yandex_candidates(locations):
+    # Unique house-level addresses from Yandex results
+    candidates = []
+    for location in locations or []:
+        if location.raw['metaDataProperty']['GeocoderMetaData']['kind'] == 'house' and location.raw['metaDataProperty']['GeocoderMetaData']['precision'] in ['number', 'exact']:
+            if location.raw['metaDataProperty']['GeocoderMetaData']['Address']['formatted'] not in [c["address"] for c in candidates]:
+                candidates.append({
+                    "address": location.raw['metaDataProperty']['GeocoderMetaData']['Address']['formatted'],
+                    "latitude": location.latitude,
+                    "longitude": location.longitude
+                })
+    return candidates
+
+
+class GeocodingClient:
+    def __init__(
+        self,
+        geocode_cache,
+        scheduler,
+        resilience,
+        logger,
+        user_agent="my_app",
+        hedge_delay=1.5,
+        nominatim_timeout=5,
+        yandex_timeout=5,
+        stub_url=""
+    ):
+        self.logger = logger
+        self.geocode_cache = geocode_cache
+        self.scheduler = scheduler
+        self.resilience = resilience
+        self.hedge_delay = hedge_delay
+        self.timeouts = {
+            "nominatim": nominatim_timeout,
+            "yandex": yandex_timeout,
+        }
+        self.counters = {
+            "nominatim_wins": 0,
+            "yandex_wins": 0,
+            "hedges": 0,
+            "failures": 0,
+        }
+
+        # Local stub server mode for offline benchmarks
+        stub_params = {}
+        if stub_url:
+            scheme, domain = stub_url.rstrip("/").split("://", 1)
+            stub_params = {"scheme": scheme, "domain": domain}
+        self.geolocators = {
+            "nominatim": Nominatim(
+                user_agent=user_agent,
+                timeout=nominatim_timeout,
+                **stub_params
+            ),
+            "yandex": Yandex(
+                api_key=os.environ.get("YANDEX_GEOCODER_KEY", ""),
+                timeout=yandex_timeout,
+                **stub_params
+            ),
+        }
+
+    def request(self, provider, kind, query):
+        # Blocking geopy call, executed in a worker thread
+        geolocator = self.geolocators[provider]
+        if kind == "forward" and provider == "nominatim":
+            locations = geolocator.geocode(query, exactly_one=False, limit=10)
+        elif kind == "forward":
+            locations = geolocator.geocode(query, exactly_one=False)
+        else:
+            locations = geolocator.reverse(query, exactly_one=False)
+
+        if provider == "nominatim":
+            return nominatim_candidates(locations)
+        return yandex_candidates(locations)
+
+    async def provider_call(self, provider, kind, query):
+        # An open breaker fails at once and the hedge goes to the other provider
+        return await self.resilience.call(
+            provider,
+            lambda: asyncio.wait_for(
+                asyncio.to_thread(self.request, provider, kind, query),
+                timeout=self.timeouts[provider] + 1
+            )
+        )
+
+    async def provider_lookup(self, provider, kind, query, key):
+        # Nominatim calls go through the shared rate-limiting scheduler
+        if provider == "nominatim":
+            candidates = await self.scheduler.run(
+                (kind, key),
+                lambda: self.provider_call(provider, kind, query)
+            )
+        else:
+            candidates = await self.provider_call(provider, kind, query)
+        if candidates:
+            await self.geocode_cache.set(provider, kind, key, candidates)
+        return candidates
+
+    async def hedged_lookup(self, kind, queries, key):
+        # Nominatim first, Yandex is raced in if Nominatim is slower than the budget
+        for provider in ("nominatim", "yandex"):
+            candidates = await self.geocode_cache.get(provider, kind, key)
+            if candidates:
+                return candidates
+
+        tasks = {
+            asyncio.create_task(
+                self.provider_lookup("nominatim", kind, queries["nominatim"], key)
+            ): "nominatim"
+        }
+        yandex_started = False
+        errors = []
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay)
+            while True:
+                for task in done:
+                    provider = tasks.pop(task)
+                    try:
+                        candidates = task.result()
+                    except Exception as e:
+                        candidates = None
+                        errors.append(f"{provider}: {e!r}")
+                        self.logger.error(
+                            f"Error in geocoding address with {provider}: {e!r}"
+                        )
+                    if candidates:
+                        self.counters[f"{provider}_wins"] += 1
+                        return candidates
+
+                # Hedge if Nominatim is still running, fallback if it failed
+                if not yandex_started:
+                    if tasks:
+                        self.counters["hedges"] += 1
+                    tasks[asyncio.create_task(
+                        self.provider_lookup("yandex", kind, queries["yandex"], key)
+                    )] = "yandex"
+                    yandex_started = True
+                if not tasks:
+                    break
+                done, _ = await asyncio.wait(
+                    tasks,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        self.counters["failures"] += 1
+        if errors:
+            raise RuntimeError("; ".join(errors))
+        return []
+
+    async def geocode(self, nominatim_query, yandex_query, key):
+        return await self.hedged_lookup(
+            "forward",
+            {"nominatim": nominatim_query, "yandex": yandex_query},
+            self.geocode_cache.address_key(key)
+        )
+
+    async def reverse(self, latitude, longitude):
+        query = f"{latitude}, {longitude}"
+        return await self.hedged_lookup(
+            "reverse",
+            {"nominatim": query, "yandex": query},
+            self.geocode_cache.coordinates_key(latitude, longitude)
+        )
+
+    def stats(self):
+        return dict(self.counters)
@@ -0,0 +1,89 @@
+import time
+import fcntl
+import asyncio
+
+
+class SchedulerOverloaded(Exception):
+    pass
+
+
+class GeocodingScheduler:
+    def __init__(self, state_path, logger, rate=1.0, max_queue=50, max_wait=10):
+        self.logger = logger
+        self.state_path = state_path
+        self.interval = 1 / rate
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_flight = {}
+        self.queued = 0
+        self.counters = {
+            "requests": 0,
+            "upstream_calls": 0,
+            "coalesced": 0,
+            "dropped": 0,
+            "queue_wait_total": 0.0,
+            "queue_wait_max": 0.0,
+        }
+
+    def reserve(self):
+        # Token bucket shared by all workers: the file keeps the next free slot
+        with open(self.state_path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            content = f.read().strip()
+            now = time.time()
+            slot = max(now, float(content) if content else 0)
+            if slot - now > self.max_wait:
+                return None
+            f.seek(0)
+            f.truncate()
+            f.write(str(slot + self.interval))
+            return slot - now
+
+    async def execute(self, factory):
+        if self.queued >= self.max_queue:
+            self.counters["dropped"] += 1
+            raise SchedulerOverloaded("geocoding queue is full")
+
+        self.queued += 1
+        start = time.monotonic()
+        try:
+            delay = await asyncio.to_thread(self.reserve)
+            if delay is None:
+                self.counters["dropped"] += 1
+                raise SchedulerOverloaded("geocoding rate limit wait is too long")
+            await asyncio.sleep(delay)
+        finally:
+            self.queued -= 1
+            wait = time.monotonic() - start
+            self.counters["queue_wait_total"] += wait
+            self.counters["queue_wait_max"] = max(
+                self.counters["queue_wait_max"],
+                wait
+            )
+
+        self.counters["upstream_calls"] += 1
+        return await factory()
+
+    async def run(self, key, factory):
+        # Identical concurrent lookups share one rate-limited upstream call
+        self.counters["requests"] += 1
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.counters["coalesced"] += 1
+        else:
+            task = asyncio.create_task(self.execute(factory))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def stats(self):
+        waited = self.counters["requests"] - self.counters["coalesced"]
+        return {
+            **self.counters,
+            "queue_wait_avg": round(
+                self.counters["queue_wait_total"] / waited, 3
+            ) if waited else None,
+            "queued": self.queued,
+            "in_flight": len(self.in_flight),
+        }
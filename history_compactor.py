@@ -0,0 +1,132 @@
+import os
+import json
+import aiofiles
+import tiktoken
+
+from pathlib import Path
+from langchain_core.messages import SystemMessage, HumanMessage
+
+
+# Anthropic tokenizer is not available locally, its counts are estimated from the OpenAI encoding
+ANTHROPIC_TOKEN_RATIO = 1.2
+SUMMARY_PROMPT = "Вы ведёте краткое содержание диалога сотрудника колл-центра сервисного центра с клиентом. Дополните текущее краткое содержание новыми сообщениями, сохранив все факты, важные для оформления и изменения заявок: причину обращения, обстоятельства, технику, имя, даты, договорённости, вопросы клиента и ответы на них. Телефоны, детали адреса и другие персональные данные НЕ включайте. Возвращайте ТОЛЬКО обновлённое краткое содержание, без пояснений."
+
+
+class HistoryCompactor:
+    def __init__(
+        self,
+        chat_data_service,
+        resilience,
+        logger,
+        oai_model,
+        token_budget=3000,
+        keep_turns=6
+    ):
+        self.logger = logger
+        self.chat_data_service = chat_data_service
+        self.resilience = resilience
+        self.token_budget = token_budget
+        # Last turns always go to the agent verbatim
+        self.keep_messages = keep_turns * 2
+        try:
+            self.encoding = tiktoken.encoding_for_model(oai_model)
+        except KeyError:
+            self.encoding = tiktoken.get_encoding("o200k_base")
+        self.counters = {
+            "turns": 0,
+            "folds": 0,
+            "folded_messages": 0,
+            "history_tokens_total": 0,
+            "sent_tokens_total": 0,
+            "errors": 0,
+        }
+
+    def count(self, company, text):
+        tokens = len(self.encoding.encode(text, disallowed_special=()))
+        if company == "OpenAI":
+            return tokens
+        return int(tokens * ANTHROPIC_TOKEN_RATIO)
+
+    def summary_path(self, chat_id):
+        return os.path.join(self.chat_data_service.file_path(chat_id), "summary.json")
+
+    async def load(self, chat_id):
+        # Summary is kept only within the dialogue since the chat history date
+        chat_dir = self.chat_data_service.file_path(chat_id)
+        async with aiofiles.open(os.path.join(chat_dir, "chat_data.json"), "r", encoding="utf-8") as f:
+            chat_history_date = json.loads(await f.read()).get("chat_history_date")
+        state = {"chat_history_date": chat_history_date, "summary": "", "last_id": 0}
+        if Path(self.summary_path(chat_id)).exists():
+            async with aiofiles.open(self.summary_path(chat_id), "r", encoding="utf-8") as f:
+                saved = json.loads(await f.read())
+            if saved.get("chat_history_date") == chat_history_date:
+                state = saved
+        return state
+
+    async def save(self, chat_id, state):
+        async with aiofiles.open(self.summary_path(chat_id), "w", encoding="utf-8") as f:
+            await f.write(json.dumps(state, ensure_ascii=False))
+
+    async def summarize(self, company, llm, summary, messages):
+        # Only the previous summary and the new messages are sent, not the whole dialogue
+        transcript = "\n".join(
+            f"{'Клиент' if message.type == 'human' else 'Сотрудник'}: {message.content}"
+            for message in messages
+        )
+        response = await self.resilience.call(
+            company,
+            lambda: llm.ainvoke([
+                SystemMessage(content=SUMMARY_PROMPT),
+                HumanMessage(
+                    content=f"Текущее краткое содержание: {summary or 'пока нет'}\n\nНовые сообщения:\n{transcript}"
+                ),
+            ])
+        )
+        return response.content
+
+    async def compact(self, chat_id, chat_history, company, llm):
+        # Summary of older turns and the messages going to the agent verbatim
+        state = await self.load(chat_id)
+        counts = {
+            id(message): self.count(company, message.content)
+            for message in chat_history
+        }
+        pending = [
+            message for message in chat_history
+            if int(message.id or 0) > state["last_id"]
+        ]
+        tokens = self.count(company, state["summary"]) + sum(
+            counts[id(message)] for message in pending
+        )
+        self.counters["turns"] += 1
+        self.counters["history_tokens_total"] += sum(counts.values())
+
+        older = pending[:max(0, len(pending) - self.keep_messages)]
+        if older and tokens > self.token_budget:
+            try:
+                state["summary"] = await self.summarize(company, llm, state["summary"], older)
+                state["last_id"] = int(older[-1].id or 0)
+                await self.save(chat_id, state)
+                self.counters["folds"] += 1
+                self.counters["folded_messages"] += len(older)
+                pending = pending[len(older):]
+                tokens = self.count(company, state["summary"]) + sum(
+                    counts[id(message)] for message in pending
+                )
+            except Exception as e:
+                self.counters["errors"] += 1
+                self.logger.error(f"Error in chat history summarization: {e}")
+        self.counters["sent_tokens_total"] += tokens
+        self.logger.info(
+            f"History for {chat_id}: {len(pending)} messages and summary, {tokens} tokens"
+        )
+        return state["summary"], pending
+
+    def stats(self):
+        history_tokens = self.counters["history_tokens_total"]
+        return {
+            **self.counters,
+            "saved_share": round(
+                1 - self.counters["sent_tokens_total"] / history_tokens, 3
+            ) if history_tokens else None,
+        }
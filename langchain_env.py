@@ -1,24 +1,34 @@
 import os
 import re
 import time
-import json
-import requests
+import asyncio
+import hashlib
+import functools
+import contextvars
 
-import phonenumbers
-
-from datetime import datetime
 from openai import AsyncOpenAI
 from anthropic import AsyncAnthropic
-from pydantic import BaseModel, Field
-from geopy.distance import geodesic
-from geopy.geocoders import Nominatim, Yandex
+from collections import OrderedDict
+from pydantic import BaseModel, Field, ValidationError
 from telebot.types import ReplyKeyboardMarkup
 
+from geo_service import ZONE_OUT, ZONE_PAID
+from order_model import national_phone
+from address_service import normalize_address
+from resilience import CircuitOpen
+from llm_router import FAILOVER_ERRORS
+from system_prompt import static_prompt
+
 from langchain_openai import ChatOpenAI
 from langchain_anthropic import ChatAnthropic
 from langchain_core.tools import StructuredTool
 from langchain_core.prompts import ChatPromptTemplate
-from langchain.agents import AgentExecutor, create_tool_calling_agent
+from langchain_core.agents import AgentFinish
+from langchain_core.messages import SystemMessage
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
+from langchain.agents import AgentExecutor
+from langchain.agents.output_parsers.tools import ToolsAgentOutputParser
+from langchain.agents.format_scratchpad.tools import format_to_tool_messages
 
 
 # Definition args schemas for tools
@@ -63,6 +73,17 @@ class save_comment_to_request_args(BaseModel):
     chat_id: int = Field(description="chat_id")
     comment: str = Field(description="comment")
 
+class save_fields_to_request_args(BaseModel):
+    chat_id: int = Field(description="chat_id")
+    name: str | None = Field(default=None, description="name")
+    direction: str | None = Field(default=None, description="direction")
+    circumstances: str | None = Field(default=None, description="circumstances")
+    brand: str | None = Field(default=None, description="brand")
+    phone: str | None = Field(default=None, description="phone")
+    date: str | None = Field(default=None, description="date")
+    comment: str | None = Field(default=None, description="comment")
+    address_line_2: str | None = Field(default=None, description="address_line_2")
+
 class create_request_args(BaseModel):
     chat_id: int = Field(description="chat_id")
     direction: str = Field(description="direction")
@@ -106,6 +127,55 @@ class ConfidentialSafeResponse(BaseModel):
     confidential_safe_answer: str
 
 
+# Tool answer when a dependency circuit breaker is open
+UNAVAILABLE_ANSWER = "Система заявок сейчас временно недоступна, НЕ используйте этот инструмент повторно. Вежливо сообщите клиенту о технических неполадках и о том, что он может связаться с нами по телефону 8 495 463 50 46"
+
+
+# Anthropic prompt caching is in beta for the pinned SDK version
+PROMPT_CACHING_BETA = "prompt-caching-2024-07-31"
+
+
+# Request items of the batched saving tool and their names in its answer
+REQUEST_FIELDS = {
+    "name": "имя клиента",
+    "direction": "направление, причина обращения",
+    "circumstances": "обстоятельства обращения",
+    "brand": "бренд / модель",
+    "phone": "телефон клиента",
+    "date": "дата посещения",
+    "comment": "комментарий",
+    "address_line_2": "вторая линия адреса клиента",
+}
+
+
+# Address words and phone numbers removed from comments after the LLM check,
+# the terms are shared with the pre-screen below
+PERSONAL_DATA_TERMS = ("подъезд", "этаж", "эт", "квартир", "кв", "домофон", "код")
+PERSONAL_DATA_PATTERN = re.compile(
+    r"([+]?[\d]?\d{3}.*?\d{3}.*?\d{2}.*?\d{2})|" + "|".join(PERSONAL_DATA_TERMS),
+    re.IGNORECASE
+)
+# Comments without digits or these terms have nothing for PERSONAL_DATA_PATTERN and skip the LLM check
+SENSITIVE_PATTERN = re.compile(
+    r"\d|" + "|".join(PERSONAL_DATA_TERMS),
+    re.IGNORECASE
+)
+PERSONAL_DATA_CACHE_SIZE = 1000
+
+
+# Agent steps after the forced tool call of an answer correction
+CORRECTION_ITERATIONS = 5
+
+
+# Status of 1C change response when the order revision is outdated
+REVISION_CONFLICT = 409
+
+
+# Validation failure of create_request pre-flight steps, the message goes to the agent
+class PreflightError(Exception):
+    pass
+
+
 # Main class
 class ChatAgent:
     def __init__(
@@ -115,19 +185,28 @@ class ChatAgent:
         oai_temperature,
         a_temperature,
         request_dir,
-        proxy_url,
+        proxy_client,
+        bid_cache,
+        order_outbox,
+        order_metadata,
+        order_builder,
         order_path,
         ws_paths,
         change_path,
         dialogue_path,
         divisions,
-        affilates,
+        geo_service,
+        geocoder,
+        address_index,
         logger,
         bot_instance,
         request_service,
         chat_data_service,
         ban_manager,
-        dialogues_api_manager
+        dialogues_api_manager,
+        resilience,
+        llm_router,
+        batched_request_fields=True
     ):
         self.logger = logger
         self.config = {
@@ -136,51 +215,107 @@ class ChatAgent:
             "oai_temperature": oai_temperature,
             "a_temperature": a_temperature,
             "request_dir": request_dir,
-            "proxy_url": proxy_url,
             "order_path": order_path,
             "ws_paths": ws_paths,
             "change_path": change_path,
             "dialogue_path": dialogue_path,
             "divisions": divisions,
-            "affilates": affilates
+            "batched_request_fields": batched_request_fields
         }
+        self.static_prompt = static_prompt(batched_request_fields)
 
         self.request_service = request_service
         self.chat_data_service = chat_data_service
         self.ban_manager = ban_manager
         self.dialogues_api_manager = dialogues_api_manager
+        self.resilience = resilience
+        self.llm_router = llm_router
+
+        # Executors of all providers are built once, the provider is chosen per run
+        self.llms = {}
+        # (company, tool names): (agent, executor)
+        self.agent_executors = {}
+        self.tool_counters = {
+            "turns": 0,
+            "bound_tools_total": 0,
+            "excluded_tools_total": 0,
+        }
 
-        self.agent_executor = None
+        # Provider clients of personal data checks are shared by all calls
+        self.openai_client = AsyncOpenAI(
+            api_key=os.environ.get("OPENAI_API_KEY", "")
+        )
+        self.anthropic_client = AsyncAnthropic(
+            api_key=os.environ.get("ANTHROPIC_API_KEY", "")
+        )
+        # comment hash: checked comment
+        self.personal_data_cache = OrderedDict()
+        self.personal_data_counters = {
+            "checks": 0,
+            "prescreened": 0,
+            "cache_hits": 0,
+            "llm_checks": 0,
+        }
+        self.current_company = contextvars.ContextVar(
+            "company",
+            default=self.llm_router.providers[0]
+        )
+        # (chat_id, request files) read by the bot for the current turn
+        self.current_draft = contextvars.ContextVar("draft", default=None)
         self.bot_instance = bot_instance
+        self.proxy_client = proxy_client
+        self.bid_cache = bid_cache
+        self.order_outbox = order_outbox
+        self.order_metadata = order_metadata
+        self.order_builder = order_builder
+        self.geo_service = geo_service
+        self.geocoder = geocoder
+        self.address_index = address_index
         self.dialogues_api_accounts = self.dialogues_api_manager.load_config()
 
-        self.token = os.environ.get("1С_TOKEN", "")
-        self.login = os.environ.get("1C_LOGIN", "")
-        self.password = os.environ.get("1C_PASSWORD", "")
+    @property
+    def company(self):
+        # Provider of the current agent run
+        return self.current_company.get()
+
+    def use_draft(self, chat_id, request):
+        # Draft read for the turn is reused by the tools instead of reading the files again
+        self.current_draft.set((str(chat_id), dict(request)))
 
-    def initialize_agent(self, company="OpenAI"):
-        # Agent initialization depending on different LLMs
-        self.company = company
-        if self.company == "OpenAI":
+    def draft(self, chat_id):
+        draft = self.current_draft.get()
+        if draft is not None and draft[0] == str(chat_id):
+            return draft[1]
+        return None
+
+    def llm(self, company):
+        if company == "OpenAI":
             llm = ChatOpenAI(
                 api_key=os.environ.get("OPENAI_API_KEY", ""),
                 model=self.config["oai_model"],
                 temperature=self.config["oai_temperature"],
-                seed = 654321
+                seed = 654321,
+                include_response_headers=True
             )
             self.logger.info(
                 f'OpenAI ChatAgent init with model: {self.config["oai_model"]} and temperature: {self.config["oai_temperature"]}'
             )
-        elif self.company == "Anthropic":
+        elif company == "Anthropic":
             llm = ChatAnthropic(
                 api_key=os.environ.get("ANTHROPIC_API_KEY", ""),
                 model=self.config["a_model"],
-                temperature=self.config["a_temperature"]
+                temperature=self.config["a_temperature"],
+                default_headers={"anthropic-beta": PROMPT_CACHING_BETA}
             )
             self.logger.info(
                 f'Anthropic ChatAgent init with model: {self.config["a_model"]} and temperature: {self.config["a_temperature"]}'
             )
+        return llm
+
+    def initialize_agent(self):
+        # Agent initialization for all LLMs of the router
         tools = []
+        field_tools = []
         # Definition args schemas for tools
 
         # Tool: activity_indication_tool
@@ -213,7 +348,7 @@ class ChatAgent:
             handle_validation_error=True,
             verbose=True,
         )
-        tools.append(save_name_tool)
+        field_tools.append(save_name_tool)
 
         # Tool: save_direction_tool
         save_direction_tool = StructuredTool.from_function(
@@ -230,7 +365,7 @@ class ChatAgent:
             handle_validation_error=True,
             verbose=True,
         )
-        tools.append(save_direction_tool)
+        field_tools.append(save_direction_tool)
 
         # Tool: save_circumstances_tool
         save_circumstances_tool = StructuredTool.from_function(
@@ -247,7 +382,7 @@ class ChatAgent:
             handle_validation_error=True,
             verbose=True,
         )
-        tools.append(save_circumstances_tool)
+        field_tools.append(save_circumstances_tool)
 
         # Tool: save_brand_tool
         save_brand_tool = StructuredTool.from_function(
@@ -263,7 +398,7 @@ class ChatAgent:
             handle_validation_error=True,
             verbose=True,
         )
-        tools.append(save_brand_tool)
+        field_tools.append(save_brand_tool)
 
         # Tool: save_gps_tool
         save_gps_tool = StructuredTool.from_function(
@@ -314,7 +449,7 @@ class ChatAgent:
             handle_validation_error=True,
             verbose=True,
         )
-        tools.append(save_address_line_2_tool)
+        field_tools.append(save_address_line_2_tool)
 
         # Tool: save_phone_tool
         save_phone_tool = StructuredTool.from_function(
@@ -330,7 +465,7 @@ class ChatAgent:
             handle_validation_error=True,
             verbose=True,
         )
-        tools.append(save_phone_tool)
+        field_tools.append(save_phone_tool)
 
         # Tool: save_date_tool
         save_date_tool = StructuredTool.from_function(
@@ -346,7 +481,7 @@ class ChatAgent:
             handle_validation_error=True,
             verbose=True,
         )
-        tools.append(save_date_tool)
+        field_tools.append(save_date_tool)
 
         # Tool: save_comment_tool
         save_comment_tool = StructuredTool.from_function(
@@ -362,7 +497,27 @@ class ChatAgent:
             handle_validation_error=True,
             verbose=True,
         )
-        tools.append(save_comment_tool)
+        field_tools.append(save_comment_tool)
+
+        # Tool: save_fields_tool
+        save_fields_tool = StructuredTool.from_function(
+            coroutine=self.save_fields_to_request,
+            name="Saving_request_fields",
+            description="""
+                Сохраняет в новую заявку сразу все полученные в сообщении данные одним вызовом, заменяет инструменты Saving_name, Saving_direction, Saving_circumstances, Saving_brand, Saving_phone_number, Saving_visit_date, Saving_comment и Saving_address_line_2.
+Передавайте chat_id и ТОЛЬКО те из параметров, которые были получены или обновились: name - имя клиента, если выглядит как настоящее человеческое; direction - подходящее направление ТОЛЬКО из вашего списка; circumstances - обстоятельства обращения; brand - бренд / модель, ТОЛЬКО если речь о технике; phone - телефон; date - дата визита в формате 'yyyy-mm-ddT00:00Z'; comment - полезная информация своими словами, НИКОГДА не детали адреса и не телефоны; address_line_2 - квартира, подъезд, этаж, домофон.
+            """,
+            args_schema=save_fields_to_request_args,
+            return_direct=False,
+            handle_tool_error=True,
+            handle_validation_error=True,
+            verbose=True,
+        )
+        # One batched tool or separate tools for every field, switched in config
+        if self.config["batched_request_fields"]:
+            tools.append(save_fields_tool)
+        else:
+            tools.extend(field_tools)
 
         # Tool: create_request_tool
         create_request_tool = StructuredTool.from_function(
@@ -384,7 +539,7 @@ class ChatAgent:
 
         # Tool: request_selection_tool
         request_selection_tool = StructuredTool.from_function(
-            coroutine=self.request_selection,
+            coroutine=self.guarded(self.request_selection, "1c"),
             name="Request_selection",
             description="""
                 Находит и ОДНОКРАТНО предоставляет клиенту список его ОФОРМЛЕННЫХ заявок для выбора, чтобы определить контекст всего диалога, если речь идёт уже о каких-либо созданных заявках, а НЕ об оформлении новой, и ТОЛЬКО если клиент уже НЕ указал номер заявки ранее.
@@ -402,7 +557,7 @@ class ChatAgent:
 
         # Tool: change_request_tool
         change_request_tool = StructuredTool.from_function(
-            coroutine=self.change_request,
+            coroutine=self.guarded(self.change_request, "1c"),
             name="Change_request",
             description="""
                 Изменяет нужные данные / значения полей в уже СУЩЕСТВУЮЩЕЙ заявке. Допустимо обрабатывать ТОЛЬКО ТЕЛЕФОН или ЛЮБУЮ ДОПОЛНИТЕЛЬНУЮ ИНФОРМАЦИЮ КАК КОММЕНТАРИЙ. Для редактирования уже имеющихся СОЗДАННЫХ заявок используйте ТОЛЬКО ЭТОТ инструмент, а НЕ обычные с добавлением информации в новую!
@@ -418,7 +573,7 @@ class ChatAgent:
 
         # Tool: call_operator_tool
         call_operator_tool = StructuredTool.from_function(
-            coroutine=self.call_operator,
+            coroutine=self.guarded(self.call_operator, "1c"),
             name="Call_operator",
             description="""
                 Вызывает в чат оператора колл-центра и переводит на него диалог в следующих случаях:
@@ -440,45 +595,221 @@ class ChatAgent:
 
         prompt = ChatPromptTemplate.from_messages(
             [
-                ("system", "{system_prompt}"),
+                ("placeholder", "{system}"),
                 ("placeholder", "{chat_history}"),
                 ("human", "{input}"),
                 ("placeholder", "{agent_scratchpad}"),
             ]
         )
-        agent = create_tool_calling_agent(llm, tools, prompt)
-        self.agent_executor = AgentExecutor(
-            agent=agent,
-            tools=tools,
-            verbose=True,
-            handle_parsing_errors=True,
-            early_stopping_method="generate",
-            max_iterations=20,
-            return_intermediate_steps=True
-        )
+        self.prompt = prompt
+        self.tools = {tool.name: tool for tool in tools}
+        for company in self.llm_router.providers:
+            self.llms[company] = self.llm(company)
+            self.executor(company, tuple(self.tools))
+
+    def executor(self, company, tool_names):
+        # Agent and executor bound to a tool subset, built once per provider and subset
+        key = (company, tool_names)
+        if key not in self.agent_executors:
+            tools = [self.tools[name] for name in tool_names]
+            # Same chain as create_tool_calling_agent with the breaker around the model call only
+            agent = (
+                RunnablePassthrough.assign(
+                    agent_scratchpad=lambda x: format_to_tool_messages(x["intermediate_steps"])
+                )
+                | self.prompt
+                | self.model_call(company, self.llms[company].bind_tools(tools))
+                | ToolsAgentOutputParser()
+            )
+            self.agent_executors[key] = (
+                agent,
+                AgentExecutor(
+                    agent=agent,
+                    tools=tools,
+                    verbose=True,
+                    handle_parsing_errors=True,
+                    early_stopping_method="generate",
+                    max_iterations=20,
+                    return_intermediate_steps=True
+                )
+            )
+        return self.agent_executors[key]
+
+    def model_call(self, company, llm):
+        # Provider breaker covers LLM calls, tool latency and errors stay with their own dependencies
+        async def call(messages, config):
+            return await self.resilience.call(
+                company,
+                lambda: llm.ainvoke(messages, config),
+                0
+            )
+        return RunnableLambda(call)
+
+    def select_tools(self, chat_id, request):
+        # Tools for the state of the draft: no creation without any saved field,
+        # no changes of existing requests only for a customer known to have no bids.
+        # Any other subset changes the cached tools prefix, so the list stays full and in order
+        excluded = set()
+        if not request:
+            excluded.add("Create_request")
+        elif self.bid_cache.peek(chat_id) is False:
+            excluded.update(("Request_selection", "Change_request"))
+        tool_names = tuple(name for name in self.tools if name not in excluded)
+        self.tool_counters["turns"] += 1
+        self.tool_counters["bound_tools_total"] += len(tool_names)
+        self.tool_counters["excluded_tools_total"] += len(excluded)
+        return tool_names
+
+    def guarded(self, coroutine, dependency):
+        # Tools of an unavailable dependency answer at once instead of waiting for timeouts
+        @functools.wraps(coroutine)
+        async def wrapper(*args, **kwargs):
+            if self.resilience.is_open(dependency):
+                return UNAVAILABLE_ANSWER
+            try:
+                return await coroutine(*args, **kwargs)
+            except CircuitOpen:
+                return UNAVAILABLE_ANSWER
+        return wrapper
+
+    def system_messages(self, company, system_prompt):
+        # Static prefix goes first, Anthropic caches tools and the prefix up to the breakpoint,
+        # OpenAI caches the longest identical prefix automatically
+        if company == "Anthropic":
+            return [SystemMessage(content=[
+                {
+                    "type": "text",
+                    "text": self.static_prompt,
+                    "cache_control": {"type": "ephemeral"},
+                },
+                {"type": "text", "text": system_prompt},
+            ])]
+        return [SystemMessage(content=f"{self.static_prompt}\n{system_prompt}")]
+
+    async def run_agent(self, prepare, tool_names=None):
+        # Provider is chosen by the router, the run goes to the next healthy one
+        # after rate limits and outages, the second try is in the bot.
+        # prepare(company) returns the inputs of the run for the provider serving it
+        tool_names = tool_names or tuple(self.tools)
+        candidates = self.llm_router.candidates()
+        for index, company in enumerate(candidates):
+            token = self.current_company.set(company)
+            callback = self.llm_router.callback(company)
+            start = time.monotonic()
+            try:
+                inputs = await prepare(company)
+                response = await self.executor(company, tool_names)[1].ainvoke(
+                    {
+                        **inputs,
+                        "system": self.system_messages(company, inputs["system_prompt"]),
+                    },
+                    config={"callbacks": [callback]}
+                )
+                self.logger.info(
+                    f"Turn of {company} in {time.monotonic() - start:.2f} s, "
+                    f"prompt tokens: {callback.tokens}, tools: {len(tool_names)}"
+                )
+                return {
+                    **response,
+                    "company": company,
+                    "tool_names": tool_names,
+                    "inputs": inputs,
+                }
+            except FAILOVER_ERRORS as e:
+                self.llm_router.failed(company, e)
+                if index == len(candidates) - 1:
+                    raise
+            finally:
+                self.current_company.reset(token)
+
+    async def run_tool(self, action):
+        try:
+            return await self.tools[action.tool].ainvoke(action.tool_input)
+        except Exception as e:
+            self.logger.error(f"Error in tool {action.tool}: {e}")
+            return f"Ошибка при использовании инструмента {action.tool}: {e}"
+
+    async def correct(self, response, tool_name):
+        # The provider of the answer is forced to call the missing tool on top of the
+        # scratchpad of the run, then the agent continues from these steps
+        company = response["company"]
+        inputs = response["inputs"]
+        steps = list(response["intermediate_steps"])
+        tool_names = response["tool_names"]
+        if tool_name not in tool_names:
+            tool_names = (*tool_names, tool_name)
+        agent = self.executor(company, tool_names)[0]
+        inputs = {
+            **inputs,
+            "system": self.system_messages(company, inputs["system_prompt"]),
+        }
+        config = {"callbacks": [self.llm_router.callback(company)]}
+        token = self.current_company.set(company)
+        try:
+            forced = self.prompt | self.model_call(
+                company,
+                self.llms[company].bind_tools(
+                    [self.tools[tool_name]],
+                    tool_choice=tool_name
+                )
+            ) | ToolsAgentOutputParser()
+            actions = await forced.ainvoke(
+                {**inputs, "agent_scratchpad": format_to_tool_messages(steps)},
+                config
+            )
+            for _ in range(CORRECTION_ITERATIONS):
+                if isinstance(actions, AgentFinish):
+                    return {
+                        **response,
+                        "output": actions.return_values["output"],
+                        "intermediate_steps": steps,
+                    }
+                for action in actions:
+                    steps.append((action, await self.run_tool(action)))
+                actions = await agent.ainvoke(
+                    {**inputs, "intermediate_steps": steps},
+                    config
+                )
+            raise RuntimeError(f"Correction by {tool_name} is not finished in {CORRECTION_ITERATIONS} steps")
+        finally:
+            self.current_company.reset(token)
+
+    def stats(self):
+        turns = self.tool_counters["turns"]
+        checks = self.personal_data_counters["checks"]
+        return {
+            "tools": {
+                **self.tool_counters,
+                "bound_tools_avg": round(
+                    self.tool_counters["bound_tools_total"] / turns, 2
+                ) if turns else None,
+                "executors": len(self.agent_executors),
+            },
+            "personal_data": {
+                **self.personal_data_counters,
+                "llm_avoided_share": round(
+                    1 - self.personal_data_counters["llm_checks"] / checks, 3
+                ) if checks else None,
+            },
+        }
 
-    def distance_calculation(self, latitude, longitude, affilate_coordinates):
-        distance = float('inf')
-        affilate = None
-
-        for aff, boundaries in affilate_coordinates:
-            if abs(latitude - boundaries[0][0]) < 7 and abs(longitude - boundaries[0][1]) < 3:
-                for coordinates in boundaries:
-                    current_distance = geodesic(
-                        [latitude, longitude],
-                        coordinates
-                    ).kilometers
-                    if current_distance < distance:
-                        distance = current_distance
-                        affilate = aff
-        return distance, affilate
-    
     async def check_personal_data(self, comment):
+        counters = self.personal_data_counters
+        counters["checks"] += 1
+        # Without digits and address / contact words there is nothing to remove
+        if not SENSITIVE_PATTERN.search(comment):
+            counters["prescreened"] += 1
+            return comment
+        key = hashlib.sha256(comment.encode()).hexdigest()
+        if key in self.personal_data_cache:
+            counters["cache_hits"] += 1
+            self.personal_data_cache.move_to_end(key)
+            return self.personal_data_cache[key]
+
         try:
+            counters["llm_checks"] += 1
             if self.company == "OpenAI":
-                client = AsyncOpenAI(
-                    api_key=os.environ.get("OPENAI_API_KEY", "")
-                )
+                client = self.openai_client
                 temperature = 0
                 seed = 654321
                 messages = [
@@ -496,53 +827,60 @@ class ChatAgent:
                     },
                     {"role": "user", "content": comment}
                 ]
-                response = await client.beta.chat.completions.parse(
-                    model="gpt-4o-mini-2024-07-18",
-                    temperature=temperature,
-                    seed=seed,
-                    response_format=ConfidentialSafeResponse,
-                    messages=messages
+                response = await self.resilience.call(
+                    "OpenAI",
+                    lambda: client.beta.chat.completions.parse(
+                        model="gpt-4o-mini-2024-07-18",
+                        temperature=temperature,
+                        seed=seed,
+                        response_format=ConfidentialSafeResponse,
+                        messages=messages
+                    )
                 )
                 comment = response.choices[0].message
                 if comment.parsed:
                     comment = comment.parsed.confidential_safe_answer
                 else:
-                    response = await client.chat.completions.create(
-                        model="gpt-4o-2024-05-13",
-                        temperature=temperature,
-                        seed=seed,
-                        messages=messages
+                    response = await self.resilience.call(
+                        "OpenAI",
+                        lambda: client.chat.completions.create(
+                            model="gpt-4o-2024-05-13",
+                            temperature=temperature,
+                            seed=seed,
+                            messages=messages
+                        )
                     )
                     comment = response.choices[0].message.content
 
             elif self.company == "Anthropic":
-                client = AsyncAnthropic(
-                    api_key=os.environ.get("ANTHROPIC_API_KEY", "")
-                )
-                response = await client.messages.create(
-                    model=self.config["a_model"],
-                    temperature=0,
-                    max_tokens=1024,
-                    system="Вы - сотрудник по сохранности конфиденциальных данных. В передаваемом вами тексте никогда не должно быть никакой следующей информации: любых номеров телефонов; значений подъезда, этажа, квартиры, домофона. Возвращайте в ответе ТОЛЬКО полученный текст с УБРАННОЙ всей перечисленной выше информацией, НИ В КОЕМ СЛУЧАЕ НЕ ваш ответ с размышлениями. Если текст изначально пустой, также возвращайте пустую строку - ''.",
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": "проход под аркой домофон 45к7809в, этаж 10, квартира 45, подъезд 3, дополнительный телефон 89760932378",
-                        },
-                        {
-                            "role": "assistant",
-                            "content": "проход под аркой домофон, этаж, квартира, подъезд, дополнительный телефон",
-                        },
-                        {"role": "user", "content": comment},
-                    ]
+                client = self.anthropic_client
+                response = await self.resilience.call(
+                    "Anthropic",
+                    lambda: client.messages.create(
+                        model=self.config["a_model"],
+                        temperature=0,
+                        max_tokens=1024,
+                        system="Вы - сотрудник по сохранности конфиденциальных данных. В передаваемом вами тексте никогда не должно быть никакой следующей информации: любых номеров телефонов; значений подъезда, этажа, квартиры, домофона. Возвращайте в ответе ТОЛЬКО полученный текст с УБРАННОЙ всей перечисленной выше информацией, НИ В КОЕМ СЛУЧАЕ НЕ ваш ответ с размышлениями. Если текст изначально пустой, также возвращайте пустую строку - ''.",
+                        messages=[
+                            {
+                                "role": "user",
+                                "content": "проход под аркой домофон 45к7809в, этаж 10, квартира 45, подъезд 3, дополнительный телефон 89760932378",
+                            },
+                            {
+                                "role": "assistant",
+                                "content": "проход под аркой домофон, этаж, квартира, подъезд, дополнительный телефон",
+                            },
+                            {"role": "user", "content": comment},
+                        ]
+                    )
                 )
                 comment = response.content[0].text
 
-            pattern = re.compile(
-                r"([+]?[\d]?\d{3}.*?\d{3}.*?\d{2}.*?\d{2})|подъезд|этаж|эт|квартир|кв|домофон|код",
-                re.IGNORECASE
-            )
-            comment = re.sub(pattern, '', comment)
+            checked = re.sub(PERSONAL_DATA_PATTERN, '', comment)
+            self.personal_data_cache[key] = checked
+            if len(self.personal_data_cache) > PERSONAL_DATA_CACHE_SIZE:
+                self.personal_data_cache.popitem(last=False)
+            comment = checked
         except Exception as e:
             self.logger.error(f"Error in checking personal data: {e}")
         return comment
@@ -598,97 +936,75 @@ class ChatAgent:
         self.logger.info("Brand was saved in the request")
         return "Бренд / модель были сохранены в заявку"
 
+    async def save_fields_to_request(self, chat_id, **fields):
+        self.logger.info(f"save_fields_to_request fields: {fields}")
+        fields = {
+            name: value for name, value in fields.items()
+            if value is not None and value != ""
+        }
+        answers = []
+        if "direction" in fields and fields["direction"] not in self.config["divisions"].values():
+            fields.pop("direction")
+            answers.append("Выбрано некорректное направление обращения, определите сами повторно подходящее именно из вашего списка")
+        if "phone" in fields:
+            phone = national_phone(fields["phone"])
+            if phone is None:
+                fields.pop("phone")
+                answers.append("Клиент предоставил некорректный номер телефона, ОБЯЗАТЕЛЬНО донесите это до клиента и запросите телефон ещё раз")
+            else:
+                fields["phone"] = phone
+        if not fields:
+            return ". ".join(answers) or "Не было передано данных для сохранения в заявку"
+
+        try:
+            await self.request_service.save_request_fields(chat_id, fields)
+        except Exception as e:
+            self.logger.error(f"Error in saving request fields: {e}")
+            return f"Ошибка при сохранении данных заявки: {e}"
+        self.logger.info(f"Request fields {list(fields)} were saved in the request")
+        saved = ", ".join(REQUEST_FIELDS[name] for name in fields)
+        return ". ".join([f"В заявку было сохранено: {saved}", *answers])
+
+    async def suggest_addresses(self, chat_id, candidates):
+        # Showing several matched addresses for the customer to choose from
+        markup = ReplyKeyboardMarkup(
+            one_time_keyboard=True
+        )
+        text = "Секунду..."
+        for candidate in candidates:
+            markup.add(candidate["address"])
+        markup.add("🏠 Вернуться в меню")
+        await self.bot_instance.send_message(
+            chat_id,
+            text,
+            reply_markup=markup
+        )
+        return "Не удалось однозначно определить адрес. ОБЯЗАТЕЛЬНО ПРЕДЛОЖИТЕ клиенту ВЫБРАТЬ из нескольких подходящих адресов, автоматически уже отображенных в диалоге, либо самостоятельно ещё раз прислать корректный адрес. Предлагайте и то, и то сразу, первое обязательно! Сами никакие конкретные варианты адресов НЕ предлагайте и НЕ упоминайте"
+
     async def save_gps_to_request(self, chat_id, latitude, longitude):
         self.logger.info(
             f"save_gps_to_request latitude: {latitude} longitude: {longitude}"
         )
         try:
-            distance, affilate = self.distance_calculation(
+            zone, affilate = self.geo_service.classify(
                 latitude,
-                longitude,
-                self.config["affilates"].items()
+                longitude
             )
-            if (
-                affilate == "Москва" and distance > 100
-            ) or (
-                affilate != "Москва" and distance > 90
-            ):
+            if zone == ZONE_OUT:
                 return "Указанный клиентом адрес находится вне зоны работы компании. Вежливо донесите это до клиента и прекратите далее оформлять заявку!"
-            elif (
-                affilate == "Москва" and distance > 50
-            ) or (
-                affilate != "Москва" and distance > 40
-            ):
+            elif zone == ZONE_PAID:
                 result = await self.call_operator(str(chat_id))
                 return """Указанный клиентом адрес находится вне зоны бесплатного выезда мастера, диалог с клиентом был переведен на оператора колл-центра.
 Передайте ОБА этих факта клиенту и оповестите его о том, что он также сам может связаться с нами по телефону 8 495 463 50 46"""
         except Exception as e:
-            self.logger.error(f"Error in distance calculation: {e}")
+            self.logger.error(f"Error in zone classification: {e}")
 
         try:
-            try:
-                geolocator = Nominatim(user_agent="my_app")
-                locations = geolocator.reverse(
-                    f"{latitude}, {longitude}",
-                    exactly_one=False
-                )
-                addresses = []
-                points = []
-                for location in locations:
-                    if location.raw['addresstype'] == 'building' and location.raw['name'] == '':
-                        if location.raw['display_name'] not in addresses:
-                            addresses.append(location.raw['display_name'])
-                            points.append(location)
-                if len(points) > 1:
-                    markup = ReplyKeyboardMarkup(
-                        one_time_keyboard=True
-                    )
-                    text = "Секунду..."
-                    for address in addresses:
-                        markup.add(address)
-                    markup.add("🏠 Вернуться в меню")
-                    await self.bot_instance.send_message(
-                        chat_id,
-                        text,
-                        reply_markup=markup
-                    )
-                    return "Не удалось однозначно определить адрес. ОБЯЗАТЕЛЬНО ПРЕДЛОЖИТЕ клиенту ВЫБРАТЬ из нескольких подходящих адресов, автоматически уже отображенных в диалоге, либо самостоятельно ещё раз прислать корректный адрес. Предлагайте и то, и то сразу, первое обязательно! Сами никакие конкретные варианты адресов НЕ предлагайте и НЕ упоминайте"
-                else:
-                    full_address = addresses[0]
-            except Exception as e:
-                self.logger.error(
-                    f"Error in geocoding address: {e}, using Yandex geolocator"
-                )
-                geolocator = Yandex(
-                    api_key=os.environ.get("YANDEX_GEOCODER_KEY", "")
-                )
-                locations = geolocator.reverse(
-                    f"{latitude}, {longitude}",
-                    exactly_one=False
-                )
-                addresses = []
-                points = []
-                for location in locations:
-                    if location.raw['metaDataProperty']['GeocoderMetaData']['kind'] == 'house' and location.raw['metaDataProperty']['GeocoderMetaData']['precision'] in ['number', 'exact']:
-                        if location.raw['metaDataProperty']['GeocoderMetaData']['Address']['formatted'] not in addresses:
-                            addresses.append(location.raw['metaDataProperty']['GeocoderMetaData']['Address']['formatted'])
-                            points.append(location)
-                if len(points) > 1:
-                    markup = ReplyKeyboardMarkup(
-                        one_time_keyboard=True
-                    )
-                    text = "Секунду..."
-                    for address in addresses:
-                        markup.add(address)
-                    markup.add("🏠 Вернуться в меню")
-                    await self.bot_instance.send_message(
-                        chat_id,
-                        text,
-                        reply_markup=markup
-                    )
-                    return "Не удалось однозначно определить адрес. ОБЯЗАТЕЛЬНО ПРЕДЛОЖИТЕ клиенту ВЫБРАТЬ из нескольких подходящих адресов, автоматически уже отображенных в диалоге, либо самостоятельно ещё раз прислать корректный адрес. Предлагайте и то, и то сразу, первое обязательно! Сами никакие конкретные варианты адресов НЕ предлагайте и НЕ упоминайте"
-                else:
-                    full_address = addresses[0]
+            candidates = await self.geocoder.reverse(latitude, longitude)
+            if len(candidates) > 1:
+                return await self.suggest_addresses(chat_id, candidates)
+            else:
+                full_address = candidates[0]["address"]
         except Exception as e:
             self.logger.error(
                 f"Error in geocoding address: {e}")
@@ -715,6 +1031,8 @@ class ChatAgent:
                 affilate,
                 "affilate"
             )
+            if self.draft(chat_id) is not None:
+                self.draft(chat_id)["affilate"] = affilate
         except Exception as e:
             self.logger.error(f"Error in saving address: {e}")
             return f"Ошибка при сохранении адреса: {e}"
@@ -723,123 +1041,49 @@ class ChatAgent:
         return f"Адрес клиента {full_address} был сохранен в заявку"
 
     async def save_address_to_request(self, chat_id, full_address):
-        del_pattern = re.compile(
-            r"ул\.*\s|дом(\s|,)|д\.*\s|город(\s|,)|гор\.*\s|г\.*\s",
-            re.IGNORECASE
-        )
-        ch_pattern = r'(,*\sстроение|,*\sстр\.*|,*\sс\.*)\s(\d+)|(,*\sкорпус|,*\sкорп\.*|,*\sк\.*)\s(\d+)'
-        replacement = lambda m: f"с{m.group(2)}" if m.group(1) else f"к{m.group(4)}" if m.group(3) else m.group(0)
-
-        nom_address = re.sub(
-            ch_pattern,
-            replacement,
-            full_address,
-            flags=re.IGNORECASE
-        )
-        nom_address = re.sub(del_pattern, '', nom_address)
+        nom_address = normalize_address(full_address)
 
         try:
-            try:
+            self.logger.info(
+                f"save_address_to_request address: {nom_address}"
+            )
+            candidates = None
+            confirmed = self.address_index.lookup(nom_address)
+            if confirmed:
                 self.logger.info(
-                    f"save_address_to_request address: {nom_address}"
+                    f"Address {confirmed['address']} found in the confirmed addresses index"
                 )
-                geolocator = Nominatim(user_agent="my_app")
-                locations = geolocator.geocode(
+                candidates = [confirmed]
+            else:
+                candidates = await self.geocoder.geocode(
                     nom_address,
-                    exactly_one=False,
-                    limit=10
-                )
-                addresses = []
-                points = []
-                for location in locations:
-                    if location.raw['addresstype'] == 'building' and location.raw['name'] == '':
-                        if location.raw['display_name'] not in addresses:
-                            addresses.append(location.raw['display_name'])
-                            points.append(location)
-                if len(points) > 1:
-                    markup = ReplyKeyboardMarkup(
-                        one_time_keyboard=True
-                    )
-                    text = "Секунду..."
-                    for address in addresses:
-                        markup.add(address)
-                    markup.add("🏠 Вернуться в меню")
-                    await self.bot_instance.send_message(
-                        chat_id,
-                        text,
-                        reply_markup=markup
-                    )
-                    return "Не удалось однозначно определить адрес. ОБЯЗАТЕЛЬНО ПРЕДЛОЖИТЕ клиенту ВЫБРАТЬ из нескольких подходящих адресов, автоматически уже отображенных в диалоге, либо самостоятельно ещё раз прислать корректный адрес. Предлагайте и то, и то сразу, первое обязательно! Сами никакие конкретные варианты адресов НЕ предлагайте и НЕ упоминайте"
-                else:
-                    latitude = points[0].latitude
-                    longitude = points[0].longitude
-                    full_address = addresses[0]
-            except Exception as e:
-                self.logger.error(
-                    f"Error in geocoding address: {e}, using Yandex geolocator"
-                )
-                self.logger.info(
-                    f"save_address_to_request address: {full_address}"
-                )
-                geolocator = Yandex(
-                    api_key=os.environ.get("YANDEX_GEOCODER_KEY", "")
-                )
-                locations = geolocator.geocode(
                     full_address,
-                    exactly_one=False
+                    nom_address
                 )
-                addresses = []
-                points = []
-                for location in locations:
-                    if location.raw['metaDataProperty']['GeocoderMetaData']['kind'] == 'house' and location.raw['metaDataProperty']['GeocoderMetaData']['precision'] in ['number', 'exact']:
-                        if location.raw['metaDataProperty']['GeocoderMetaData']['Address']['formatted'] not in addresses:
-                            addresses.append(location.raw['metaDataProperty']['GeocoderMetaData']['Address']['formatted'])
-                            points.append(location)
-                if len(points) > 1:
-                    markup = ReplyKeyboardMarkup(
-                        one_time_keyboard=True
-                    )
-                    text = "Секунду..."
-                    for address in addresses:
-                        markup.add(address)
-                    markup.add("🏠 Вернуться в меню")
-                    await self.bot_instance.send_message(
-                        chat_id,
-                        text,
-                        reply_markup=markup
-                    )
-                    return "Не удалось однозначно определить адрес. ОБЯЗАТЕЛЬНО ПРЕДЛОЖИТЕ клиенту ВЫБРАТЬ из нескольких подходящих адресов, автоматически уже отображенных в диалоге, либо самостоятельно ещё раз прислать корректный адрес. Предлагайте и то, и то сразу, первое обязательно! Сами никакие конкретные варианты адресов НЕ предлагайте и НЕ упоминайте"
-                else:
-                    latitude = points[0].latitude
-                    longitude = points[0].longitude
-                    full_address = addresses[0]
+            if len(candidates) > 1:
+                return await self.suggest_addresses(chat_id, candidates)
+            else:
+                latitude = candidates[0]["latitude"]
+                longitude = candidates[0]["longitude"]
+                full_address = candidates[0]["address"]
         except Exception as e:
             self.logger.error(
                 f"Error in geocoding address: {e}")
             return "Не удалось определить координаты адреса. Запросите адрес ещё раз"
         
         try:
-            distance, affilate = self.distance_calculation(
+            zone, affilate = self.geo_service.classify(
                 latitude,
-                longitude,
-                self.config["affilates"].items()
+                longitude
             )
-            if (
-                affilate == "Москва" and distance > 100
-            ) or (
-                affilate != "Москва" and distance > 90
-            ):
+            if zone == ZONE_OUT:
                 return "Указанный клиентом адрес находится вне зоны работы компании. Вежливо донесите это до клиента и прекратите далее оформлять заявку!"
-            elif (
-                affilate == "Москва" and distance > 50
-            ) or (
-                affilate != "Москва" and distance > 40
-            ):
+            elif zone == ZONE_PAID:
                 result = await self.call_operator(str(chat_id))
                 return """Указанный клиентом адрес находится вне зоны бесплатного выезда мастера, диалог с клиентом был переведен на оператора колл-центра.
 Передайте ОБА этих факта клиенту и о повестите его о том, что он также сам может связаться с нами по телефону 8 495 463 50 46"""
         except Exception as e:
-            self.logger.error(f"Error in distance calculation: {e}")
+            self.logger.error(f"Error in zone classification: {e}")
         
         try:
             await self.request_service.save_to_request(
@@ -861,7 +1105,9 @@ class ChatAgent:
                 chat_id,
                 affilate,
                 "affilate"
-            )            
+            )
+            if self.draft(chat_id) is not None:
+                self.draft(chat_id)["affilate"] = affilate            
         except Exception as e:
             self.logger.error(f"Error in saving address: {e}")
             return f"Ошибка при сохранении адреса: {e}"
@@ -886,20 +1132,9 @@ class ChatAgent:
 
     async def save_phone_to_request(self, chat_id, phone):
         self.logger.info(f"save_phone_to_request phone: {phone}")
-        phones = phonenumbers.PhoneNumberMatcher(phone, "RU")
-        if len([num for num in phones]) > 0:
-            for num in phones:
-                if phonenumbers.is_valid_number(num.number):
-                    phone = str(num.number.national_number)
-        else:
-            try:
-                parse = phonenumbers.parse("".join(re.findall(r"[\d]", phone)), "RU")
-                if phonenumbers.is_valid_number(parse):
-                    phone = str(parse.national_number)
-                else:
-                    return "Клиент предоставил некорректный номер телефона, ОБЯЗАТЕЛЬНО донесите это до клиента и запросите телефон ещё раз"
-            except Exception:
-                return "Клиент предоставил некорректный номер телефона, ОБЯЗАТЕЛЬНО донесите это до клиента и запросите телефон ещё раз"
+        phone = national_phone(phone)
+        if phone is None:
+            return "Клиент предоставил некорректный номер телефона, ОБЯЗАТЕЛЬНО донесите это до клиента и запросите телефон ещё раз"
 
         try:
             await self.request_service.save_to_request(
@@ -936,6 +1171,46 @@ class ChatAgent:
         self.logger.info("Comment was saved in the request")
         return "Комментарий был сохранен в заявку"
 
+    async def timed(self, timings, name, coroutine):
+        start = time.perf_counter()
+        try:
+            return await coroutine
+        finally:
+            timings[name] = round(time.perf_counter() - start, 3)
+
+    async def check_daily_limit(self, chat_id):
+        try:
+            banned = await self.request_selection(
+                chat_id,
+                request_creating=True
+            ) == "Ban"
+        except Exception as error:
+            self.logger.error(
+                f"Error in receiving today customer requests: {error}"
+            )
+            return
+        if banned:
+            self.ban_manager.set(
+                chat_id,
+                time.strftime("%Y-%m-%d %H:%M", time.localtime())
+            )
+            raise PreflightError("""Клиентом создано подозрительное число заявок за день.
+                Передайте ему это, а также то, что в целях безопасности ему необходимо оформлять далее заявки с другого Телеграм аккаунта. И прекратите далее оформлять заявку!
+                """)
+
+    async def read_saved_address(self, chat_id):
+        # Coordinates and affilate saved by the address tools, one directory scan
+        try:
+            request = await self.request_service.read_request(chat_id, True)
+            if "affilate" not in request:
+                raise KeyError("affilate")
+            return request
+        except Exception as e:
+            self.logger.error(
+                f"Error in reading current request files: {e}"
+            )
+            raise PreflightError("Вы не сохранили адрес! Перед 'Create_request' используйте сначала остальные инструменты для сохранения всех полученных данных")
+
     async def create_request(
         self,
         chat_id,
@@ -954,197 +1229,137 @@ class ChatAgent:
         circumstances="",
         brand=""
     ):
-        try:
-            if await self.request_selection(
-                chat_id,
-                request_creating=True
-            ) == "Ban":
-                self.ban_manager.set(
-                    chat_id,
-                    time.strftime("%Y-%m-%d %H:%M", time.localtime())
-                )
-                return """Клиентом создано подозрительное число заявок за день.
-                Передайте ему это, а также то, что в целях безопасности ему необходимо оформлять далее заявки с другого Телеграм аккаунта. И прекратите далее оформлять заявку!
-                """
-        except Exception as error:
-            self.logger.error(
-                f"Error in receiving today customer requests: {error}"
-            )
-
-        try:
-            with open("./data/template.json", "r", encoding="utf-8") as f:
-                order_params = json.load(f)
-        except Exception as e:
-            self.logger.error(f"Error in getting params template: {e}")
-            return f"Ошибка при получении шаблона параметров заявки: {e}"
-        
-        try:
-            order_params["order"]["client"]["display_name"] = name
-            order_params["order"]["address"]["floor"] = floor
-            order_params["order"]["address"]["entrance"] = entrance
-            order_params["order"]["address"]["apartment"] = apartment
-            order_params["order"]["address"]["intercom"] = intercom
-        except Exception as e:
-            self.logger.error(f"Error in getting order params: {e}")
-        
-        if latitude == 0 and longitude == 0:
-            try:
-                latitude = (await self.request_service.read_request(chat_id))["latitude"]
-                longitude = (await self.request_service.read_request(chat_id))["longitude"]
-            except Exception as e:
-                self.logger.error(
-                    f"Error in reading current request files: {e}"
-                )
-                return "Вы не сохранили адрес! Перед 'Create_request' используйте сначала остальные инструменты для сохранения всех полученных данных"
         if direction not in self.config["divisions"].values():
             return "Выбрано некорректное направление обращения, определите сами повторно подходящее именно из вашего списка"
-        
+
         for detail in [brand, circumstances]:
             if detail !="":
                 comment += f"\n{detail}"
 
-        # Double-check of personal data
-        comment = await self.check_personal_data(comment)
-
-        affilate = None
+        # Customer data is validated before any network call
+        order_fields = {
+            "direction": direction,
+            "date": date,
+            "phone": phone,
+            "name": name,
+            "floor": floor,
+            "entrance": entrance,
+            "apartment": apartment,
+            "intercom": intercom,
+        }
         try:
-            affilate = (await self.request_service.read_request(chat_id, True))["affilate"]
-        except Exception as e:
-            self.logger.error(
-                f"Error in reading current request files: {e}"
-            )
-            return "Вы не сохранили адрес! Перед 'Create_request' используйте сначала остальные инструменты для сохранения всех полученных данных"
+            self.order_builder.build(**order_fields)
+        except ValidationError as e:
+            self.logger.error(f"Error in order params validation: {e}")
+            return f"Получены некорректные данные заявки, исправьте их или уточните у клиента: {e}"
+
+        # Independent pre-flight steps run concurrently,
+        # the first validation failure cancels the others
+        timings = {}
+        failure = None
+        try:
+            async with asyncio.TaskGroup() as group:
+                group.create_task(
+                    self.timed(timings, "ban_check", self.check_daily_limit(chat_id))
+                )
+                comment_task = group.create_task(
+                    self.timed(timings, "personal_data", self.check_personal_data(comment))
+                )
+                request_task = group.create_task(
+                    self.timed(timings, "request_files", self.read_saved_address(chat_id))
+                )
+        except* PreflightError as errors:
+            failure = str(errors.exceptions[0])
+        self.logger.info(f"Pre-flight timings: {timings}")
+        if failure:
+            return failure
+
+        comment = comment_task.result()
+        saved_address = request_task.result()
+        if latitude == 0 and longitude == 0:
+            if "latitude" not in saved_address or "longitude" not in saved_address:
+                return "Вы не сохранили адрес! Перед 'Create_request' используйте сначала остальные инструменты для сохранения всех полученных данных"
+            latitude = saved_address["latitude"]
+            longitude = saved_address["longitude"]
+        affilate = saved_address["affilate"]
+
         if not affilate:
             try:
-                distance, affilate = self.distance_calculation(
+                zone, affilate = self.geo_service.classify(
                     latitude,
-                    longitude,
-                    self.config["affilates"].items()
+                    longitude
                 )
-                if (
-                    affilate == "Москва" and distance > 100
-                ) or (
-                    affilate != "Москва" and distance > 90
-                ):
+                if zone == ZONE_OUT:
                     return """Указанный клиентом адрес находится вне зоны работы компании.
 Вежливо донесите это до клиента и прекратите далее оформлять заявку!"""
-                elif (
-                    affilate == "Москва" and distance > 50
-                ) or (
-                    affilate != "Москва" and distance > 40
-                ):
+                elif zone == ZONE_PAID:
                     result = await self.call_operator(str(chat_id))
                     return """Указанный клиентом адрес находится вне зоны бесплатного выезда мастера, диалог с клиентом был переведен на оператора колл-центра.
     Передайте ОБА этих факта клиенту и оповестите его о том, что он также сам может связаться с нами по телефону 8 495 463 50 46"""
             except Exception as e:
-                self.logger.error(f"Error in distance calculation: {e}")
+                self.logger.error(f"Error in zone classification: {e}")
 
-        del_pattern = re.compile(
-            r"улица\s*|ул\.*\s|дом(\s|,)|д\.*\s|город(\s|,)|гор\.*\s|г\.*\s",
-            re.IGNORECASE
-        )
-        ch_pattern = r'(,*\sстроение|,*\sстр\.*|,*\sс\.*)\s(\d+)|(,*\sкорпус|,*\sкорп\.*|,*\sк\.*)\s(\d+)'
-        replacement = lambda m: f"с{m.group(2)}" if m.group(1) else f"к{m.group(4)}" if m.group(3) else m.group(0)
-
-        address = re.sub(ch_pattern, replacement, address, flags=re.IGNORECASE)
-        address = re.sub(del_pattern, '', address)
+        confirmed_address = address
+        address = normalize_address(address)
 
         try:
-            order_params["order"]["services"][0]["service_id"] = direction
-            order_params["order"]["desired_dt"] = date
-            order_params["order"]["client"]["phone"] = phone
-            order_params["order"]["address"]["name"] = address
-            order_params["order"]["address"]["name_components"][0]["name"] = affilate
-            order_params["order"]["comment"] = comment
-            order_params["order"]["address"]["geopoint"]["latitude"] = latitude
-            order_params["order"]["address"]["geopoint"]["longitude"] = longitude
-            order_params["order"]["uslugi_id"] = time.strftime(
-                "%Y-%m-%d-%H-%M-%S",
-                time.localtime()
-            ).replace("-", "")+str(chat_id)
+            order_params = self.order_builder.build(
+                **order_fields,
+                address=address,
+                affilate=affilate,
+                comment=comment,
+                latitude=latitude,
+                longitude=longitude,
+                uslugi_id=time.strftime(
+                    "%Y-%m-%d-%H-%M-%S",
+                    time.localtime()
+                ).replace("-", "")+str(chat_id)
+            ).model_dump()
         except Exception as e:
             self.logger.error(f"Error in getting order params: {e}")
             return f"Ошибка при получении параметров заявки: {e}"
 
+        # Order is durably queued, submission to 1C and its number are delivered in background
         try:
-            ws_params = {
-                "Идентификатор": "new_bid_number",
-                "НомерПартнера": order_params["order"]["uslugi_id"],
-            }
-            order_url = f"{self.config['proxy_url']}/hs"
-            ws_url = f"{self.config['proxy_url']}/ws"
-
-            order_data = {
-                "clientPath": self.config["order_path"]
-            }
-            ws_data = {
-                "clientPath": self.config["ws_paths"],
-                "login": self.login,
-                "password": self.password,
-            }
-            request_number = None
-        except Exception as e:
-            self.logger.error(f"Error in getting web services params: {e}")
-            return f"Ошибка при получении параметров вэб-сервисов: {e}"
-        
-        try:
-            order = requests.post(
-                order_url,
-                json={
-                    "config": order_data,
-                    "params": order_params,
-                    "token": self.token
-                }
-            )
+            enqueued = await self.order_outbox.enqueue(chat_id, order_params)
         except Exception as e:
             self.logger.error(f"Error in creating request: {e}")
             return f"Ошибка при создании заявки: {e}"
-        finally:
-            if order:
-                self.logger.info(f"Result:\n{order.status_code}\n{order.text}")
 
         try:
-            # Receiving number of new request
-            results = requests.post(
-                ws_url,
-                json={"config": ws_data, "params": ws_params, "token": self.token}
-            ).json()["result"]
-            self.logger.info(f"results: {results}")
-            for value in results.values():
-                if len(value) > 0:
-                    request_number = value[0]["id"]
-                    break
-        except Exception as e:
-            self.logger.error(f"Error in receiving request number: {e}")
-
-        if order.status_code == 200:
-            self.logger.info(f"number: {request_number}")
-            self.request_service.delete_files(chat_id)
-            self.affilate = None
-            await self.chat_data_service.update_bot_message_date(
-                chat_id,
-                False
+            self.address_index.add(
+                confirmed_address,
+                latitude,
+                longitude,
+                affilate
             )
-            if request_number:
-                return f"Заявка была создана с номером {request_number}"
-            else:
-                return "Заявка была создана"
-        else:
-            self.logger.error(f"Error in creating request: {order.text}")
-            return f"Ошибка при создании заявки: {order.text}"
+        except Exception as e:
+            self.logger.error(f"Error in indexing confirmed address: {e}")
+        self.request_service.delete_files(chat_id)
+        self.affilate = None
+        if self.draft(chat_id) is not None:
+            self.draft(chat_id).clear()
+        await self.chat_data_service.update_bot_message_date(
+            chat_id,
+            False
+        )
+        if not enqueued:
+            return "Эта заявка уже была создана ранее, повторно её создавать НЕ нужно, её номер придёт клиенту отдельным сообщением в ближайшее время"
+        return "Заявка была создана, её номер придёт клиенту отдельным сообщением в ближайшее время"
+
+    async def saved_affilate(self, chat_id):
+        # Affilate of the address saved in the current request, it selects the 1C base
+        draft = self.draft(chat_id)
+        if draft is not None:
+            return draft.get("affilate")
+        try:
+            return (await self.request_service.read_request(chat_id, True)).get("affilate")
+        except Exception as e:
+            self.logger.error(f"Error in reading current request files: {e}")
+            return None
 
     async def request_selection(self, chat_id, request_creating=False):
         try:
-            ws_url = f"{self.config['proxy_url']}/ws"        
-            ws_params = {
-                "Идентификатор": "bid_numbers",
-                "НомерПартнера": str(chat_id),
-            }
-            ws_data = {
-                "clientPath": self.config["ws_paths"],
-                "login": self.login,
-                "password": self.password,
-            }
             request_numbers = {}
             divisions = self.config["divisions"]
         except Exception as e:
@@ -1152,10 +1367,10 @@ class ChatAgent:
             return f"Ошибка при получении параметров вэб-сервиса: {e}"
 
         try:
-            results = requests.post(
-                ws_url,
-                json={"config": ws_data, "params": ws_params, "token": self.token}
-            ).json()["result"]
+            results = await self.bid_cache.get(
+                chat_id,
+                await self.saved_affilate(chat_id)
+            )
             self.logger.info(f"results: {results}")
             for value in results.values():
                 if len(value) > 0:
@@ -1199,146 +1414,80 @@ class ChatAgent:
                 return "У клиента нет существующих заявок"
     
     async def change_request(self, chat_id, request_number, field_name, field_value):
-        partner_number = None
-        date_str = None
-        revision = None
-        locality = None
+        # Validation of value types
+        if field_name == "comment":
 
-        try:
-            ws_url = f"{self.config['proxy_url']}/ws"        
-            ws_params = {
-                "Идентификатор": "data_to_change_bid",
-                "Номер": request_number,
-            }
-            ws_data = {
-                "clientPath": self.config["ws_paths"],
-                "login": self.login,
-                "password": self.password,
-            }
-        except Exception as e:
-            self.logger.error(f"Error in getting web service params: {e}")
-            return f"Ошибка при получении параметров вэб-сервиса: {e}"
-        
-        # Unloading items critical for change
-        try:
-            results = requests.post(
-                ws_url,
-                json={"config": ws_data, "params": ws_params, "token": self.token}
-            ).json()["result"]
-            self.logger.info(f"results: {results}")
-            
-            for value in results.values():
-                if len(value) > 0:
-                    partner_number = str(value[0]["id"])
-                    date_received = value[0]["date"]
-                    date = datetime.strptime(
-                        date_received,
-                        '%d.%m.%Y %H:%M:%S'
-                    )
-                    date_str = date.strftime('%Y-%m-%dT%H:%MZ')
-                    if value[0]["comment"]:
-                        if value[0]["comment"] == "''":
-                            comment = ''
-                        else:
-                            comment = value[0]["comment"]
-                    else:
-                        comment = ''
-                    break
-
-            get_url = f"{self.config['proxy_url']}/rev"
-            get_data = {
-                "clientPath": {"crm": self.config["order_path"]["crm"]+partner_number}
-            }
-            request = requests.post(
-                get_url,
-                json={"config": get_data, "token": self.token}
-            ).json()["result"]["order"]
-            revision = request["revision"]
-            locality = request["address"]["name_components"][0]["name"]
-
-            self.logger.info(f"partner_number: {partner_number}")
-            self.logger.info(f"date: {date_str}")
-            self.logger.info(f"comment: {comment}")
-            self.logger.info(f"revision: {revision}")
-            self.logger.info(f"locality: {locality}")
-        except Exception as e:
-            self.logger.error(f"Error in receiving request data: {e}")
+            # Double-check of personal data
+            field_value = await self.check_personal_data(field_value)
 
-        if partner_number and date_str and locality and revision is not None:
+        elif field_name == "phone":
+            field_value = national_phone(field_value)
+            if field_value is None:
+                return "Клиент предоставил некорректный номер телефона, ОБЯЗАТЕЛЬНО донесите это до клиента и запросите телефон ещё раз"
+
+        else:
+            return "Получено или сформулировано недопустимое для изменения значение. Доступны только коммментарий или телефон"
+
+        # Cached order metadata, refetched once if 1C reports a revision conflict
+        for attempt in range(2):
             try:
-                with open("./data/template.json", "r", encoding="utf-8") as f:
-                    change_params = json.load(f)
+                metadata = await self.order_metadata.get(
+                    request_number,
+                    refresh=attempt > 0
+                )
             except Exception as e:
-                self.logger.error(f"Error in getting params template: {e}")
-                return f"Ошибка при получении шаблона параметров заявки: {e}"
-            
-            change_params["order"]["uslugi_id"] = partner_number
-            change_params["order"]["desired_dt"] = date_str
-            change_params["order"]["address"]["name_components"][0]["name"] = locality
-            change_params["order"]["revision"] = revision + 1
-
-            # Validation of value types
+                self.logger.error(f"Error in receiving request data: {e}")
+                return f"Произошла ошибка при получении данных заявки: {e}"
+
+            change_fields = {
+                "uslugi_id": metadata["partner_number"],
+                "date": metadata["date"],
+                "affilate": metadata["locality"],
+                "revision": metadata["revision"] + 1,
+                "comment": metadata["comment"],
+            }
             if field_name == "comment":
-
-                # Double-check of personal data
-                field_value = await self.check_personal_data(field_value)
-                change_params["order"]["comment"] = field_value
-                self.logger.info(f"Parametrs: {change_params}")
-
-            elif field_name == "phone":
-                phones = phonenumbers.PhoneNumberMatcher(field_value, "RU")
-                if len([num for num in phones]) > 0:
-                    for num in phones:
-                        if phonenumbers.is_valid_number(num.number):
-                            field_value = str(num.number.national_number)
-                else:
-                    try:
-                        parse = phonenumbers.parse("".join(re.findall(r"[\d]", field_value)), "RU")
-                        if phonenumbers.is_valid_number(parse):
-                            field_value = str(parse.national_number)
-                        else:
-                            return "Клиент предоставил некорректный номер телефона, ОБЯЗАТЕЛЬНО донесите это до клиента и запросите телефон ещё раз"
-                    except Exception:
-                        return "Клиент предоставил некорректный номер телефона, ОБЯЗАТЕЛЬНО донесите это до клиента и запросите телефон ещё раз"
-
-                change_params["order"]["client"]["phone"] = field_value
-                change_params["order"]["comment"] = comment
-                self.logger.info(f"Parametrs: {change_params}")
-
+                change_fields["comment"] = field_value
             else:
-                self.logger.info(f"Parametrs: {change_params}")
-                return "Получено или сформулировано недопустимое для изменения значение. Доступны только коммментарий или телефон"
-            
+                change_fields["phone"] = field_value
+            try:
+                change_params = self.order_builder.build(**change_fields).model_dump()
+            except ValidationError as e:
+                self.logger.error(f"Error in order params validation: {e}")
+                return f"Ошибка при получении параметров заявки: {e}"
+            self.logger.info(f"Parametrs: {change_params}")
+
             # Change of request
             try:
-                change_url = f"{self.config['proxy_url']}/ex"
-                change_data = {
-                    "clientPath": {"domain": self.config["change_path"]["domain"]+partner_number}
-                }
-                change = requests.post(
-                    change_url,
-                    json={
-                        "config": change_data,
-                        "params": change_params,
-                        "token": self.token
-                    }
+                change = await self.proxy_client.exchange(
+                    {"domain": self.config["change_path"]["domain"]+metadata["partner_number"]},
+                    change_params
                 )
             except Exception as e:
                 self.logger.error(f"Error in changing request: {e}")
                 return f"Ошибка при обновлении заявки: {e}"
             self.logger.info(f"Result:\n{change.status_code}\n{change.text}")
-            
+
             if change.status_code == 200:
+                self.order_metadata.update(
+                    request_number,
+                    revision=change_params["order"]["revision"],
+                    comment=change_params["order"]["comment"]
+                )
+                self.bid_cache.invalidate(chat_id)
                 await self.chat_data_service.update_bot_message_date(
                     chat_id,
                     False
                 )
                 return f"Данные заявки были обновлены"
+            elif change.status_code == REVISION_CONFLICT:
+                self.logger.info(f"Revision conflict in changing request: {change.text}")
+                self.order_metadata.conflict(request_number)
             else:
-                self.logger.error(f"Error in changing request: {change.text}")
-                return f"Ошибка при обновлении заявки: {change.text}"
-        else:
-            return f"Произошла ошибка при получении данных заявки: {e}"
+                break
+
+        self.logger.error(f"Error in changing request: {change.text}")
+        return f"Ошибка при обновлении заявки: {change.text}"
 
     async def call_operator(self, chat_id):
         self.dialogues_api_accounts = self.dialogues_api_manager.load_config()
@@ -1347,22 +1496,14 @@ class ChatAgent:
                 off_params = {
                     "chat_id": chat_id
                 }
-                off_url = f"{self.config['proxy_url']}/hs"
-                off_data = {
-                    "clientPath": self.config["dialogue_path"]
-                }
             except Exception as e:
                 self.logger.error(f"Error in getting call operator params: {e}")
                 return f"Ошибка при получении параметров вызова оператора: {e}"
             
             try:
-                call = requests.post(
-                    off_url,
-                    json={
-                        "config": off_data,
-                        "params": off_params,
-                        "token": self.token
-                    }
+                call = await self.proxy_client.http_service(
+                    self.config["dialogue_path"],
+                    off_params
                 )
             except Exception as e:
                 self.logger.error(f"Error in calling operator: {e}")
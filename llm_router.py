@@ -0,0 +1,240 @@
+import re
+import time
+import openai
+import anthropic
+
+from collections import deque
+from datetime import datetime
+
+from langchain_core.callbacks import AsyncCallbackHandler
+
+from resilience import CircuitOpen, LatencyWindow
+
+
+# Errors after which the agent run is repeated with the next provider
+FAILOVER_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+    anthropic.RateLimitError,
+    anthropic.APIConnectionError,
+    anthropic.InternalServerError,
+    CircuitOpen,
+)
+DURATION_PATTERN = re.compile(r"([\d.]+)(ms|h|m|s)?")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "": 1}
+
+
+def reset_seconds(value):
+    # retry-after seconds, OpenAI "1m30s" / "250ms" durations and Anthropic RFC 3339 timestamps
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() - time.time())
+    except ValueError:
+        pass
+    return sum(
+        float(number) * DURATION_UNITS[unit]
+        for number, unit in DURATION_PATTERN.findall(value)
+    )
+
+
+def prompt_tokens(llm_output):
+    # (input tokens, tokens read from the prompt cache) of an LLM call
+    llm_output = llm_output or {}
+    if "token_usage" in llm_output:
+        usage = llm_output["token_usage"] or {}
+        details = usage.get("prompt_tokens_details") or {}
+        return usage.get("prompt_tokens") or 0, details.get("cached_tokens") or 0
+    # Anthropic input_tokens do not include cache reads and writes
+    usage = llm_output.get("usage") or {}
+    cached = usage.get("cache_read_input_tokens") or 0
+    return (
+        (usage.get("input_tokens") or 0)
+        + cached
+        + (usage.get("cache_creation_input_tokens") or 0)
+    ), cached
+
+
+class ProviderCallback(AsyncCallbackHandler):
+    # Latency, errors, prompt tokens and rate limit headers of every LLM call of an agent run
+    def __init__(self, router, provider):
+        self.router = router
+        self.provider = provider
+        self.started = {}
+        self.tokens = {"input": 0, "cached": 0}
+
+    async def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self.started[run_id] = time.monotonic()
+
+    async def on_llm_end(self, response, *, run_id, **kwargs):
+        start = self.started.pop(run_id, None)
+        if start is not None:
+            self.router.record(self.provider, time.monotonic() - start, True)
+        input_tokens, cached_tokens = prompt_tokens(response.llm_output)
+        self.tokens["input"] += input_tokens
+        self.tokens["cached"] += cached_tokens
+        self.router.prompt_tokens(self.provider, input_tokens, cached_tokens)
+        for generations in response.generations:
+            for generation in generations:
+                info = generation.generation_info or {}
+                if "headers" in info:
+                    self.router.limits(self.provider, info["headers"])
+
+    async def on_llm_error(self, error, *, run_id, **kwargs):
+        start = self.started.pop(run_id, None)
+        if start is not None:
+            self.router.record(self.provider, time.monotonic() - start, False)
+
+
+class LlmRouter:
+    def __init__(
+        self,
+        resilience,
+        logger,
+        providers=("OpenAI", "Anthropic"),
+        cooldown=120,
+        max_error_rate=0.3,
+        max_latency=30,
+        min_calls=5,
+        min_remaining_requests=2,
+        window_size=200,
+        window_period=300
+    ):
+        self.logger = logger
+        self.resilience = resilience
+        # The first provider is the primary one, traffic returns to it after a cooldown
+        self.providers = list(providers)
+        self.cooldown = cooldown
+        self.max_error_rate = max_error_rate
+        self.max_latency = max_latency
+        self.min_calls = min_calls
+        self.min_remaining_requests = min_remaining_requests
+        self.windows = {
+            provider: LatencyWindow(window_size, window_period)
+            for provider in self.providers
+        }
+        # provider: monotonic time until which it is not selected
+        self.cooldowns = {}
+        # provider: (remaining requests, monotonic time of the limit reset)
+        self.remaining = {}
+        self.current = self.providers[0]
+        self.switches = deque(maxlen=20)
+        self.counters = {"switches": 0, "recoveries": 0, "failovers": 0}
+        # provider: [input tokens, cached input tokens]
+        self.tokens = {provider: [0, 0] for provider in self.providers}
+
+    def callback(self, provider):
+        return ProviderCallback(self, provider)
+
+    def record(self, provider, latency, ok):
+        self.windows[provider].add(latency, ok)
+
+    def prompt_tokens(self, provider, input_tokens, cached_tokens):
+        self.tokens[provider][0] += input_tokens
+        self.tokens[provider][1] += cached_tokens
+
+    def limits(self, provider, headers):
+        # Remaining requests from x-ratelimit-* / anthropic-ratelimit-* response headers
+        headers = {key.lower(): value for key, value in headers.items()}
+        for prefix in ("x-ratelimit-", "anthropic-ratelimit-"):
+            remaining = headers.get(f"{prefix}remaining-requests") or headers.get(f"{prefix}requests-remaining")
+            if remaining is None:
+                continue
+            reset = reset_seconds(
+                headers.get(f"{prefix}reset-requests") or headers.get(f"{prefix}requests-reset")
+            )
+            self.remaining[provider] = (int(remaining), time.monotonic() + (reset or 0))
+
+    def rate_limited(self, provider, error):
+        # Provider is skipped until its limit resets, the default cooldown without retry-after
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None) or {}
+        delay = reset_seconds(headers.get("retry-after"))
+        self.cooldowns[provider] = time.monotonic() + (delay or self.cooldown)
+
+    def failed(self, provider, error):
+        self.counters["failovers"] += 1
+        self.logger.error(f"LLM provider {provider} failed: {error}, trying the next one")
+        if isinstance(error, (openai.RateLimitError, anthropic.RateLimitError)):
+            self.rate_limited(provider, error)
+        else:
+            self.cooldowns[provider] = time.monotonic() + self.cooldown
+        self.candidates()
+
+    def recent(self, provider):
+        # Calls made before the end of the last cooldown do not count anymore
+        since = self.cooldowns.get(provider, 0)
+        return [call for call in self.windows[provider].recent() if call[0] >= since]
+
+    def unhealthy(self, provider):
+        # Reason why the provider should not get traffic now, None if it is healthy
+        now = time.monotonic()
+        if self.resilience.is_open(provider):
+            return "circuit open"
+        if self.cooldowns.get(provider, 0) > now:
+            return "cooldown"
+        remaining, reset = self.remaining.get(provider, (None, 0))
+        if remaining is not None and remaining <= self.min_remaining_requests and reset > now:
+            return "rate limit"
+        calls = self.recent(provider)
+        if len(calls) >= self.min_calls:
+            if sum(1 for _, _, ok in calls if not ok) / len(calls) > self.max_error_rate:
+                return "error rate"
+            latencies = sorted(latency for _, latency, _ in calls)
+            if latencies[int(len(latencies) * 0.95)] > self.max_latency:
+                return "latency"
+        return None
+
+    def candidates(self):
+        # Healthy providers in priority order, all of them if none is healthy
+        reasons = {provider: self.unhealthy(provider) for provider in self.providers}
+        for provider, reason in reasons.items():
+            # A degraded provider gets traffic again only after the cooldown
+            if reason in ("error rate", "latency"):
+                self.cooldowns[provider] = time.monotonic() + self.cooldown
+        healthy = [provider for provider in self.providers if reasons[provider] is None]
+        if not healthy:
+            return list(self.providers)
+        if healthy[0] != self.current:
+            self.switch(healthy[0], reasons.get(self.current) or "recovery")
+        return healthy
+
+    def switch(self, provider, reason):
+        self.counters["switches"] += 1
+        if provider == self.providers[0]:
+            self.counters["recoveries"] += 1
+        self.logger.info(f"LLM provider switched from {self.current} to {provider}: {reason}")
+        self.switches.append({
+            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "from": self.current,
+            "to": provider,
+            "reason": reason,
+        })
+        self.current = provider
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "current": self.current,
+            **self.counters,
+            "providers": {
+                provider: {
+                    "reason": self.unhealthy(provider),
+                    "cooldown_left": round(max(0, self.cooldowns.get(provider, 0) - now), 1),
+                    "remaining_requests": self.remaining.get(provider, (None, 0))[0],
+                    "input_tokens": self.tokens[provider][0],
+                    "cached_tokens": self.tokens[provider][1],
+                    "cached_share": round(
+                        self.tokens[provider][1] / self.tokens[provider][0], 3
+                    ) if self.tokens[provider][0] else None,
+                    **self.windows[provider].stats(),
+                }
+                for provider in self.providers
+            },
+            "last_switches": list(self.switches),
+        }
@@ -0,0 +1,100 @@
+import time
+
+from datetime import datetime
+
+
+class OrderMetadataCache:
+    def __init__(self, ws_router, proxy_client, order_path, logger, ttl=600):
+        self.logger = logger
+        self.ws_router = ws_router
+        self.proxy_client = proxy_client
+        self.order_path = order_path
+        self.ttl = ttl
+        # request_number: (expiration time, metadata)
+        self.entries = {}
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "refetches": 0,
+            "optimistic_updates": 0,
+            "conflicts": 0,
+        }
+
+    async def fetch(self, request_number):
+        # Items critical for a change: data_to_change_bid and current revision
+        results = await self.ws_router.query(
+            {
+                "Идентификатор": "data_to_change_bid",
+                "Номер": request_number,
+            },
+            request_number=request_number
+        )
+        self.logger.info(f"results: {results}")
+        metadata = None
+        for value in results.values():
+            if len(value) > 0:
+                comment = value[0]["comment"]
+                if not comment or comment == "''":
+                    comment = ""
+                metadata = {
+                    "partner_number": str(value[0]["id"]),
+                    "date": datetime.strptime(
+                        value[0]["date"],
+                        '%d.%m.%Y %H:%M:%S'
+                    ).strftime('%Y-%m-%dT%H:%MZ'),
+                    "comment": comment,
+                }
+                break
+        if metadata is None:
+            raise LookupError(f"request {request_number} is not found")
+
+        order = await self.proxy_client.revision(
+            {"crm": self.order_path["crm"]+metadata["partner_number"]}
+        )
+        metadata["revision"] = order["revision"]
+        metadata["locality"] = order["address"]["name_components"][0]["name"]
+        self.logger.info(f"Order metadata: {metadata}")
+        return metadata
+
+    async def get(self, request_number, refresh=False):
+        request_number = str(request_number)
+        entry = self.entries.get(request_number)
+        if entry is not None and not refresh and entry[0] > time.monotonic():
+            self.counters["hits"] += 1
+            return dict(entry[1])
+
+        self.counters["refetches" if refresh else "misses"] += 1
+        metadata = await self.fetch(request_number)
+        now = time.monotonic()
+        self.entries = {
+            number: entry for number, entry in self.entries.items()
+            if entry[0] > now
+        }
+        self.entries[request_number] = (now + self.ttl, metadata)
+        return dict(metadata)
+
+    def update(self, request_number, **fields):
+        # Optimistic update after a change accepted by 1C
+        request_number = str(request_number)
+        entry = self.entries.get(request_number)
+        if entry is not None:
+            entry[1].update(fields)
+            self.counters["optimistic_updates"] += 1
+
+    def conflict(self, request_number):
+        self.counters["conflicts"] += 1
+        self.entries.pop(str(request_number), None)
+
+    def stats(self):
+        lookups = (
+            self.counters["hits"]
+            + self.counters["misses"]
+            + self.counters["refetches"]
+        )
+        return {
+            **self.counters,
+            "hit_ratio": round(
+                self.counters["hits"] / lookups, 3
+            ) if lookups else None,
+            "entries": len(self.entries),
+        }
@@ -0,0 +1,142 @@
+import re
+import functools
+
+import orjson
+import phonenumbers
+
+from datetime import datetime
+from pydantic import BaseModel, ConfigDict, Field, field_validator
+
+
+# Desired visit time format 'yyyy-mm-ddThh:mmZ'
+DESIRED_DT_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}Z")
+# Order fields set by the tools and their places in the payload
+ORDER_FIELDS = {
+    "uslugi_id": ("uslugi_id",),
+    "direction": ("services", 0, "service_id"),
+    "date": ("desired_dt",),
+    "name": ("client", "display_name"),
+    "phone": ("client", "phone"),
+    "address": ("address", "name"),
+    "floor": ("address", "floor"),
+    "entrance": ("address", "entrance"),
+    "apartment": ("address", "apartment"),
+    "intercom": ("address", "intercom"),
+    "latitude": ("address", "geopoint", "latitude"),
+    "longitude": ("address", "geopoint", "longitude"),
+    "affilate": ("address", "name_components", 0, "name"),
+    "comment": ("comment",),
+    "revision": ("revision",),
+}
+
+
+@functools.lru_cache(maxsize=4096)
+def national_phone(phone):
+    # Russian national number of a valid phone, None otherwise
+    for match in phonenumbers.PhoneNumberMatcher(phone, "RU"):
+        if phonenumbers.is_valid_number(match.number):
+            return str(match.number.national_number)
+    try:
+        parse = phonenumbers.parse("".join(re.findall(r"[\d]", phone)), "RU")
+        if phonenumbers.is_valid_number(parse):
+            return str(parse.national_number)
+    except Exception:
+        pass
+    return None
+
+
+class OrderModel(BaseModel):
+    # Template keys unknown to the model raise instead of being dropped from the orders
+    model_config = ConfigDict(extra="forbid")
+
+
+class Service(OrderModel):
+    service_id: str
+    amount: int = 0
+    label: str = ""
+    price: str = ""
+    additionals: list = []
+
+
+class Client(OrderModel):
+    display_name: str = "Не названо"
+    phone: str = ""
+
+    @field_validator("phone")
+    @classmethod
+    def check_phone(cls, value):
+        if value == "":
+            return value
+        phone = national_phone(value)
+        if phone is None:
+            raise ValueError(f"invalid phone number {value}")
+        return phone
+
+
+class Geopoint(OrderModel):
+    longitude: float = Field(ge=-180, le=180)
+    latitude: float = Field(ge=-90, le=90)
+
+
+class NameComponent(OrderModel):
+    kind: str
+    name: str | None
+
+
+class Address(OrderModel):
+    uri: str = ""
+    geopoint: Geopoint
+    name: str = ""
+    floor: str = ""
+    entrance: str = ""
+    apartment: str = ""
+    intercom: str = ""
+    name_components: list[NameComponent]
+
+
+class Order(OrderModel):
+    uslugi_id: str
+    services: list[Service]
+    source: str = ""
+    utm_source: str = ""
+    status: str = "created"
+    duration_minutes: int = 0
+    desired_dt: str
+    employees: list = []
+    payment_type: str = "card"
+    client: Client
+    address: Address
+    comment: str = ""
+    revision: int = 0
+
+    @field_validator("desired_dt")
+    @classmethod
+    def check_desired_dt(cls, value):
+        if not DESIRED_DT_PATTERN.fullmatch(value):
+            raise ValueError(f"desired_dt {value} is not in yyyy-mm-ddThh:mmZ format")
+        datetime.fromisoformat(value[:-1])
+        return value
+
+
+class OrderPayload(OrderModel):
+    order: Order
+
+
+class OrderBuilder:
+    def __init__(self, template_path):
+        # Template is parsed and validated once and kept serialized,
+        # every payload starts as a cheap copy decoded from it
+        with open(template_path, "r", encoding="utf-8") as f:
+            template = OrderPayload.model_validate_json(f.read())
+        self.template = orjson.dumps(template.model_dump())
+
+    def build(self, **fields):
+        # Validated payload, raises ValidationError for incorrect values
+        params = orjson.loads(self.template)
+        for name, value in fields.items():
+            *parents, key = ORDER_FIELDS[name]
+            target = params["order"]
+            for parent in parents:
+                target = target[parent]
+            target[key] = value
+        return OrderPayload.model_validate(params)
@@ -0,0 +1,411 @@
+import os
+import time
+import random
+import hashlib
+import asyncio
+import sqlite3
+import threading
+
+import orjson
+
+from datetime import datetime
+
+
+PENDING = "pending"
+SUBMITTED = "submitted"
+DONE = "done"
+FAILED = "failed"
+FAILURE_MESSAGE = "К сожалению, не удалось передать вашу заявку. Пожалуйста, свяжитесь с нами по телефону 8 495 463 50 46"
+
+
+class OrderRejected(Exception):
+    # 4xx answer of /hs, the same order would be rejected again
+    pass
+
+
+class OrderOutbox:
+    def __init__(
+        self,
+        db_path,
+        proxy_client,
+        ws_router,
+        bid_cache,
+        order_path,
+        bot_instance,
+        chat_data_service,
+        logger,
+        max_attempts=8,
+        base_delay=2,
+        max_delay=300,
+        number_polls=5,
+        concurrency=4,
+        lease=120,
+        draft_window=600
+    ):
+        self.logger = logger
+        self.db_path = db_path
+        self.proxy_client = proxy_client
+        self.bid_cache = bid_cache
+        self.ws_router = ws_router
+        self.order_path = order_path
+        self.bot_instance = bot_instance
+        self.chat_data_service = chat_data_service
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.number_polls = number_polls
+        self.concurrency = concurrency
+        self.lease = lease
+        self.draft_window = draft_window
+        self.owner = f"{os.uname().nodename}:{os.getpid()}"
+        self.wakeup = asyncio.Event()
+        self.worker = None
+        self.conn = None
+        # Serializes statements of the shared connection between threads
+        self.lock = threading.Lock()
+        self.counters = {
+            "enqueued": 0,
+            "submitted": 0,
+            "retries": 0,
+            "failed": 0,
+            "numbers_delivered": 0,
+            "already_in_1c": 0,
+            "duplicates": 0,
+            "rejected": 0,
+            "submit_delay_total": 0.0,
+        }
+
+    def connection(self):
+        # Outbox journal shared by all workers, orders are claimed with a lease
+        if self.conn is None:
+            self.conn = sqlite3.connect(
+                self.db_path,
+                timeout=5,
+                check_same_thread=False,
+                isolation_level=None
+            )
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS order_outbox (
+                    uslugi_id TEXT PRIMARY KEY,
+                    chat_id TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL,
+                    lease_owner TEXT,
+                    lease_until REAL NOT NULL DEFAULT 0,
+                    request_number TEXT,
+                    error TEXT,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+            """)
+            self.conn.execute("""
+                CREATE INDEX IF NOT EXISTS order_outbox_due
+                ON order_outbox (status, next_attempt)
+            """)
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(order_outbox)")]
+            if "draft_key" not in columns:
+                self.conn.execute("ALTER TABLE order_outbox ADD COLUMN draft_key TEXT")
+            self.conn.execute("""
+                CREATE INDEX IF NOT EXISTS order_outbox_draft
+                ON order_outbox (draft_key, created)
+            """)
+        return self.conn
+
+    def insert(self, chat_id, order_params):
+        with self.lock:
+            return self.insert_locked(chat_id, order_params)
+
+    def draft_key(self, chat_id, order_params):
+        # Same draft of the chat submitted again gets a new uslugi_id but the same key
+        order = order_params["order"]
+        return hashlib.sha256(orjson.dumps([
+            str(chat_id),
+            order["services"][0]["service_id"],
+            order["desired_dt"],
+            order["client"]["phone"],
+            order["address"]["name"],
+            order["address"]["geopoint"],
+        ])).hexdigest()
+
+    def insert_locked(self, chat_id, order_params):
+        conn = self.connection()
+        now = time.time()
+        draft_key = self.draft_key(chat_id, order_params)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            duplicate = conn.execute(
+                """
+                    SELECT uslugi_id FROM order_outbox
+                    WHERE draft_key = ? AND created > ? AND status != ?
+                """,
+                (draft_key, now - self.draft_window, FAILED)
+            ).fetchone()
+            inserted = False
+            if duplicate is None:
+                cursor = conn.execute(
+                    """
+                        INSERT OR IGNORE INTO order_outbox
+                        (uslugi_id, chat_id, params, status, next_attempt, created, updated, draft_key)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        order_params["order"]["uslugi_id"],
+                        str(chat_id),
+                        orjson.dumps(order_params).decode(),
+                        PENDING,
+                        now,
+                        now,
+                        now,
+                        draft_key,
+                    )
+                )
+                inserted = cursor.rowcount > 0
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return inserted
+
+    async def enqueue(self, chat_id, order_params):
+        # The order is durable once this returns, 1C submission goes in background
+        inserted = await asyncio.to_thread(self.insert, chat_id, order_params)
+        if inserted:
+            self.counters["enqueued"] += 1
+        else:
+            self.counters["duplicates"] += 1
+            self.logger.info(f"Order of chat {chat_id} is already in the outbox")
+        self.wakeup.set()
+        return inserted
+
+    def claim(self):
+        with self.lock:
+            return self.claim_locked()
+
+    def claim_locked(self):
+        # Due orders not leased by another worker
+        conn = self.connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                """
+                    SELECT uslugi_id, chat_id, params, status, attempts, created
+                    FROM order_outbox
+                    WHERE status IN (?, ?) AND next_attempt <= ? AND lease_until < ?
+                    ORDER BY next_attempt
+                    LIMIT ?
+                """,
+                (PENDING, SUBMITTED, now, now, self.concurrency)
+            ).fetchall()
+            conn.executemany(
+                """
+                    UPDATE order_outbox SET lease_owner = ?, lease_until = ?
+                    WHERE uslugi_id = ?
+                """,
+                [(self.owner, now + self.lease, row[0]) for row in rows]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def update(self, uslugi_id, **fields):
+        fields["updated"] = time.time()
+        fields["lease_until"] = 0
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self.lock:
+            self.connection().execute(
+                f"UPDATE order_outbox SET {columns} WHERE uslugi_id = ?",
+                (*fields.values(), uslugi_id)
+            )
+
+    def next_delay(self, attempts):
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempts))
+
+    async def new_bid_number(self, uslugi_id, params):
+        order = orjson.loads(params)["order"]
+        try:
+            affilate = order["address"]["name_components"][0]["name"]
+        except (KeyError, IndexError):
+            affilate = None
+        results = await self.ws_router.query(
+            {
+                "Идентификатор": "new_bid_number",
+                "НомерПартнера": uslugi_id,
+            },
+            affilate
+        )
+        for value in results.values():
+            if len(value) > 0:
+                return str(value[0]["id"])
+        return None
+
+    async def submit(self, uslugi_id, chat_id, params, attempts, created):
+        # A retried order may have reached 1C before the previous attempt failed
+        if attempts > 0 and await self.new_bid_number(uslugi_id, params):
+            self.counters["already_in_1c"] += 1
+        else:
+            order = await self.proxy_client.http_service(
+                self.order_path,
+                orjson.loads(params)
+            )
+            self.logger.info(f"Result:\n{order.status_code}\n{order.text}")
+            # Only transport errors and 5xx answers are retried
+            if 400 <= order.status_code < 500:
+                raise OrderRejected(f"{order.status_code} {order.text}")
+            if order.status_code != 200:
+                raise RuntimeError(f"{order.status_code} {order.text}")
+
+        self.counters["submitted"] += 1
+        self.counters["submit_delay_total"] += time.time() - created
+        self.bid_cache.invalidate(chat_id)
+        await asyncio.to_thread(
+            self.update,
+            uslugi_id,
+            status=SUBMITTED,
+            attempts=0,
+            next_attempt=time.time(),
+            error=None
+        )
+
+    async def poll_number(self, uslugi_id, chat_id, params, attempts):
+        request_number = await self.new_bid_number(uslugi_id, params)
+        self.logger.info(f"number: {request_number}")
+        if request_number is None and attempts + 1 < self.number_polls:
+            await asyncio.to_thread(
+                self.update,
+                uslugi_id,
+                attempts=attempts + 1,
+                next_attempt=time.time() + self.next_delay(attempts)
+            )
+            return
+
+        await asyncio.to_thread(
+            self.update,
+            uslugi_id,
+            status=DONE,
+            request_number=request_number
+        )
+        if request_number:
+            self.counters["numbers_delivered"] += 1
+            await self.notify(chat_id, f"Ваша заявка зарегистрирована под номером {request_number}")
+
+    async def process(self, row):
+        uslugi_id, chat_id, params, status, attempts, created = row
+        try:
+            if status == PENDING:
+                await self.submit(uslugi_id, chat_id, params, attempts, created)
+            else:
+                await self.poll_number(uslugi_id, chat_id, params, attempts)
+        except OrderRejected as e:
+            self.logger.error(f"Outbox order {uslugi_id} rejected by 1C: {e}")
+            self.counters["failed"] += 1
+            self.counters["rejected"] += 1
+            await asyncio.to_thread(
+                self.update,
+                uslugi_id,
+                status=FAILED,
+                attempts=attempts + 1,
+                error=str(e)
+            )
+            await self.notify(chat_id, FAILURE_MESSAGE)
+        except Exception as e:
+            self.logger.error(f"Error in processing outbox order {uslugi_id}: {e}")
+            attempts += 1
+            if status == SUBMITTED and attempts >= self.number_polls:
+                # The order is in 1C, only its number is not delivered
+                await asyncio.to_thread(
+                    self.update,
+                    uslugi_id,
+                    status=DONE,
+                    attempts=attempts,
+                    error=str(e)
+                )
+                return
+            if status == PENDING and attempts >= self.max_attempts:
+                self.counters["failed"] += 1
+                await asyncio.to_thread(
+                    self.update,
+                    uslugi_id,
+                    status=FAILED,
+                    attempts=attempts,
+                    error=str(e)
+                )
+                await self.notify(chat_id, FAILURE_MESSAGE)
+                return
+            self.counters["retries"] += 1
+            await asyncio.to_thread(
+                self.update,
+                uslugi_id,
+                attempts=attempts,
+                next_attempt=time.time() + self.next_delay(attempts),
+                error=str(e)
+            )
+
+    async def notify(self, chat_id, text):
+        try:
+            answer = await self.bot_instance.send_message(chat_id, text)
+            await self.chat_data_service.insert_message_to_sql(
+                answer.from_user.first_name if answer.from_user.first_name else None,
+                answer.from_user.last_name if answer.from_user.last_name else None,
+                answer.from_user.is_bot,
+                answer.from_user.id,
+                chat_id,
+                answer.message_id,
+                datetime.fromtimestamp(answer.date).strftime("%Y-%m-%d %H:%M:%S"),
+                text,
+                answer.from_user.username if answer.from_user.username else None
+            )
+        except Exception as e:
+            self.logger.error(f"Error in notifying about order: {e}")
+
+    async def run(self):
+        while True:
+            try:
+                rows = await asyncio.to_thread(self.claim)
+            except Exception as e:
+                self.logger.error(f"Error in claiming outbox orders: {e}")
+                rows = []
+            if rows:
+                await asyncio.gather(*(self.process(row) for row in rows))
+                continue
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self.worker is None:
+            self.worker = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+
+    def stats(self):
+        try:
+            with self.lock:
+                statuses = dict(self.connection().execute(
+                    "SELECT status, COUNT(*) FROM order_outbox GROUP BY status"
+                ).fetchall())
+        except Exception as e:
+            self.logger.error(f"Error in reading outbox stats: {e}")
+            statuses = {}
+        return {
+            **self.counters,
+            "submit_delay_avg": round(
+                self.counters["submit_delay_total"] / self.counters["submitted"], 3
+            ) if self.counters["submitted"] else None,
+            "statuses": statuses,
+        }
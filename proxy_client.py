@@ -0,0 +1,108 @@
+import os
+import json
+
+import httpx
+import orjson
+
+from pydantic import BaseModel
+
+
+class ProxyResponse(BaseModel):
+    endpoint: str
+    status_code: int
+    text: str
+    elapsed: float
+
+    def data(self):
+        return json.loads(self.text)
+
+
+class ProxyClient:
+    def __init__(
+        self,
+        proxy_url,
+        resilience,
+        logger,
+        timeouts=None,
+        max_connections=20,
+        max_keepalive_connections=10,
+        http2=True
+    ):
+        self.logger = logger
+        self.resilience = resilience
+        self.timeouts = {"ws": 30, "hs": 30, "rev": 15, "ex": 30}
+        self.timeouts.update(timeouts or {})
+        self.token = os.environ.get("1С_TOKEN", "")
+        self.login = os.environ.get("1C_LOGIN", "")
+        self.password = os.environ.get("1C_PASSWORD", "")
+
+        # One pooled keep-alive client for all 1C proxy calls of the worker
+        self.client = httpx.AsyncClient(
+            base_url=proxy_url,
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections
+            )
+        )
+
+    async def post(self, endpoint, payload):
+        payload["token"] = self.token
+        # Only reading endpoints are retried, orders and changes are not idempotent
+        response = await self.resilience.call(
+            "1c",
+            lambda: self.client.post(
+                f"/{endpoint}",
+                content=orjson.dumps(payload),
+                headers={"Content-Type": "application/json"},
+                timeout=self.timeouts.get(endpoint, 30)
+            ),
+            None if endpoint in ("ws", "rev") else 0,
+            lambda response: response.status_code >= 500
+        )
+        return ProxyResponse(
+            endpoint=endpoint,
+            status_code=response.status_code,
+            text=response.text,
+            elapsed=response.elapsed.total_seconds()
+        )
+
+    async def web_service(self, ws_paths, params):
+        # /ws query to the 1C bases, returns results by base
+        response = await self.post(
+            "ws",
+            {
+                "config": {
+                    "clientPath": ws_paths,
+                    "login": self.login,
+                    "password": self.password,
+                },
+                "params": params,
+            }
+        )
+        return response.data()["result"]
+
+    async def http_service(self, client_path, params):
+        # /hs call, orders creation and operator calls
+        return await self.post(
+            "hs",
+            {"config": {"clientPath": client_path}, "params": params}
+        )
+
+    async def revision(self, client_path):
+        # /rev, current order data with its revision
+        response = await self.post(
+            "rev",
+            {"config": {"clientPath": client_path}}
+        )
+        return response.data()["result"]["order"]
+
+    async def exchange(self, client_path, params):
+        # /ex, order changes
+        return await self.post(
+            "ex",
+            {"config": {"clientPath": client_path}, "params": params}
+        )
+
+    async def close(self):
+        await self.client.aclose()
@@ -0,0 +1,192 @@
+import time
+import random
+import asyncio
+
+from collections import deque
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    def __init__(self, name):
+        super().__init__(f"{name} is temporarily unavailable")
+        self.name = name
+
+
+class LatencyWindow:
+    def __init__(self, size=500, period=300):
+        # (time, latency, ok) of the last calls within the period
+        self.calls = deque(maxlen=size)
+        self.period = period
+
+    def add(self, latency, ok):
+        self.calls.append((time.monotonic(), latency, ok))
+
+    def recent(self):
+        border = time.monotonic() - self.period
+        while self.calls and self.calls[0][0] < border:
+            self.calls.popleft()
+        return self.calls
+
+    def error_rate(self):
+        calls = self.recent()
+        if not calls:
+            return None
+        return sum(1 for _, _, ok in calls if not ok) / len(calls)
+
+    def stats(self):
+        calls = self.recent()
+        if not calls:
+            return {"calls": 0}
+        latencies = sorted(latency for _, latency, _ in calls)
+
+        def percentile(share):
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * share))], 3)
+
+        return {
+            "calls": len(calls),
+            "error_rate": round(self.error_rate(), 3),
+            "p50": percentile(0.5),
+            "p95": percentile(0.95),
+            "p99": percentile(0.99),
+        }
+
+
+class Dependency:
+    def __init__(
+        self,
+        name,
+        logger,
+        failure_threshold=5,
+        failure_rate=0.5,
+        min_calls=20,
+        open_timeout=30,
+        retries=0,
+        base_delay=0.2,
+        max_delay=2,
+        window_size=500,
+        window_period=300
+    ):
+        self.name = name
+        self.logger = logger
+        self.failure_threshold = failure_threshold
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.open_timeout = open_timeout
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.window = LatencyWindow(window_size, window_period)
+        self.state = CLOSED
+        self.opened_at = 0
+        self.consecutive_failures = 0
+        self.probe = False
+        self.counters = {"opened": 0, "rejected": 0, "retries": 0}
+
+    def is_open(self):
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.open_timeout:
+            self.state = HALF_OPEN
+            self.probe = False
+        return self.state == OPEN or (self.state == HALF_OPEN and self.probe)
+
+    def before_call(self):
+        if self.is_open():
+            self.counters["rejected"] += 1
+            raise CircuitOpen(self.name)
+        if self.state == HALF_OPEN:
+            # Only one probe call goes through a half-open breaker
+            self.probe = True
+
+    def record(self, latency, ok):
+        self.window.add(latency, ok)
+        if ok:
+            self.consecutive_failures = 0
+            if self.state != CLOSED:
+                self.logger.info(f"Circuit breaker of {self.name} is closed")
+            self.state = CLOSED
+            return
+
+        self.consecutive_failures += 1
+        error_rate = self.window.error_rate()
+        if (
+            self.state == HALF_OPEN
+            or self.consecutive_failures >= self.failure_threshold
+            or (
+                len(self.window.calls) >= self.min_calls
+                and error_rate >= self.failure_rate
+            )
+        ):
+            if self.state != OPEN:
+                self.counters["opened"] += 1
+                self.logger.error(f"Circuit breaker of {self.name} is open")
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.probe = False
+
+    def next_delay(self, attempt):
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def stats(self):
+        self.is_open()
+        return {
+            "state": self.state,
+            **self.counters,
+            **self.window.stats(),
+        }
+
+
+class Resilience:
+    def __init__(self, logger, config=None):
+        self.logger = logger
+        # {"default": {...}, "<dependency>": {...}} with Dependency settings
+        self.config = config or {}
+        self.dependencies = {}
+
+    def dependency(self, name):
+        if name not in self.dependencies:
+            settings = {
+                **self.config.get("default", {}),
+                **self.config.get(name, {}),
+            }
+            self.dependencies[name] = Dependency(name, self.logger, **settings)
+        return self.dependencies[name]
+
+    def is_open(self, name):
+        return self.dependency(name).is_open()
+
+    async def call(self, name, factory, retries=None, failed=None):
+        # Calls factory() with breaker, bounded retries and latency recording.
+        # failed(result) marks a returned result as a failure, e.g. a 5xx response
+        dependency = self.dependency(name)
+        retries = dependency.retries if retries is None else retries
+        attempt = 0
+        while True:
+            dependency.before_call()
+            start = time.monotonic()
+            try:
+                result = await factory()
+            except asyncio.CancelledError:
+                dependency.probe = False
+                raise
+            except Exception:
+                dependency.record(time.monotonic() - start, False)
+                if attempt >= retries or dependency.is_open():
+                    raise
+            else:
+                ok = not (failed and failed(result))
+                dependency.record(time.monotonic() - start, ok)
+                if ok or attempt >= retries or dependency.is_open():
+                    return result
+            dependency.counters["retries"] += 1
+            await asyncio.sleep(dependency.next_delay(attempt))
+            attempt += 1
+
+    def stats(self):
+        return {
+            name: dependency.stats()
+            for name, dependency in self.dependencies.items()
+        }
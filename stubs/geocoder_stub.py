@@ -0,0 +1,94 @@
+# Local stand-in for Nominatim and Yandex geocoders.
+# Run: uvicorn stubs.geocoder_stub:app --port 7490
+# and set "geocoding": {"stub_url": "http://127.0.0.1:7490"} in data/config.json.
+# Latency (seconds) and error rate per provider are read from the environment:
+# NOMINATIM_LATENCY, NOMINATIM_JITTER, NOMINATIM_ERROR_RATE, YANDEX_LATENCY, ...
+import os
+import random
+import asyncio
+
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+
+app = FastAPI()
+
+
+def provider_params(provider):
+    prefix = provider.upper()
+    return (
+        float(os.environ.get(f"{prefix}_LATENCY", "0.3")),
+        float(os.environ.get(f"{prefix}_JITTER", "0.2")),
+        float(os.environ.get(f"{prefix}_ERROR_RATE", "0")),
+    )
+
+
+async def emulate(provider):
+    # Normally distributed latency and random server errors
+    latency, jitter, error_rate = provider_params(provider)
+    await asyncio.sleep(max(0, random.gauss(latency, jitter)))
+    return random.random() < error_rate
+
+
+def fake_point(seed):
+    rng = random.Random(seed)
+    return 55.75 + rng.uniform(-0.2, 0.2), 37.62 + rng.uniform(-0.3, 0.3)
+
+
+def nominatim_place(seed):
+    latitude, longitude = fake_point(seed)
+    return {
+        "place_id": abs(hash(seed)) % 10**8,
+        "lat": str(latitude),
+        "lon": str(longitude),
+        "addresstype": "building",
+        "name": "",
+        "display_name": f"{abs(hash(seed)) % 200 + 1}, Тестовая улица, Москва, Россия",
+    }
+
+
+def yandex_member(seed):
+    latitude, longitude = fake_point(seed)
+    formatted = f"Россия, Москва, Тестовая улица, {abs(hash(seed)) % 200 + 1}"
+    return {
+        "GeoObject": {
+            "name": formatted,
+            "description": "Москва, Россия",
+            "Point": {"pos": f"{longitude} {latitude}"},
+            "metaDataProperty": {
+                "GeocoderMetaData": {
+                    "kind": "house",
+                    "precision": "exact",
+                    "text": formatted,
+                    "Address": {"formatted": formatted},
+                }
+            },
+        }
+    }
+
+
+@app.get("/search")
+async def nominatim_search(q: str = ""):
+    if await emulate("nominatim"):
+        return JSONResponse(status_code=503, content={"error": "stub error"})
+    return [nominatim_place(q)]
+
+
+@app.get("/reverse")
+async def nominatim_reverse(lat: str = "", lon: str = ""):
+    if await emulate("nominatim"):
+        return JSONResponse(status_code=503, content={"error": "stub error"})
+    return nominatim_place(f"{lat},{lon}")
+
+
+@app.get("/1.x/")
+async def yandex_geocode(geocode: str = ""):
+    if await emulate("yandex"):
+        return JSONResponse(status_code=503, content={"error": "stub error"})
+    return {
+        "response": {
+            "GeoObjectCollection": {
+                "featureMember": [yandex_member(geocode)]
+            }
+        }
+    }
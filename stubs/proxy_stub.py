@@ -0,0 +1,190 @@
+# Local stand-in for the 1C proxy: /ws, /hs, /rev and /ex.
+# Run: uvicorn stubs.proxy_stub:app --port 7405
+# and set "proxy_client": {"stub_url": "http://127.0.0.1:7405"} in data/config.json.
+# Behaviour is read from the environment, per endpoint settings override the common ones:
+# PROXY_LATENCY_DIST - gauss, lognormal or fixed,
+# PROXY_LATENCY, PROXY_JITTER, PROXY_ERROR_RATE, e.g. PROXY_WS_LATENCY, PROXY_EX_ERROR_RATE,
+# NUMBER_DELAY - seconds before a created order gets its number,
+# REVISION_DRIFT - probability that an order is changed in 1C before an /ex call.
+import os
+import math
+import time
+import random
+import asyncio
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+app = FastAPI()
+
+# uslugi_id: order payload with "number", "chat_id", "base" and "created"
+orders = {}
+numbers = {}
+counters = {
+    "orders": 0,
+    "duplicates": 0,
+    "changes": 0,
+    "conflicts": 0,
+    "operator_calls": 0,
+    "errors": 0,
+}
+BASES = {"Москва": "msk", "Санкт-Петербург": "spb"}
+
+
+def setting(endpoint, name, default):
+    return os.environ.get(
+        f"PROXY_{endpoint.upper()}_{name}",
+        os.environ.get(f"PROXY_{name}", default)
+    )
+
+
+def latency(endpoint):
+    mean = float(setting(endpoint, "LATENCY", "0.5"))
+    jitter = float(setting(endpoint, "JITTER", "0.3"))
+    distribution = setting(endpoint, "LATENCY_DIST", "gauss")
+    if distribution == "fixed" or mean <= 0:
+        return max(0, mean)
+    if distribution == "lognormal":
+        # Long tail with the given mean and standard deviation
+        sigma = math.sqrt(math.log(1 + (jitter / mean) ** 2))
+        return random.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma)
+    return max(0, random.gauss(mean, jitter))
+
+
+async def emulate(endpoint):
+    await asyncio.sleep(latency(endpoint))
+    if random.random() < float(setting(endpoint, "ERROR_RATE", "0")):
+        counters["errors"] += 1
+        return JSONResponse(status_code=503, content={"error": "stub error"})
+    return None
+
+
+def path_id(client_path):
+    # Partner number at the end of crm / domain path
+    return next(iter(client_path.values())).rstrip("/").rsplit("/", 1)[-1]
+
+
+def bid(order):
+    return {
+        "id": order["number"],
+        "date": order["date"],
+        "division": order["division"],
+        "comment": order["order"]["comment"] or "''",
+    }
+
+
+def results(client_path, found):
+    # Results are grouped by the requested bases
+    grouped = {base: [] for base in client_path}
+    for order in found:
+        if order["base"] in grouped:
+            grouped[order["base"]].append(bid(order))
+    return {"result": grouped}
+
+
+@app.post("/hs")
+async def http_service(request: Request):
+    body = await request.json()
+    error = await emulate("hs")
+    if error:
+        return error
+    order = body["params"].get("order")
+    if order is None:
+        counters["operator_calls"] += 1
+        return {"result": "ok"}
+
+    uslugi_id = order["uslugi_id"]
+    if uslugi_id in orders:
+        counters["duplicates"] += 1
+        return {"result": "ok"}
+    counters["orders"] += 1
+    number = str(100000 + len(orders))
+    orders[uslugi_id] = {
+        "order": order,
+        "number": number,
+        "chat_id": uslugi_id[14:],
+        "base": BASES.get(order["address"]["name_components"][0]["name"], "reg"),
+        "created": time.monotonic(),
+        "date": time.strftime("%d.%m.%Y %H:%M:%S", time.localtime()),
+        "division": order["services"][0]["service_id"],
+    }
+    numbers[number] = uslugi_id
+    return {"result": "ok"}
+
+
+@app.post("/ws")
+async def web_service(request: Request):
+    body = await request.json()
+    error = await emulate("ws")
+    if error:
+        return error
+    client_path = body["config"]["clientPath"]
+    query = body["params"]
+    found = []
+    if query["Идентификатор"] == "new_bid_number":
+        order = orders.get(query["НомерПартнера"])
+        number_delay = float(os.environ.get("NUMBER_DELAY", "1"))
+        if order and time.monotonic() - order["created"] >= number_delay:
+            found.append(order)
+    elif query["Идентификатор"] == "bid_numbers":
+        found = [
+            order for order in orders.values()
+            if order["chat_id"] == query["НомерПартнера"]
+        ]
+    elif query["Идентификатор"] == "data_to_change_bid":
+        uslugi_id = numbers.get(str(query["Номер"]))
+        if uslugi_id:
+            response = results(client_path, [orders[uslugi_id]])
+            # Change data is identified by the partner number
+            for bids in response["result"].values():
+                for item in bids:
+                    item["id"] = uslugi_id
+            return response
+    return results(client_path, found)
+
+
+@app.post("/rev")
+async def revision(request: Request):
+    body = await request.json()
+    error = await emulate("rev")
+    if error:
+        return error
+    order = orders.get(path_id(body["config"]["clientPath"]))
+    if order is None:
+        return JSONResponse(status_code=404, content={"error": "order not found"})
+    return {"result": {"order": order["order"]}}
+
+
+@app.post("/ex")
+async def exchange(request: Request):
+    body = await request.json()
+    error = await emulate("ex")
+    if error:
+        return error
+    order = orders.get(path_id(body["config"]["clientPath"]))
+    if order is None:
+        return JSONResponse(status_code=404, content={"error": "order not found"})
+    # Order edited in 1C since the revision was read
+    if random.random() < float(os.environ.get("REVISION_DRIFT", "0")):
+        order["order"]["revision"] += 1
+
+    change = body["params"]["order"]
+    # A change must be based on the current revision
+    if change["revision"] != order["order"]["revision"] + 1:
+        counters["conflicts"] += 1
+        return JSONResponse(
+            status_code=409,
+            content={"error": f"revision conflict, current revision {order['order']['revision']}"}
+        )
+    counters["changes"] += 1
+    order["order"]["revision"] = change["revision"]
+    order["order"]["comment"] = change["comment"]
+    if change["client"]["phone"]:
+        order["order"]["client"]["phone"] = change["client"]["phone"]
+    return {"result": "ok"}
+
+
+@app.get("/stats")
+async def stats():
+    return counters
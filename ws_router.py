@@ -0,0 +1,82 @@
+import time
+
+from collections import OrderedDict
+
+
+FAN_OUT = "all"
+
+
+class WsRouter:
+    def __init__(
+        self,
+        proxy_client,
+        ws_paths,
+        logger,
+        regions=None,
+        default_base=None,
+        maxsize=10000
+    ):
+        self.logger = logger
+        self.proxy_client = proxy_client
+        self.ws_paths = ws_paths
+        # affilate: 1C base key of ws_paths, other known affilates go to default_base
+        self.regions = regions or {}
+        self.default_base = default_base
+        self.maxsize = maxsize
+        self.bid_bases = OrderedDict()
+        self.latencies = {}
+
+    def base(self, affilate=None, request_number=None):
+        # 1C base of an affilate or of an already seen bid, None if unknown
+        if request_number is not None:
+            base = self.bid_bases.get(str(request_number))
+            if base in self.ws_paths:
+                return base
+        if affilate:
+            base = self.regions.get(affilate, self.default_base)
+            if base in self.ws_paths:
+                return base
+        return None
+
+    def route(self, affilate=None, request_number=None):
+        return self.base(affilate, request_number) or FAN_OUT
+
+    def paths(self, route):
+        if route == FAN_OUT:
+            return self.ws_paths
+        return {route: self.ws_paths[route]}
+
+    async def query(self, params, affilate=None, request_number=None):
+        # Web service query only to the relevant base, to all of them if the region is unknown
+        route = self.route(affilate, request_number)
+        start = time.monotonic()
+        try:
+            results = await self.proxy_client.web_service(self.paths(route), params)
+        finally:
+            self.record(route, time.monotonic() - start)
+        self.remember(results)
+        return results
+
+    def remember(self, results):
+        # Bases of returned bids, later queries by bid number go only there
+        for base, bids in results.items():
+            for bid in bids:
+                if "id" in bid:
+                    self.bid_bases[str(bid["id"])] = base
+                    self.bid_bases.move_to_end(str(bid["id"]))
+        while len(self.bid_bases) > self.maxsize:
+            self.bid_bases.popitem(last=False)
+
+    def record(self, route, latency):
+        count, total, maximum = self.latencies.get(route, (0, 0.0, 0.0))
+        self.latencies[route] = (count + 1, total + latency, max(maximum, latency))
+
+    def stats(self):
+        return {
+            route: {
+                "count": count,
+                "latency_avg": round(total / count, 3),
+                "latency_max": round(maximum, 3),
+            }
+            for route, (count, total, maximum) in self.latencies.items()
+        }